@@ -1,63 +1,50 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import os
-import praw
-import time
-import traceback
-import logging
+import sys
+from typing import List, Optional
 
-from praw.exceptions import RedditAPIException
-from praw.models import Message
+import praw
+import requests
 
-from exception.exceptions import ReferralBotFatalException
-from responder import Responder
 from referralbotconfig import ReferralBotConfig
+from tenants import TenantRunner
 
-# Start logger
-logging.basicConfig(filename='log.txt', level=logging.INFO, format='%(asctime)s %(message)s')
+# logged in when the bot starts, unless set beforehand.  Used by tenants without a prawSite
+reddit: Optional[praw.Reddit] = None
 
-# Log into Reddit API
-try:
-    reddit = praw.Reddit(client_id=os.environ["CLIENT_ID"],
-                         client_secret=os.environ["CLIENT_SECRET"],
-                         password=os.environ["REDDIT_PASSWORD"],
-                         user_agent='script:PMAutomaticReplyBot:v1',
-                         username=os.environ["REDDIT_USERNAME"])
-except KeyError:
-    reddit = praw.Reddit('bot1')
 
+def login(config: ReferralBotConfig, session: requests.Session = None) -> praw.Reddit:
+    """Log into Reddit API as config's bot account, sending requests through session"""
+    global reddit
 
-def handle():
-    config: ReferralBotConfig = ReferralBotConfig('referralbot.ini')
-    print("Starting...")
-    logging.info("[Info] Starting bot in {type} mode...".format(type=config.referral_source_type))
+    requestor_kwargs = {'session': session} if session is not None else {}
 
-    while True:
-        print("Checking inbox...")
+    if config.praw_site:
+        return praw.Reddit(config.praw_site, requestor_kwargs=requestor_kwargs)
 
+    if reddit is None:
         try:
-            for message in reddit.inbox.unread(limit=None):
-                if isinstance(message, Message):
-                    responder = Responder(reddit, config, message)
-                    responder.run()
-                    message.mark_read()
-            time.sleep(30)
-
-        except ReferralBotFatalException:
-            print("FATAL error occurred. Here's the traceback: \n {} \n\n Exiting!".format(traceback.format_exc()))
-            logging.fatal("[FATAL] {msg}".format(msg=format(traceback.format_exc())))
-            logging.fatal("[FATAL] Bot is terminating")
-            exit(1)
-        except RedditAPIException:
-            # probably rate limited. Sleep for a minute
-            print("Error occurred. Here's the traceback: \n {} \n\n Sleeping...".format(traceback.format_exc()))
-            logging.warning("[Warning] Error occurred.  Stacktrace follows: \n {}".format(traceback.format_exc()))
-            time.sleep(60)
-        except Exception:
-            print("Error occurred. Here's the traceback: \n {} \n\n Sleeping...".format(traceback.format_exc()))
-            logging.warning("[Warning] Error checking inbox.  Stacktrace follows: \n {}".format(traceback.format_exc()))
-            time.sleep(30)
+            reddit = praw.Reddit(client_id=os.environ["CLIENT_ID"],
+                                 client_secret=os.environ["CLIENT_SECRET"],
+                                 password=os.environ["REDDIT_PASSWORD"],
+                                 user_agent='script:PMAutomaticReplyBot:v1',
+                                 username=os.environ["REDDIT_USERNAME"],
+                                 requestor_kwargs=requestor_kwargs)
+        except KeyError:
+            reddit = praw.Reddit('bot1', requestor_kwargs=requestor_kwargs)
+
+    return reddit
+
+
+def handle(config_file: str = 'referralbot.ini'):
+    handle_tenants([config_file])
+
+
+def handle_tenants(config_files: List[str]):
+    """Serve every community configured in config_files from this process"""
+    TenantRunner(config_files, login).run()
 
 
 if __name__ == "__main__":
-    handle()
+    handle_tenants(sys.argv[1:] or ['referralbot.ini'])
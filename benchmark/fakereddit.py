@@ -0,0 +1,151 @@
+import itertools
+import time
+import uuid
+from typing import Dict, Iterator, List
+
+
+class FakeWikiPage(object):
+    """
+    In-memory stand-in for praw.models.WikiPage
+    """
+
+    def __init__(self, name: str, content_md: str = ''):
+        self.name: str = name
+        self.content_md: str = content_md
+        self.revision_id: str = uuid.uuid4().hex
+        self.may_revise: bool = True
+        self.edits: int = 0
+
+    @property
+    def mod(self):
+        # the handlers read page.mod.wikipage.content_md
+        return self
+
+    @property
+    def wikipage(self):
+        return self
+
+    def edit(self, content: str, reason: str = None, **other_settings):
+        self.content_md = content
+        self.revision_id = uuid.uuid4().hex
+        self.edits += 1
+
+    def revisions(self, limit: int = None) -> Iterator[dict]:
+        yield {'id': self.revision_id}
+
+
+class FakeWiki(object):
+
+    def __init__(self):
+        self.pages: Dict[str, FakeWikiPage] = {}
+
+    def __getitem__(self, name: str) -> FakeWikiPage:
+        if name not in self.pages:
+            self.pages[name] = FakeWikiPage(name)
+        return self.pages[name]
+
+
+class FakeSubreddit(object):
+
+    def __init__(self, name: str):
+        self.display_name: str = name
+        self.wiki: FakeWiki = FakeWiki()
+
+
+class FakeRedditor(object):
+    """
+    In-memory stand-in for praw.models.Redditor, old enough and with enough karma to pass every check
+    """
+
+    def __init__(self, reddit: 'FakeReddit', name: str):
+        self._reddit: FakeReddit = reddit
+        self.name: str = name
+        self.created_utc: float = time.time() - 365 * 86400
+        self.link_karma: int = 100
+        self.comment_karma: int = 100
+
+    def message(self, subject: str, message: str, from_subreddit=None):
+        self._reddit.sent.append((self.name, subject))
+
+    def __eq__(self, other):
+        return str(self).lower() == str(other).lower()
+
+    def __hash__(self):
+        return hash(self.name.lower())
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage(object):
+    """
+    In-memory stand-in for praw.models.Message
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, reddit: 'FakeReddit', author: str, subject: str, body: str):
+        self.id: str = 'm{}'.format(next(self._ids))
+        self.fullname: str = 't4_' + self.id
+        self.author: FakeRedditor = reddit.redditor(author)
+        self.subject: str = subject
+        self.body: str = body
+        self.created_utc: float = time.time()
+        self.replies: List[str] = []
+        self.read: bool = False
+
+    def reply(self, body: str):
+        self.replies.append(body)
+
+    def mark_read(self):
+        self.read = True
+
+
+class FakeInbox(object):
+
+    def __init__(self):
+        self.messages: List[FakeMessage] = []
+
+    def unread(self, limit=None, **kwargs) -> Iterator[FakeMessage]:
+        return iter([message for message in self.messages if not message.read])
+
+    def mark_read(self, items: List[FakeMessage]):
+        for item in items:
+            item.read = True
+
+
+class FakeAuth(object):
+    limits: dict = {'remaining': None, 'reset_timestamp': None, 'used': None}
+
+
+class FakeReddit(object):
+    """
+    In-memory stand-in for the parts of praw.Reddit the bot uses.  Messages sent to redditors are
+    recorded in sent.
+    """
+
+    def __init__(self):
+        self.auth: FakeAuth = FakeAuth()
+        self.inbox: FakeInbox = FakeInbox()
+        self.sent: List[tuple] = []
+        self._subreddits: Dict[str, FakeSubreddit] = {}
+        self._redditors: Dict[str, FakeRedditor] = {}
+
+    def subreddit(self, name: str) -> FakeSubreddit:
+        if name.lower() not in self._subreddits:
+            self._subreddits[name.lower()] = FakeSubreddit(name)
+        return self._subreddits[name.lower()]
+
+    def redditor(self, name: str) -> FakeRedditor:
+        if name.lower() not in self._redditors:
+            self._redditors[name.lower()] = FakeRedditor(self, name)
+        return self._redditors[name.lower()]
+
+
+class FakeValidationClient(object):
+    """
+    Stand-in for validationclient.ValidationClient that accepts every code without a network call
+    """
+
+    def is_valid(self, url: str) -> bool:
+        return True
@@ -0,0 +1,276 @@
+"""
+End to end load test of app.handle against the local Reddit simulator
+
+Starts the simulator, seeds the referral lists, runs the bot in a background thread with a configuration
+pointing at the simulator and injects a mix of messages at a steady rate.  The time from injecting a message to
+its reply arriving is reported per command, with overall throughput and the API calls made.
+
+    python -m benchmark.loadtest --messages 1000 --rate 20 --mix referral=70,optin=15,renewal=14,replace_month=1
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from configparser import ConfigParser
+from typing import Dict, List, Optional, Set, Tuple
+
+import praw
+
+from benchmark.fakereddit import FakeReddit
+from benchmark.redditsim import RedditSimulator
+from benchmark.run import BACKENDS
+from benchmark.synthetic import generate_entries, render, taken_codes, unused_code
+from referralbotconfig import ReferralBotConfig
+
+DEFAULT_MIX = 'referral=70,optin=15,renewal=14,replace_month=1'
+
+
+def parse_mix(mix: str) -> List[Tuple[str, int]]:
+    """Parse "referral=70,optin=30" into [('referral', 70), ('optin', 30)]"""
+    weights = []
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind.strip() not in ('referral', 'optin', 'renewal', 'replace_month'):
+            raise ValueError("Unknown message kind in mix: " + kind)
+        weights.append((kind.strip(), int(weight or 1)))
+    return weights
+
+
+def schedule(weights: List[Tuple[str, int]], count: int) -> List[str]:
+    """Spread count messages over the kinds in proportion to their weights, interleaved rather than in runs"""
+    total = sum(weight for _, weight in weights)
+    credit = {kind: 0.0 for kind, _ in weights}
+    kinds = []
+
+    for _ in range(count):
+        for kind, weight in weights:
+            credit[kind] += weight / total
+        kind = max(credit, key=credit.get)
+        credit[kind] -= 1
+        kinds.append(kind)
+
+    return kinds
+
+
+def percentile(samples: List[float], share: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * share))]
+
+
+class LoadTest(object):
+    """
+    One run of the bot against the simulator
+
+    Attributes:
+        _simulator (RedditSimulator): the fake Reddit the bot talks to
+        _entries (List[Tuple[str, str]]): the synthetic referral list
+        _taken (Set[str]): codes in _entries
+        _ini (str): configuration file the bot runs with
+        _kinds (Dict[str, str]): injected message id -> kind of message
+    """
+
+    def __init__(self, args: argparse.Namespace, workdir: str):
+        self._args: argparse.Namespace = args
+        self._workdir: str = workdir
+        self._simulator: RedditSimulator = RedditSimulator(latency=args.latency_ms / 1000,
+                                                           jitter=args.jitter_ms / 1000,
+                                                           error_rate=args.error_rate,
+                                                           ratelimit=args.ratelimit)
+        self._entries: List[Tuple[str, str]] = generate_entries(args.list_size)
+        self._taken: Set[str] = taken_codes(self._entries)
+        self._ini: str = ''
+        self._config: Optional[ReferralBotConfig] = None
+        self._kinds: Dict[str, str] = {}
+        self._started: float = 0.0
+
+    def run(self) -> dict:
+        self._simulator.start()
+        self._ini = self._make_config()
+        self._config = ReferralBotConfig(self._ini)
+        self._seed()
+
+        # praw reads these settings from the environment when app.reddit is created below
+        os.environ.update({'CLIENT_ID': 'loadtest',
+                           'CLIENT_SECRET': 'loadtest',
+                           'REDDIT_USERNAME': self._simulator.bot_name,
+                           'REDDIT_PASSWORD': 'loadtest',
+                           'praw_check_for_updates': 'False',
+                           'NO_PROXY': '127.0.0.1,localhost'})
+        import app
+
+        # the Reddit URLs can only be passed to praw.Reddit, not set in the environment
+        app.reddit = praw.Reddit(client_id='loadtest',
+                                 client_secret='loadtest',
+                                 username=self._simulator.bot_name,
+                                 password='loadtest',
+                                 user_agent='script:PMAutomaticReplyBot:loadtest',
+                                 oauth_url=self._simulator.url,
+                                 reddit_url=self._simulator.url)
+
+        output = sys.stdout if self._args.verbose else open(os.devnull, 'wt')
+        with contextlib.redirect_stdout(output):
+            threading.Thread(target=app.handle, args=(self._ini,), name='ReferralBot', daemon=True).start()
+            self._inject()
+            self._wait()
+
+        self._simulator.stop()
+        return self._report()
+
+    def _inject(self):
+        kinds = schedule(parse_mix(self._args.mix), self._args.messages)
+        interval = 1 / self._args.rate if self._args.rate > 0 else 0
+        renewals = iter(self._entries)
+        self._started = time.time()
+
+        for number, kind in enumerate(kinds):
+            if kind == 'referral':
+                author, subject, body = 'loaduser{}'.format(number), self._config.request_subject, 'Referral Please'
+            elif kind == 'optin':
+                author, subject, body = 'loaduser{}'.format(number), 'Opt-in', unused_code(self._taken, number)
+            elif kind == 'renewal':
+                # renew codes already on the list, each one once
+                author, body = next(renewals, ('loaduser{}'.format(number), unused_code(self._taken, number)))
+                subject = 'Renewal'
+            else:
+                author, subject, body = self._config.contact_name, 'Replace Month', 'Replace Month'
+
+            self._kinds[self._simulator.inject(author, subject, body)] = kind
+
+            if interval:
+                # keep a steady rate however long injecting took
+                time.sleep(max(0.0, self._started + (number + 1) * interval - time.time()))
+
+    def _wait(self):
+        deadline = time.time() + self._args.timeout
+        while time.time() < deadline and len(self._simulator.replied_at) < len(self._kinds):
+            time.sleep(0.1)
+
+    def _report(self) -> dict:
+        injected_at = self._simulator.injected_at
+        replied_at = self._simulator.replied_at
+        latencies: Dict[str, List[float]] = {}
+
+        for message_id, kind in self._kinds.items():
+            if message_id in replied_at:
+                latency = replied_at[message_id] - injected_at[message_id]
+                latencies.setdefault(kind, []).append(latency)
+                latencies.setdefault('all', []).append(latency)
+
+        for samples in latencies.values():
+            samples.sort()
+
+        duration = (max(replied_at.values()) - self._started) if replied_at else 0.0
+        return {'backend': self._args.backend,
+                'workers': self._args.workers,
+                'messages': len(self._kinds),
+                'replied': len(replied_at),
+                'duration_s': duration,
+                'throughput_per_s': len(replied_at) / duration if duration else 0.0,
+                'latency': {kind: {'count': len(samples),
+                                   'p50_s': percentile(samples, 0.5),
+                                   'p99_s': percentile(samples, 0.99),
+                                   'max_s': samples[-1]}
+                            for kind, samples in sorted(latencies.items())},
+                'api_calls': dict(self._simulator.calls),
+                'injected_errors': {str(status): count for status, count in self._simulator.errors.items()},
+                'messages_composed': len(self._simulator.sent)}
+
+    def _seed(self):
+        """Fill the referral list, approved for a month swap, and leave the renewal list empty"""
+        config = self._config
+        referrals = config.update_approved_text + render(self._entries)
+
+        if self._args.backend == 'wiki':
+            self._simulator.set_wiki_page(config.home_subreddit, config.referral_list_name, referrals)
+            self._simulator.set_wiki_page(config.home_subreddit, config.renewal_list_name, '')
+            return
+
+        referral_class, renewal_class = BACKENDS[self._args.backend]
+        referral_class(config, FakeReddit()).replace(referrals)
+        renewal_class(config, FakeReddit()).replace('')
+
+    def _make_config(self) -> str:
+        parser = ConfigParser(interpolation=None)
+        parser.optionxform = str
+        parser.read(self._args.config)
+        overrides = {
+            ('referralbot', 'referralOutputMethod'): self._args.backend,
+            ('referralbot', 'contactName'): 'loadtest',
+            ('referralbot', 'botName'): self._simulator.bot_name,
+            ('referralbot', 'workers'): str(self._args.workers),
+            ('Links', 'activation'): self._simulator.url + '/activate/',
+            ('Links', 'referralBaseUrl'): self._simulator.url + '/activate/?raf=',
+            ('file', 'referralList'): os.path.join(self._workdir, 'referralList.txt'),
+            ('file', 'renewalList'): os.path.join(self._workdir, 'renewalList.txt'),
+            ('sqlite', 'database'): os.path.join(self._workdir, 'referralbot.db'),
+            ('validation', 'cacheFile'): '',
+            ('validation', 'profileCacheFile'): '',
+            ('polling', 'journalFile'): '',
+            ('snapshot', 'file'): '',
+            ('revalidation', 'enabled'): 'false',
+            ('rotation', 'stateFile'): '',
+            ('polling', 'minInterval'): str(self._args.poll_interval),
+            ('polling', 'maxInterval'): str(self._args.poll_interval),
+            ('polling', 'errorDelay'): '1',
+            ('polling', 'maxErrorDelay'): '5',
+            ('Bulk Messages', 'queueDirectory'): os.path.join(self._workdir, 'bulkmessages'),
+        }
+        for (section, option), value in overrides.items():
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, option, value)
+
+        path = os.path.join(self._workdir, 'referralbot.ini')
+        with open(path, 'wt') as file:
+            parser.write(file)
+
+        return path
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Load test the referral bot against a local Reddit simulator')
+    parser.add_argument('--messages', type=int, default=500, help='messages to inject')
+    parser.add_argument('--rate', type=float, default=20, help='messages injected per second, 0 for all at once')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='relative weights of referral, optin, renewal and '
+                                                           'replace_month messages')
+    parser.add_argument('--backend', default='wiki', choices=('wiki', 'file', 'sqlite'))
+    parser.add_argument('--workers', type=int, default=1, help='inbox workers')
+    parser.add_argument('--list-size', type=int, default=1000, help='entries on the seeded referral list')
+    parser.add_argument('--latency-ms', type=float, default=50, help='latency added to every API request')
+    parser.add_argument('--jitter-ms', type=float, default=20, help='up to this much more latency, at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API requests failing with a 503')
+    parser.add_argument('--ratelimit', type=int, default=1000,
+                        help='API requests allowed per 10 minute window, 0 for no limit')
+    parser.add_argument('--poll-interval', type=float, default=1, help='seconds between inbox sweeps')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for the last reply')
+    parser.add_argument('--config', default='referralbot.ini', help='configuration to start from')
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help="show the bot's own output")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report = LoadTest(args, workdir).run()
+
+    if args.output:
+        with open(args.output, 'wt') as file:
+            json.dump(report, file, indent=2)
+
+    print("{replied}/{messages} replied in {duration_s:.1f}s, {throughput_per_s:.1f} messages/s".format(**report))
+    for kind, latency in report['latency'].items():
+        print("{kind:14} {count:>6}  p50 {p50_s:>8.3f}s  p99 {p99_s:>8.3f}s  max {max_s:>8.3f}s".format(
+            kind=kind, **latency))
+    print("API calls: " + ', '.join("{}={}".format(name, count) for name, count in sorted(report['api_calls'].items())))
+    if report['injected_errors']:
+        print("Injected errors: " + ', '.join("{}={}".format(status, count)
+                                              for status, count in sorted(report['injected_errors'].items())))
+
+    return 0 if report['replied'] == report['messages'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
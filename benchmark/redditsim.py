@@ -0,0 +1,421 @@
+"""
+Local stand-in for the Reddit endpoints the bot uses, served over HTTP so praw and prawcore run unmodified
+
+Point praw at it by passing oauth_url and reddit_url to praw.Reddit.  Served:
+
+    POST /api/v1/access_token             any credentials are accepted
+    GET  /message/unread/                 injected messages that haven't been marked read, newest first
+    POST /api/read_message/               mark messages read
+    POST /api/comment/                    reply to a message, recorded with the time it arrived
+    POST /api/compose/                    send a message, recorded in sent
+    GET  /user/<name>/about/              a year old account with some karma
+    GET  /api/user_data_by_account_ids    the same for up to 100 comma separated t2_ ids of injected authors
+    GET  /r/<sub>/wiki/<page>             read a wiki page
+    GET  /r/<sub>/wiki/revisions/<page>   latest revision first
+    POST /r/<sub>/api/wiki/edit/          edit a wiki page, 409 when previous isn't the latest revision
+    GET  /activate/?raf=<code>            activation page stub for Referral.validate
+
+Every OAuth request sleeps latency plus up to jitter seconds, fails with a 503 with probability error_rate and
+counts against a rate limit window reported in the x-ratelimit headers.  Once the window is used up requests
+get a 429 until it resets.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+class SimulatedWikiPage(object):
+
+    def __init__(self, name: str, content: str = ''):
+        self.name: str = name
+        self.content: str = content
+        self.revisions: List[Tuple[str, float]] = []
+        self.revise()
+
+    @property
+    def revision_id(self) -> str:
+        return self.revisions[-1][0]
+
+    def revise(self):
+        self.revisions.append(('{:08x}-sim'.format(random.getrandbits(32)), time.time()))
+
+
+class RedditSimulator(object):
+    """
+    A fake Reddit on a background HTTP server
+
+    Attributes:
+        _latency (float): seconds added to every OAuth request
+        _jitter (float): up to this many seconds more, picked at random
+        _error_rate (float): share of OAuth requests answered with a 503
+        _ratelimit (int): requests allowed per rate limit window, 0 for no limit
+        _window (float): length of the rate limit window in seconds
+        bot_name (str): the account the bot logs in as, author of its replies
+        inbox (Dict[str, dict]): message id -> message data, in the order injected
+        injected_at (Dict[str, float]): message id -> when it was injected
+        replied_at (Dict[str, float]): message id -> when the first reply to it arrived
+        replies (Dict[str, str]): message id -> body of the first reply
+        sent (List[Tuple[str, str]]): (recipient, subject) of composed messages
+        users (Dict[str, str]): account fullname -> name of every injected author
+        invalid_codes (Set[str]): codes the activation stub rejects
+        calls (Counter): requests served per endpoint
+        errors (Counter): injected errors per status code
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, ratelimit: int = 1000,
+                 window: float = 600, bot_name: str = 'PMReferralBot', port: int = 0):
+        self._latency: float = latency
+        self._jitter: float = jitter
+        self._error_rate: float = error_rate
+        self._ratelimit: int = ratelimit
+        self._window: float = window
+        self._window_start: float = time.time()
+        self._used: int = 0
+        self._ids = itertools.count(1)
+        self._lock: threading.Lock = threading.Lock()
+        self.bot_name: str = bot_name
+        self.inbox: Dict[str, dict] = {}
+        self.injected_at: Dict[str, float] = {}
+        self.replied_at: Dict[str, float] = {}
+        self.replies: Dict[str, str] = {}
+        self.sent: List[Tuple[str, str]] = []
+        self.users: Dict[str, str] = {}
+        self.invalid_codes: Set[str] = set()
+        self.wiki: Dict[Tuple[str, str], SimulatedWikiPage] = {}
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+
+        self._server: ThreadingHTTPServer = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='RedditSimulator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def inject(self, author: str, subject: str, body: str) -> str:
+        """Put a new unread message in the bot's inbox and return its id"""
+        with self._lock:
+            message_id = self._base36(next(self._ids))
+            now = time.time()
+            self.users['t2_' + self._user_id(author)] = author
+            self.inbox[message_id] = {'id': message_id,
+                                      'name': 't4_' + message_id,
+                                      'author': author,
+                                      'author_fullname': 't2_' + self._user_id(author),
+                                      'dest': self.bot_name,
+                                      'subject': subject,
+                                      'body': body,
+                                      'body_html': body,
+                                      'created': now,
+                                      'created_utc': now,
+                                      'new': True,
+                                      'was_comment': False,
+                                      'replies': '',
+                                      'first_message': None,
+                                      'first_message_name': None,
+                                      'parent_id': None,
+                                      'context': '',
+                                      'subreddit': None,
+                                      'distinguished': None}
+            self.injected_at[message_id] = now
+
+        return message_id
+
+    def set_wiki_page(self, subreddit: str, name: str, content: str):
+        with self._lock:
+            self.wiki[(subreddit.lower(), name)] = SimulatedWikiPage(name, content)
+
+    def wiki_page(self, subreddit: str, name: str) -> SimulatedWikiPage:
+        with self._lock:
+            return self._page(subreddit, name)
+
+    def _page(self, subreddit: str, name: str) -> SimulatedWikiPage:
+        key = (subreddit.lower(), name)
+        if key not in self.wiki:
+            self.wiki[key] = SimulatedWikiPage(name)
+        return self.wiki[key]
+
+    def _take_budget(self) -> Tuple[Optional[dict], bool]:
+        """Count a request against the rate limit, returning its headers and whether it is allowed"""
+        if not self._ratelimit:
+            return None, True
+
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self._window:
+                self._window_start = now
+                self._used = 0
+
+            allowed = self._used < self._ratelimit
+            if allowed:
+                self._used += 1
+
+            headers = {'x-ratelimit-used': str(self._used),
+                       'x-ratelimit-remaining': str(max(0, self._ratelimit - self._used)),
+                       'x-ratelimit-reset': str(int(self._window - (now - self._window_start)) + 1)}
+
+        return headers, allowed
+
+    # endpoint implementations, each returning (status, JSON body)
+
+    def _unread(self, params: dict) -> Tuple[int, dict]:
+        limit = int(params.get('limit', 25) or 25)
+        before = params.get('before')
+
+        with self._lock:
+            unread = [data for data in reversed(self.inbox.values()) if data['new']]
+
+        if before:
+            # newer than before: everything ahead of it in newest first order
+            names = [data['name'] for data in unread]
+            unread = unread[:names.index(before)] if before in names else unread
+
+        children = [{'kind': 't4', 'data': dict(data)} for data in unread[:limit]]
+        after = children[-1]['data']['name'] if len(unread) > limit else None
+        return 200, {'kind': 'Listing', 'data': {'children': children, 'after': after, 'before': None}}
+
+    def _read_message(self, form: dict) -> Tuple[int, dict]:
+        with self._lock:
+            for fullname in form.get('id', '').split(','):
+                data = self.inbox.get(fullname.replace('t4_', '', 1))
+                if data is not None:
+                    data['new'] = False
+
+        return 200, {}
+
+    def _comment(self, form: dict) -> Tuple[int, dict]:
+        parent = form.get('thing_id', '').replace('t4_', '', 1)
+        now = time.time()
+
+        with self._lock:
+            original = self.inbox.get(parent)
+            if original is not None and parent not in self.replied_at:
+                self.replied_at[parent] = now
+                self.replies[parent] = form.get('text', '')
+            reply_id = self._base36(next(self._ids))
+
+        reply = {'id': reply_id,
+                 'name': 't4_' + reply_id,
+                 'author': self.bot_name,
+                 'dest': original['author'] if original is not None else '',
+                 'subject': 're: ' + (original['subject'] if original is not None else ''),
+                 'body': form.get('text', ''),
+                 'body_html': form.get('text', ''),
+                 'created': now,
+                 'created_utc': now,
+                 'new': False,
+                 'was_comment': False,
+                 'replies': '',
+                 'first_message': None,
+                 'first_message_name': 't4_' + parent,
+                 'parent_id': 't4_' + parent,
+                 'context': '',
+                 'subreddit': None,
+                 'distinguished': None}
+        return 200, {'json': {'errors': [], 'data': {'things': [{'kind': 't4', 'data': reply}]}}}
+
+    def _compose(self, form: dict) -> Tuple[int, dict]:
+        with self._lock:
+            self.sent.append((form.get('to', ''), form.get('subject', '')))
+
+        return 200, {'json': {'errors': []}}
+
+    def _about(self, name: str) -> Tuple[int, dict]:
+        return 200, {'kind': 't2', 'data': {'name': name,
+                                            'id': self._user_id(name),
+                                            'created': time.time() - 365 * 86400,
+                                            'created_utc': time.time() - 365 * 86400,
+                                            'link_karma': 100,
+                                            'comment_karma': 100}}
+
+    def _user_data(self, params: dict) -> Tuple[int, dict]:
+        fullnames = [fullname for fullname in params.get('ids', '').split(',') if fullname]
+        if len(fullnames) > 100:
+            return 400, {'message': 'Bad Request', 'error': 400}
+
+        with self._lock:
+            names = {fullname: self.users[fullname] for fullname in fullnames if fullname in self.users}
+
+        # unknown ids are left out, as Reddit does for suspended and deleted accounts
+        return 200, {fullname: {'name': name,
+                                'created_utc': time.time() - 365 * 86400,
+                                'link_karma': 100,
+                                'comment_karma': 100,
+                                'profile_img': '',
+                                'profile_color': '',
+                                'profile_over_18': False} for fullname, name in names.items()}
+
+    def _wiki_read(self, subreddit: str, name: str) -> Tuple[int, dict]:
+        with self._lock:
+            page = self._page(subreddit, name)
+            revision_id, revision_date = page.revisions[-1]
+            content = page.content
+
+        return 200, {'kind': 'wikipage', 'data': {'content_md': content,
+                                                  'content_html': content,
+                                                  'may_revise': True,
+                                                  'reason': None,
+                                                  'revision_by': None,
+                                                  'revision_date': revision_date,
+                                                  'revision_id': revision_id}}
+
+    def _wiki_revisions(self, subreddit: str, name: str, params: dict) -> Tuple[int, dict]:
+        limit = int(params.get('limit', 25) or 25)
+
+        with self._lock:
+            revisions = list(reversed(self._page(subreddit, name).revisions))[:limit]
+
+        children = [{'id': revision_id, 'author': None, 'page': name, 'reason': None, 'timestamp': timestamp,
+                     'revision_hidden': False} for revision_id, timestamp in revisions]
+        return 200, {'kind': 'Listing', 'data': {'children': children, 'after': None, 'before': None}}
+
+    def _wiki_edit(self, subreddit: str, form: dict) -> Tuple[int, dict]:
+        with self._lock:
+            page = self._page(subreddit, form.get('page', ''))
+            previous = form.get('previous')
+
+            if previous and previous != page.revision_id:
+                return 409, {'message': 'Conflict', 'reason': 'EDIT_CONFLICT', 'newcontent': page.content,
+                             'newrevision': page.revision_id, 'diffcontent': ''}
+
+            page.content = form.get('content', '')
+            page.revise()
+
+        return 200, {}
+
+    def _make_handler(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            ROUTES = [
+                ('GET', re.compile(r'^/message/unread/?$'), 'unread'),
+                ('POST', re.compile(r'^/api/read_message/?$'), 'read_message'),
+                ('POST', re.compile(r'^/api/comment/?$'), 'comment'),
+                ('POST', re.compile(r'^/api/compose/?$'), 'compose'),
+                ('GET', re.compile(r'^/user/(?P<name>[^/]+)/about/?$'), 'about'),
+                ('GET', re.compile(r'^/api/user_data_by_account_ids/?$'), 'user_data'),
+                ('GET', re.compile(r'^/r/(?P<subreddit>[^/]+)/wiki/revisions/(?P<page>.+?)/?$'), 'wiki_revisions'),
+                ('POST', re.compile(r'^/r/(?P<subreddit>[^/]+)/api/wiki/edit/?$'), 'wiki_edit'),
+                ('GET', re.compile(r'^/r/(?P<subreddit>[^/]+)/wiki/(?P<page>.+?)/?$'), 'wiki_read'),
+            ]
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def log_message(self, format, *args):
+                # keep the load test output readable
+                pass
+
+            def _handle(self, method: str):
+                url = urlsplit(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {key: values[-1] for key, values in
+                        parse_qs(self.rfile.read(length).decode('utf-8') if length else '').items()}
+
+                if url.path.rstrip('/') == '/api/v1/access_token':
+                    simulator.calls['access_token'] += 1
+                    self._send(200, {'access_token': 'simulated', 'token_type': 'bearer', 'expires_in': 86400,
+                                     'scope': '*'})
+                    return
+
+                if url.path.rstrip('/') == '/activate':
+                    simulator.calls['activate'] += 1
+                    code = params.get('raf', '').upper()
+                    marker = 'error_16x16' if code in simulator.invalid_codes else 'ok_16x16'
+                    self._send(200, '<html><body><img src="{}.png"></body></html>'.format(marker), 'text/html')
+                    return
+
+                for route_method, pattern, endpoint in self.ROUTES:
+                    match = pattern.match(url.path)
+                    if route_method == method and match is not None:
+                        break
+                else:
+                    simulator.calls['not_found'] += 1
+                    self._send(404, {'message': 'Not Found', 'error': 404})
+                    return
+
+                simulator.calls[endpoint] += 1
+                delay = simulator._latency + random.uniform(0, simulator._jitter)
+                if delay > 0:
+                    time.sleep(delay)
+
+                headers, allowed = simulator._take_budget()
+                if not allowed:
+                    simulator.errors[429] += 1
+                    self._send(429, {'message': 'Too Many Requests', 'error': 429}, headers=headers)
+                    return
+                if random.random() < simulator._error_rate:
+                    simulator.errors[503] += 1
+                    self._send(503, {'message': 'Service Unavailable', 'error': 503}, headers=headers)
+                    return
+
+                arguments = match.groupdict()
+                if endpoint == 'unread':
+                    status, body = simulator._unread(params)
+                elif endpoint == 'read_message':
+                    status, body = simulator._read_message(form)
+                elif endpoint == 'comment':
+                    status, body = simulator._comment(form)
+                elif endpoint == 'compose':
+                    status, body = simulator._compose(form)
+                elif endpoint == 'about':
+                    status, body = simulator._about(arguments['name'])
+                elif endpoint == 'user_data':
+                    status, body = simulator._user_data(params)
+                elif endpoint == 'wiki_revisions':
+                    status, body = simulator._wiki_revisions(arguments['subreddit'], arguments['page'], params)
+                elif endpoint == 'wiki_edit':
+                    status, body = simulator._wiki_edit(arguments['subreddit'], form)
+                else:
+                    status, body = simulator._wiki_read(arguments['subreddit'], arguments['page'])
+
+                self._send(status, body, headers=headers)
+
+            def _send(self, status: int, body, content_type: str = 'application/json', headers: dict = None):
+                data = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type + '; charset=UTF-8')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    @classmethod
+    def _user_id(cls, name: str) -> str:
+        # a stable made up id so the same user always looks the same
+        return cls._base36(abs(hash(name.lower())) % 10 ** 9)
+
+    @staticmethod
+    def _base36(number: int) -> str:
+        alphabet = '0123456789abcdefghijklmnopqrstuvwxyz'
+        digits = ''
+        while True:
+            number, remainder = divmod(number, 36)
+            digits = alphabet[remainder] + digits
+            if not number:
+                return digits
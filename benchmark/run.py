@@ -0,0 +1,234 @@
+"""
+Microbenchmarks for the list handlers, Referral and Responder against synthetic lists
+
+Runs every case against in-memory fakes of Reddit and the activation site and writes the timings to a JSON
+file.  Pass --compare with an earlier results file to flag regressions.
+
+    python -m benchmark.run --sizes 100,10000,1000000 --output bench.json --compare previous.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from benchmark.fakereddit import FakeMessage, FakeReddit, FakeValidationClient
+from benchmark.synthetic import generate_entries, render, taken_codes, unused_code
+from bulkmessenger import BulkMessenger
+from handler.filehandlers import FileReferralHandler, FileRenewalHandler
+from handler.handlers import AbstractHandler
+from handler.index import ReferralIndexStore
+from handler.sqlitehandlers import SqliteReferralHandler, SqliteRenewalHandler
+from handler.wikihandlers import WikiReferralHandler, WikiRenewalHandler
+from referral import Referral
+from referralbotconfig import ReferralBotConfig
+from renewalprocessor import ReferralProcessor
+from responder import Responder
+from validationclient import ValidationClient
+
+BACKENDS = {
+    'file': (FileReferralHandler, FileRenewalHandler),
+    'wiki': (WikiReferralHandler, WikiRenewalHandler),
+    'sqlite': (SqliteReferralHandler, SqliteRenewalHandler),
+}
+
+
+class Benchmark(object):
+    """
+    One backend and list size, with its own configuration, fake Reddit and working directory
+
+    Attributes:
+        _backend (str): wiki, file or sqlite
+        _entries (List[Tuple[str, str]]): the synthetic list
+        _taken (Set[str]): codes in _entries, so timed code doesn't rebuild the set
+        _config (referralbotconfig.ReferralBotConfig): configuration pointing at the working directory
+        _reddit (FakeReddit): in-memory Reddit
+    """
+
+    def __init__(self, backend: str, size: int, workdir: str, ini: str):
+        self._backend: str = backend
+        self._size: int = size
+        self._entries: List[Tuple[str, str]] = generate_entries(size)
+        self._taken: Set[str] = taken_codes(self._entries)
+        self._config: ReferralBotConfig = self._make_config(os.path.join(workdir, '{}-{}'.format(backend, size)), ini)
+        self._reddit: FakeReddit = FakeReddit()
+        self._bulk_messenger: BulkMessenger = BulkMessenger(self._reddit, self._config)
+        self._serial: int = 0
+
+        # accept every code without going to the activation site
+        ValidationClient._instances[self._config.referral_base_url] = FakeValidationClient()
+
+        referral_class, renewal_class = BACKENDS[backend]
+        self._referrals: AbstractHandler = referral_class(self._config, self._reddit)
+        self._renewals: AbstractHandler = renewal_class(self._config, self._reddit)
+
+    def run(self, iterations: int, bulk_limit: int) -> List[dict]:
+        self._fill()
+        results = []
+        codes = [code for _, code in self._entries]
+
+        def new_referral() -> Referral:
+            self._serial += 1
+            return Referral(self._config, self._reddit.redditor('bench{}'.format(self._serial)),
+                            unused_code(self._taken, self._serial))
+
+        results.append(self._time('get_random', self._referrals.get_random, iterations))
+        results.append(self._time('is_duplicate',
+                                  lambda: self._referrals.is_duplicate(Referral(self._config, 'x',
+                                                                                codes[self._serial % len(codes)])),
+                                  iterations))
+        results.append(self._time('get_usernames', self._referrals.get_usernames, iterations))
+        results.append(self._time('save', lambda: self._referrals.save(new_referral()), iterations))
+
+        for name, subject, body in (('responder_referral', self._config.request_subject, ''),
+                                    ('responder_optin', 'Opt-in', None),
+                                    ('responder_renewal', 'Renewal', None),
+                                    ('responder_reply', 're: ' + self._config.request_subject, ''),
+                                    ('responder_about', 'Hello', '')):
+            results.append(self._time(name, lambda: self._respond(subject, body), iterations))
+
+        if self._size <= bulk_limit:
+            results.append(self._time('process', self._process, max(1, iterations // 10), setup=self._fill))
+            results.append(self._time('responder_replace_month', lambda: self._respond('Replace Month', ''),
+                                      max(1, iterations // 10), setup=self._fill))
+            results.append(self._time('responder_announcement', lambda: self._respond('Announcement', 'Hi'),
+                                      max(1, iterations // 10)))
+
+        return results
+
+    def _fill(self):
+        """Write the synthetic list to the referral list and the renewal list, approved for a month swap"""
+        text = render(self._entries)
+        self._referrals.replace(self._config.update_approved_text + text)
+        self._renewals.replace(text)
+
+    def _process(self):
+        ReferralProcessor(self._config, self._reddit).process()
+
+    def _respond(self, subject: str, body: Optional[str]):
+        if body is None:
+            self._serial += 1
+            body = unused_code(self._taken, self._serial)
+
+        message = FakeMessage(self._reddit, self._config.contact_name, subject, body)
+        Responder(self._reddit, self._config, message, self._bulk_messenger).run()
+
+    def _time(self, case: str, function: Callable, iterations: int, setup: Callable = None) -> dict:
+        samples = []
+        for _ in range(iterations):
+            if setup is not None:
+                setup()
+            started = time.perf_counter()
+            function()
+            samples.append((time.perf_counter() - started) * 1e6)
+
+        samples.sort()
+        return {'case': case,
+                'backend': self._backend,
+                'size': self._size,
+                'iterations': iterations,
+                'mean_us': statistics.mean(samples),
+                'min_us': samples[0],
+                'p50_us': samples[len(samples) // 2],
+                'p95_us': samples[min(len(samples) - 1, int(len(samples) * 0.95))]}
+
+    def _make_config(self, workdir: str, ini: str) -> ReferralBotConfig:
+        os.makedirs(workdir, exist_ok=True)
+
+        parser = ConfigParser(interpolation=None)
+        parser.optionxform = str
+        parser.read(ini)
+        overrides = {
+            ('referralbot', 'referralOutputMethod'): self._backend,
+            ('referralbot', 'contactName'): 'benchmark',
+            ('file', 'referralList'): os.path.join(workdir, 'referralList.txt'),
+            ('file', 'renewalList'): os.path.join(workdir, 'renewalList.txt'),
+            ('sqlite', 'database'): os.path.join(workdir, 'referralbot.db'),
+            ('validation', 'cacheFile'): '',
+            ('validation', 'profileCacheFile'): '',
+            ('rotation', 'stateFile'): '',
+            ('Bulk Messages', 'queueDirectory'): os.path.join(workdir, 'bulkmessages'),
+        }
+        for (section, option), value in overrides.items():
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, option, value)
+
+        path = os.path.join(workdir, 'referralbot.ini')
+        with open(path, 'wt') as file:
+            parser.write(file)
+
+        return ReferralBotConfig(path)
+
+
+def compare(results: List[dict], previous_file: str, threshold: float) -> List[str]:
+    """Return a line for every case that got more than threshold times slower"""
+    with open(previous_file) as file:
+        previous: Dict[tuple, dict] = {(r['case'], r['backend'], r['size']): r for r in json.load(file)['results']}
+
+    regressions = []
+    for result in results:
+        before = previous.get((result['case'], result['backend'], result['size']))
+        if before is not None and result['p50_us'] > before['p50_us'] * threshold:
+            regressions.append("{case} [{backend}, {size}]: p50 {before:.0f}us -> {after:.0f}us".format(
+                case=result['case'], backend=result['backend'], size=result['size'],
+                before=before['p50_us'], after=result['p50_us']))
+
+    return regressions
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the referral bot against synthetic lists')
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help='comma separated list sizes')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated backends')
+    parser.add_argument('--iterations', type=int, default=50, help='timed runs per case')
+    parser.add_argument('--bulk-limit', type=int, default=10000,
+                        help='largest list to run the month swap and announcement cases on')
+    parser.add_argument('--config', default='referralbot.ini', help='configuration to start from')
+    parser.add_argument('--output', default='bench_output.json', help='where to write the results')
+    parser.add_argument('--compare', help='earlier results file to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown factor reported as a regression')
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for backend in args.backends.split(','):
+            for size in (int(size) for size in args.sizes.split(',')):
+                print("Benchmarking {backend} with {size} entries...".format(backend=backend, size=size))
+                results.extend(Benchmark(backend, size, workdir, args.config).run(args.iterations, args.bulk_limit))
+                ReferralIndexStore.clear()
+
+    with open(args.output, 'wt') as file:
+        json.dump({'revision': git_revision(),
+                   'python': platform.python_version(),
+                   'timestamp': time.time(),
+                   'results': results}, file, indent=2)
+
+    for result in results:
+        print("{case:26} {backend:6} {size:>8} p50 {p50_us:>12.1f}us  p95 {p95_us:>12.1f}us".format(**result))
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import random
+import string
+from typing import List, Set, Tuple
+
+
+def generate_entries(size: int, seed: int = 0) -> List[Tuple[str, str]]:
+    """Return size unique (username, code) pairs matching the default codeRegex"""
+    rng = random.Random(seed)
+    alphabet = string.ascii_uppercase + string.digits
+    codes = set()
+
+    while len(codes) < size:
+        codes.add(''.join(rng.choice(alphabet) for _ in range(6)))
+
+    return [('user{}'.format(number), code) for number, code in enumerate(sorted(codes))]
+
+
+def render(entries: List[Tuple[str, str]], header: str = '') -> str:
+    """Render entries the way the bot writes them: each entry after a blank line"""
+    return header + ''.join("\n\n{user}:{code}".format(user=user, code=code) for user, code in entries)
+
+
+def taken_codes(entries: List[Tuple[str, str]]) -> Set[str]:
+    """Return the codes in entries, built once and passed to unused_code"""
+    return {code for _, code in entries}
+
+
+def unused_code(taken: Set[str], number: int) -> str:
+    """Return a valid code that isn't taken, different for each number"""
+    alphabet = string.ascii_uppercase + string.digits
+
+    while True:
+        digits = []
+        value = number
+        for _ in range(6):
+            value, remainder = divmod(value, len(alphabet))
+            digits.append(alphabet[remainder])
+        code = ''.join(digits)
+        if code not in taken:
+            return code
+        number += 1_000_003
@@ -0,0 +1,245 @@
+import atexit
+import contextlib
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from referralbotconfig import ReferralBotConfig
+
+# the level is a field of its own in JSON records
+LEVEL_PREFIX = re.compile(r'^\[(Debug|Info|Warning|FATAL)\] ?')
+
+
+class LogContext(object):
+    """
+    Fields added to every record logged by the current thread, eg. the message id and user being handled
+    """
+
+    _local: threading.local = threading.local()
+
+    @classmethod
+    @contextlib.contextmanager
+    def bind(cls, **fields) -> Iterator[None]:
+        """Add fields to the records logged inside the block"""
+        previous = cls.fields()
+        cls._local.fields = dict(previous, **fields)
+        try:
+            yield
+        finally:
+            cls._local.fields = previous
+
+    @classmethod
+    def fields(cls) -> Dict[str, object]:
+        return getattr(cls._local, 'fields', {})
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the LogContext onto records
+
+    Runs on the QueueHandler, in the thread that logged the record, before the record changes threads.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, value in LogContext.fields().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line with the time, level, message and any context fields
+    """
+
+    FIELDS = ('message_id', 'user', 'command', 'duration')
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) +
+                '.{:03d}Z'.format(int(record.msecs)),
+                'level': record.levelname,
+                'logger': record.name,
+                'thread': record.threadName,
+                'message': LEVEL_PREFIX.sub('', record.getMessage())}
+
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value if isinstance(value, (int, float, bool)) else str(value)
+
+        if record.exc_text:
+            data['exception'] = record.exc_text
+
+        return json.dumps(data, ensure_ascii=False)
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that keeps the record's fields, leaving the formatting to the handlers behind the queue
+    """
+
+    _formatter: logging.Formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the arguments and traceback may change once the calling thread moves on, so render them now
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RotatingLogFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    Log file rotated when it reaches max_bytes and every time interval, whichever comes first
+
+    Rotated files are named <file>.<time>[.<n>] and gzip compressed when compress is set.  Only the newest
+    backup_count rotated files are kept.
+    """
+
+    def __init__(self, filename: str, when: str, max_bytes: int, backup_count: int, compress: bool):
+        super().__init__(filename, when=when, backupCount=backup_count, encoding='utf-8', delay=True)
+        self._max_bytes: int = max_bytes
+        self._compress: bool = compress
+        self.namer = self._name_rotated
+        if compress:
+            self.rotator = self._rotate_compressed
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self._max_bytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.stream.tell() + len(self.format(record)) + 1 >= self._max_bytes:
+                return True
+
+        return bool(super().shouldRollover(record))
+
+    def getFilesToDelete(self) -> List[str]:
+        if self.backupCount <= 0:
+            return []
+
+        directory, base = os.path.split(self.baseFilename)
+        rotated = [os.path.join(directory, name) for name in os.listdir(directory or '.')
+                   if name.startswith(base + '.')]
+        rotated.sort(key=os.path.getmtime)
+        return rotated[:-self.backupCount]
+
+    def _name_rotated(self, default_name: str) -> str:
+        # a size rollover can happen twice within the same time suffix, number them so none is overwritten
+        suffix = '.gz' if self._compress else ''
+        name, number = default_name, 0
+        while os.path.exists(name + suffix):
+            number += 1
+            name = '{}.{}'.format(default_name, number)
+        return name + suffix
+
+    @staticmethod
+    def _rotate_compressed(source: str, destination: str):
+        with open(source, 'rb') as plain, gzip.open(destination, 'wb') as compressed:
+            shutil.copyfileobj(plain, compressed)
+        os.remove(source)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+# forward the records of worker processes to the same handlers
+_process_listeners: List[logging.handlers.QueueListener] = []
+_listener_lock: threading.Lock = threading.Lock()
+
+
+def configure(config: ReferralBotConfig):
+    """Send all logging through a queue to a background thread writing the log file and the console
+
+    Logging calls only put the record on the queue, so file writes, rotation and compression never hold up
+    message handling.  Calling it again replaces the previous configuration.
+    """
+    global _listener
+
+    handlers: List[logging.Handler] = []
+
+    file_handler = RotatingLogFileHandler(config.log_file, config.log_rotate_when, config.log_max_bytes,
+                                          config.log_backup_count, config.log_compress)
+    if config.log_format == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    handlers.append(file_handler)
+
+    if config.log_console:
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter('%(message)s'))
+        handlers.append(console)
+
+    records: queue.Queue = queue.Queue(-1)
+    queue_handler = BackgroundQueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+        root.addHandler(queue_handler)
+        root.setLevel(config.log_level)
+
+        _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        _listener.start()
+
+
+def listen(records: queue.Queue):
+    """Write the records other processes put on records, eg. a multiprocessing queue, like this process's own"""
+    with _listener_lock:
+        if _listener is None:
+            return
+
+        listener = logging.handlers.QueueListener(records, *_listener.handlers, respect_handler_level=True)
+        listener.start()
+        _process_listeners.append(listener)
+
+
+def configure_worker(records: queue.Queue, level: str):
+    """Send all logging of this worker process to the process that called listen(records)"""
+    queue_handler = BackgroundQueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+
+def shutdown():
+    """Write out the queued records and stop the background writer"""
+    global _listener
+
+    with _listener_lock:
+        # the workers' records first, they share the handlers closed below
+        while _process_listeners:
+            _process_listeners.pop().stop()
+
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,347 @@
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+import praw
+from praw.exceptions import APIException, ClientException, PRAWException
+from prawcore import Forbidden, NotFound
+
+import metrics
+from redditpool import RedditPool
+from referralbotconfig import ReferralBotConfig
+
+
+class BulkMessageJob(object):
+    """
+    A message to be sent to many users, checkpointed to disk
+
+    The job definition is written once to <queue directory>/<id>.json.  Progress is appended to
+    <id>.progress one line per recipient, so a crashed run can be resumed without messaging anyone twice.
+
+    Attributes:
+        _id (str): job id
+        _subject (str): subject of the message
+        _body (str): body of the message
+        _recipients (List[str]): usernames to message, without duplicates
+        _notify (str): username to send the summary report to, if any
+        _sent (List[str]): recipients successfully messaged
+        _failed (Dict[str, str]): recipients that could not be messaged and why
+        _skipped (int): recipients already handled by an earlier run of this job
+    """
+
+    def __init__(self, subject: str, body: str, recipients: List[str], notify: Optional[str] = None,
+                 job_id: Optional[str] = None):
+        self._id: str = job_id or uuid.uuid4().hex
+        self._subject: str = subject
+        self._body: str = body
+        # keep the list order but only message each user once
+        self._recipients: List[str] = list(dict.fromkeys(recipients))
+        self._notify: Optional[str] = notify
+        self._sent: List[str] = []
+        self._failed: Dict[str, str] = {}
+        self._skipped: int = 0
+        self._directory: Optional[str] = None
+        self._progress_lock: threading.Lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory: str, job_id: str) -> 'BulkMessageJob':
+        with open(os.path.join(directory, job_id + '.json')) as file:
+            data = json.load(file)
+
+        job = cls(data['subject'], data['body'], data['recipients'], data.get('notify'), job_id)
+        job._directory = directory
+
+        if os.path.exists(job._progress_path):
+            with open(job._progress_path) as file:
+                for line in file:
+                    items = line.rstrip('\n').split('\t')
+                    if items[0] == 'sent':
+                        job._sent.append(items[1])
+                    elif items[0] == 'failed':
+                        job._failed[items[1]] = items[2] if len(items) > 2 else ''
+
+        job._skipped = len(job._sent) + len(job._failed)
+
+        return job
+
+    def save(self, directory: str):
+        """Write the job definition to directory, atomically"""
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+
+        path = os.path.join(directory, self._id + '.json')
+        with open(path + '.tmp', 'wt') as file:
+            json.dump({'subject': self._subject,
+                       'body': self._body,
+                       'recipients': self._recipients,
+                       'notify': self._notify}, file)
+        os.replace(path + '.tmp', path)
+
+    def remove(self):
+        for path in (os.path.join(self._directory, self._id + '.json'), self._progress_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def record_sent(self, user: str):
+        self._record('sent', user)
+        self._sent.append(user)
+
+    def record_failed(self, user: str, reason: str):
+        self._record('failed', user, reason)
+        self._failed[user] = reason
+
+    def _record(self, *fields: str):
+        if self._directory is None:
+            return
+
+        line = '\t'.join(field.replace('\t', ' ').replace('\n', ' ') for field in fields)
+        with self._progress_lock, open(self._progress_path, 'at') as file:
+            file.write(line + '\n')
+
+    @property
+    def _progress_path(self) -> str:
+        return os.path.join(self._directory, self._id + '.progress')
+
+    @property
+    def body(self) -> str:
+        return self._body
+
+    @property
+    def failed(self) -> Dict[str, str]:
+        return self._failed
+
+    @property
+    def id(self) -> str:
+        return self._id
+
+    @property
+    def notify(self) -> Optional[str]:
+        return self._notify
+
+    @property
+    def pending(self) -> List[str]:
+        done = set(self._sent) | set(self._failed)
+        return [user for user in self._recipients if user not in done]
+
+    @property
+    def recipients(self) -> List[str]:
+        return self._recipients
+
+    @property
+    def sent(self) -> List[str]:
+        return self._sent
+
+    @property
+    def skipped(self) -> int:
+        return self._skipped
+
+    @property
+    def subject(self) -> str:
+        return self._subject
+
+
+class BulkMessenger(object):
+    """
+    Sends BulkMessageJobs in the background with bounded concurrency.
+
+    Jobs run one at a time on a background thread so the inbox loop is never blocked.  Each sending thread
+    borrows its own Reddit instance from the RedditPool.  Before each message that instance's rate limit
+    headers are checked and sending pauses until the window resets when the remaining budget is low.  Reddit's
+    RATELIMIT errors are retried after the wait it asks for, without counting towards MAX_ATTEMPTS.
+
+    Jobs checkpointed by other processes, eg. the QueueDispatcher's workers, are picked up by collect.
+
+    Attributes:
+        _reddit (praw.Reddit): Reddit instance
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _jobs (queue.Queue): jobs waiting to be sent
+        _known (Set[str]): ids of the jobs queued so far
+        _paused_until (float): reset time of the last rate limit window sending paused for
+    """
+
+    # Reddit error types that will not go away by retrying
+    PERMANENT_ERRORS = ('USER_DOESNT_EXIST', 'NOT_WHITELISTED_BY_USER_MESSAGE', 'INVALID_USER')
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig):
+        self._reddit: praw.Reddit = reddit
+        self._config: ReferralBotConfig = config
+        self._jobs: queue.Queue = queue.Queue()
+        self._known: Set[str] = set()
+        self._budget_lock: threading.Lock = threading.Lock()
+        self._paused_until: float = 0.0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the background sender and queue any jobs left over from a previous run"""
+        for job in self.collect():
+            logging.info("[Info] Resuming bulk message job {id}: {count} message(s) left".format(
+                id=job.id, count=len(job.pending)))
+
+        self._thread = threading.Thread(target=self._work, name='BulkMessenger', daemon=True)
+        self._thread.start()
+
+    def collect(self) -> List[BulkMessageJob]:
+        """Queue the jobs checkpointed to the queue directory that aren't queued yet, returning them"""
+        directory = self._config.bulk_queue_directory
+        if not os.path.isdir(directory):
+            return []
+
+        # only jobs this messenger queued are ever removed, so the others stay put while they're loaded
+        new = [filename for filename in os.listdir(directory)
+               if filename.endswith('.json') and filename[:-len('.json')] not in self._known]
+
+        collected: List[BulkMessageJob] = []
+        for filename in sorted(new, key=lambda f: os.path.getmtime(os.path.join(directory, f))):
+            job = BulkMessageJob.load(directory, filename[:-len('.json')])
+            self._known.add(job.id)
+            self._jobs.put(job)
+            collected.append(job)
+
+        return collected
+
+    def submit(self, job: BulkMessageJob):
+        """Checkpoint job to disk and queue it for sending"""
+        job.save(self._config.bulk_queue_directory)
+        logging.info("[Info] Queued bulk message job {id} for {count} user(s)".format(
+            id=job.id, count=len(job.recipients)))
+
+        if self._thread is None:
+            # no background sender, eg. a one-off run from a script
+            self._run_with_recovery(job)
+        else:
+            self._known.add(job.id)
+            self._jobs.put(job)
+
+    def run(self, job: BulkMessageJob):
+        """Send job in the calling thread and report the result"""
+        started = time.time()
+
+        with ThreadPoolExecutor(max_workers=self._config.bulk_workers) as executor:
+            # list() re-raises anything unexpected from the workers
+            list(executor.map(lambda user: self._send(job, user), job.pending))
+
+        self._report(job, time.time() - started)
+        job.remove()
+
+    def _work(self):
+        while True:
+            job: BulkMessageJob = self._jobs.get()
+            try:
+                self._run_with_recovery(job)
+            finally:
+                self._jobs.task_done()
+
+    def _run_with_recovery(self, job: BulkMessageJob):
+        try:
+            self.run(job)
+        except Exception as e:
+            # the checkpoint is still on disk and the job resumes on the next start
+            logging.warning("[Warning] Bulk message job {id} stopped: {error}".format(id=job.id, error=e))
+
+    def _send(self, job: BulkMessageJob, user: str):
+        with RedditPool.for_reddit(self._reddit).borrow() as reddit:
+            self._send_with(reddit, job, user)
+
+    def _send_with(self, reddit: praw.Reddit, job: BulkMessageJob, user: str):
+        attempt = 0
+        while attempt < self.MAX_ATTEMPTS:
+            self._wait_for_budget(reddit)
+            try:
+                with metrics.stage('bulk_send', command='bulk_message'):
+                    reddit.redditor(user).message(job.subject, job.body)
+            except APIException as e:
+                error_type, message = self._describe(e)
+                if error_type == 'RATELIMIT':
+                    delay = self._parse_ratelimit_delay(message)
+                    logging.info("[Info] Rate limited messaging {user}, retrying in {delay}s".format(
+                        user=user, delay=delay))
+                    time.sleep(delay)
+                    # waiting as asked isn't a failed attempt
+                    continue
+                if error_type in self.PERMANENT_ERRORS:
+                    job.record_failed(user, error_type)
+                    return
+                reason = "{type}: {message}".format(type=error_type, message=message)
+            except (NotFound, Forbidden) as e:
+                job.record_failed(user, e.__class__.__name__)
+                return
+            except Exception as e:
+                # one bad recipient must not stop the rest of the run
+                reason = "{type}: {error}".format(type=e.__class__.__name__, error=e)
+            else:
+                job.record_sent(user)
+                return
+
+            attempt += 1
+            logging.warning("[Warning] Error messaging {user} (attempt {attempt}): {reason}".format(
+                user=user, attempt=attempt, reason=reason))
+
+        job.record_failed(user, 'gave up after {count} attempts'.format(count=self.MAX_ATTEMPTS))
+
+    def _wait_for_budget(self, reddit: praw.Reddit):
+        """Sleep until the rate limit window resets if too few requests remain in it"""
+        limits = getattr(getattr(reddit, 'auth', None), 'limits', None) or {}
+        remaining = limits.get('remaining')
+        reset = limits.get('reset_timestamp')
+        if remaining is None or reset is None or remaining >= self._config.bulk_min_remaining:
+            return
+
+        # the other sending threads find the same window low, log the pause once
+        with self._budget_lock:
+            if reset > self._paused_until:
+                self._paused_until = reset
+                logging.info("[Info] {remaining} requests left in rate limit window, pausing {delay:.0f}s".format(
+                    remaining=remaining, delay=max(0.0, reset - time.time())))
+
+        # outside the lock, so the threads wait out the window together rather than one after another
+        time.sleep(max(0.0, reset - time.time()))
+
+    def _report(self, job: BulkMessageJob, duration: float):
+        failures = '\n'.join("* /u/{user}: {reason}".format(user=user, reason=reason)
+                             for user, reason in job.failed.items())
+        report = self._config.bulk_report_message.format(subject=job.subject,
+                                                         total=len(job.recipients),
+                                                         sent=len(job.sent),
+                                                         failed=len(job.failed),
+                                                         skipped=job.skipped,
+                                                         duration=int(duration),
+                                                         failures=failures or 'None')
+
+        logging.info("[Info] Bulk message job {id} finished: {sent} sent, {failed} failed, "
+                     "{skipped} already handled in {duration:.0f}s".format(id=job.id,
+                                                                            sent=len(job.sent),
+                                                                            failed=len(job.failed),
+                                                                            skipped=job.skipped,
+                                                                            duration=duration))
+
+        if job.notify:
+            try:
+                with RedditPool.for_reddit(self._reddit).borrow() as reddit:
+                    reddit.redditor(job.notify).message(self._config.bulk_report_subject, report)
+            except (APIException, PRAWException, ClientException) as e:
+                logging.warning("[Warning] Could not send bulk message report to {user}: {error}".format(
+                    user=job.notify, error=e))
+
+    @staticmethod
+    def _describe(e: APIException):
+        # praw 7 wraps several errors in RedditAPIException.items
+        item = e.items[0] if getattr(e, 'items', None) else e
+        return item.error_type, item.message or ''
+
+    @staticmethod
+    def _parse_ratelimit_delay(message: str) -> int:
+        """Parse Reddit's "try again in 5 minutes" into seconds"""
+        match = re.search(r'(\d+) (second|minute)', message)
+        if match is None:
+            return 60
+
+        delay = int(match.group(1))
+        return delay * 60 if match.group(2) == 'minute' else delay
@@ -0,0 +1,156 @@
+import logging
+import re
+import threading
+import time
+import weakref
+from typing import Dict, List, Pattern
+
+from referralbotconfig import ReferralBotConfig
+
+
+class Command(object):
+    """
+    A message subject the bot responds to
+
+    Attributes:
+        _name (str): command name, used for timings and logs
+        _matcher (Pattern): compiled subject matcher
+        _handler (str): name of the Responder method that builds the reply
+        _requires_age (bool): the author must pass the account age check
+        _requires_karma (bool): the author must pass the karma check
+    """
+
+    def __init__(self, name: str, matcher: Pattern, handler: str, requires_age: bool = True,
+                 requires_karma: bool = False):
+        self._name: str = name
+        self._matcher: Pattern = matcher
+        self._handler: str = handler
+        self._requires_age: bool = requires_age
+        self._requires_karma: bool = requires_karma
+
+    def matches(self, subject: str) -> bool:
+        return self._matcher.search(subject) is not None
+
+    @property
+    def handler(self) -> str:
+        return self._handler
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def requires_age(self) -> bool:
+        return self._requires_age
+
+    @property
+    def requires_karma(self) -> bool:
+        return self._requires_karma
+
+
+class CommandTiming(object):
+    """
+    Running totals of how long a Command takes to handle
+    """
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class CommandRouter(object):
+    """
+    Picks the Command for a message subject
+
+    Subject matchers are compiled once per configuration.  Commands are tried in registration order and the
+    fallback command is used when none match.  Only commands that need them load the author's age and karma,
+    so replies and unknown subjects never fetch the Redditor.
+
+    Attributes:
+        _commands (List[Command]): registered commands, in priority order
+        _fallback (Command): command for unrecognised subjects
+        _timings (Dict[str, CommandTiming]): timings by command name
+    """
+
+    _instances: 'weakref.WeakKeyDictionary[ReferralBotConfig, CommandRouter]' = weakref.WeakKeyDictionary()
+    _instances_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, config: ReferralBotConfig):
+        self._commands: List[Command] = []
+        self._timings: Dict[str, CommandTiming] = {}
+        self._timings_lock: threading.Lock = threading.Lock()
+
+        # they are responding to our message
+        self.register(Command('reply', re.compile(r'^re: '), '_build_message_reply', requires_age=False))
+        self.register(Command('referral', self._contains(config.request_subject), '_build_message_get_referral'))
+        self.register(Command('optin', self._contains('Opt-in'), '_build_message_optin', requires_karma=True))
+        self.register(Command('renewal', self._contains('Renewal'), '_build_message_renewal', requires_karma=True))
+        self.register(Command('replace_month', self._contains('Replace Month'), '_build_message_process_renewals'))
+        self.register(Command('announcement', self._contains('Announcement'), '_build_message_announcement'))
+        self._fallback: Command = Command('about', re.compile(''), '_build_message_about', requires_age=False)
+
+    @classmethod
+    def for_config(cls, config: ReferralBotConfig) -> 'CommandRouter':
+        """Return the router compiled from config, building it on first use"""
+        with cls._instances_lock:
+            router = cls._instances.get(config)
+            if router is None:
+                router = cls(config)
+                cls._instances[config] = router
+
+        return router
+
+    def register(self, command: Command):
+        self._commands.append(command)
+        self._timings[command.name] = CommandTiming()
+
+    def route(self, subject: str) -> Command:
+        for command in self._commands:
+            if command.matches(subject):
+                return command
+
+        return self._fallback
+
+    def record(self, command: Command, seconds: float):
+        with self._timings_lock:
+            self._timings.setdefault(command.name, CommandTiming()).add(seconds)
+
+        logging.info("[Info] Handled {command} in {seconds:.3f}s".format(command=command.name, seconds=seconds),
+                     extra={'duration': round(seconds, 6)})
+
+    @property
+    def timings(self) -> Dict[str, CommandTiming]:
+        return self._timings
+
+    @staticmethod
+    def _contains(text: str) -> Pattern:
+        return re.compile(re.escape(text), re.IGNORECASE)
+
+
+class Stopwatch(object):
+    """
+    Context manager recording the time spent handling a Command
+    """
+
+    def __init__(self, router: CommandRouter, command: Command):
+        self._router: CommandRouter = router
+        self._command: Command = command
+        self._started: float = 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._router.record(self._command, time.perf_counter() - self._started)
+        return False
@@ -0,0 +1,88 @@
+import configparser
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+
+from exception.exceptions import InvalidConfigException
+from referralbotconfig import ReferralBotConfig
+
+# settings read once by the long lived parts of the bot (storage, caches, pools, logging, ...), changing them
+# needs a restart
+RESTART_ONLY_PREFIXES = ('bulk_', 'journal_', 'log_', 'metrics_', 'profile_', 'profiling_', 'revalidation_',
+                         'rotation_', 'snapshot_', 'sqlite_', 'validation_', 'wiki_')
+RESTART_ONLY = ('html_match_success', 'html_success_pattern', 'poll_mode', 'praw_site', 'processes',
+                'quarantine_list_name', 'referral_base_url', 'referral_list_name', 'referral_source_type',
+                'renewal_list_name', 'work_queue_file', 'workers')
+
+
+class ConfigManager(object):
+    """
+    Holds the current ReferralBotConfig and reloads it when the ini file changes
+
+    reload_if_changed() is called between inbox sweeps.  When the file's modification time or size changed, it
+    is loaded into a new ReferralBotConfig, which replaces the current one only if it loads cleanly and leaves
+    the restart only settings alone.  Otherwise the current config stays in use and a warning says why.  The
+    swap is a single assignment, so a sweep sees either the old config or the new one, never a mix.
+
+    Message texts, subjects, requirements, links and polling intervals can be changed this way.
+
+    Attributes:
+        _filename (str): the ini file
+        _config (referralbotconfig.ReferralBotConfig): the config in use
+        _stamp (Tuple[int, int]): modification time and size of the file when it was last read
+    """
+
+    def __init__(self, filename: str):
+        self._filename: str = filename
+        self._stamp: Optional[Tuple[int, int]] = self._file_stamp()
+        self._config: ReferralBotConfig = ReferralBotConfig(filename)
+
+    @property
+    def config(self) -> ReferralBotConfig:
+        return self._config
+
+    @property
+    def filename(self) -> str:
+        return self._filename
+
+    def reload_if_changed(self) -> bool:
+        """Reload the config if the file changed, returning whether a new config is in use"""
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+
+        # remembered even when the reload fails, so a bad file is reported once rather than every sweep
+        self._stamp = stamp
+
+        try:
+            config = ReferralBotConfig(self._filename)
+        except (configparser.Error, ValueError, re.error, InvalidConfigException) as e:
+            logging.warning("[Warning] Not reloading {file}, keeping the current configuration: {error}".format(
+                file=self._filename, error=e))
+            return False
+
+        changed = self._restart_only_changes(config)
+        if changed:
+            logging.warning("[Warning] Not reloading {file}, {settings} only change on restart".format(
+                file=self._filename, settings=', '.join(changed)))
+            return False
+
+        self._config = config
+        logging.info("[Info] Reloaded configuration from {file}".format(file=self._filename))
+        return True
+
+    def _restart_only_changes(self, config: ReferralBotConfig) -> List[str]:
+        names = [name for name, value in vars(ReferralBotConfig).items() if isinstance(value, property) and
+                 (name in RESTART_ONLY or name.startswith(RESTART_ONLY_PREFIXES))]
+
+        return sorted(name for name in names if getattr(config, name) != getattr(self._config, name))
+
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._filename)
+        except OSError:
+            # mid save by an editor that replaces the file, look again next sweep
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
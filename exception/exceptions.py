@@ -16,3 +16,11 @@ class NoReferralsFoundException(Exception):
 
 class ReferralBotFatalException(Exception):
     pass
+
+
+class ValidationUnavailableException(Exception):
+    pass
+
+
+class InvalidConfigException(Exception):
+    pass
@@ -1,40 +1,215 @@
+import contextlib
+import mmap
+import os
 from abc import ABC
+from typing import Callable, Hashable, Iterator, List, Optional, Set, Tuple
 
 from exception.exceptions import DuplicateCodeException
 from handler.handlers import AbstractHandler
+from handler.index import ReferralIndex, ReferralIndexStore
 from referral import Referral
 
+try:
+    import fcntl
+except ImportError:
+    # not on Windows, where only the threads of one process are kept apart
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(source: str) -> Iterator[None]:
+    """Hold an exclusive lock on source across processes, through the lock file next to it"""
+    if fcntl is None:
+        yield
+        return
+
+    # the list itself is replaced by renaming, so a lock on it would be left behind on the old inode
+    with open(source + '.lock', 'a') as file:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class FileReferralIndex(ReferralIndex):
+    """
+    ReferralIndex for a file that only grows between replaces
+
+    Remembers how far into the file it has parsed so appended lines can be parsed on their own.  The last
+    line of the file has no newline until the next entry is appended, so it is parsed again every time.
+
+    Attributes:
+        _identity (Tuple[int, int]): device and inode of the file, a new inode means the file was replaced
+        _tail_start (int): byte offset of the last, unterminated, line
+        _tail_is_entry (bool): the last line was added to the index as an entry
+        _guard (bytes): bytes just before _tail_start, used to spot a file rewritten in place
+    """
+
+    GUARD_SIZE = 64
+
+    def __init__(self, identity: Tuple[int, int]):
+        super().__init__('')
+        self._identity: Tuple[int, int] = identity
+        self._tail_start: int = 0
+        self._tail_is_entry: bool = False
+        self._guard: bytes = b''
+
+    def is_append_of(self, identity: Tuple[int, int], size: int, data: mmap.mmap) -> bool:
+        """Check whether the file is this one with lines appended, rather than truncated or replaced"""
+        if identity != self._identity or size < self._tail_start:
+            return False
+
+        return data[max(0, self._tail_start - self.GUARD_SIZE):self._tail_start] == self._guard
+
+    def parse(self, data: mmap.mmap, size: int):
+        """Parse lines from the start of the last line to size"""
+        # readers wait rather than see the list without its last entry
+        with self._lock:
+            if self._tail_is_entry:
+                self.pop()
+                self._tail_is_entry = False
+
+            data.seek(self._tail_start)
+            while data.tell() < size:
+                start = data.tell()
+                line = data.readline()
+                is_entry = self.add_line(line.decode('utf-8', errors='replace'))
+
+                if not line.endswith(b'\n'):
+                    # unterminated: parse it again once more text is appended
+                    self._tail_start = start
+                    self._tail_is_entry = is_entry
+                    break
+            else:
+                self._tail_start = size
+
+            self._guard = data[max(0, self._tail_start - self.GUARD_SIZE):self._tail_start]
+
 
 class AbstractFileHandler(AbstractHandler, ABC):
     """
     Abstract File Handler
 
-    Abstract class for File handlers to inherit common functionality
+    Abstract class for File handlers to inherit common functionality.  Files are read through mmap and only
+    the lines appended since the last read are parsed.  Truncating or replacing the file parses it again.
+
+    Writes hold file_lock as well as the thread lock, so several bot processes can share the lists.  Replacing
+    a list writes a temporary file and renames it over the list, so readers see the old or the new list whole.
     """
+    def _get_index_key(self, source: str) -> Hashable:
+        return 'file', os.path.abspath(source)
+
+    def _get_index(self, source: str) -> ReferralIndex:
+        key = self._get_index_key(source)
+        stat = os.stat(source)
+        revision = self._revision_of(stat)
+
+        index: FileReferralIndex = ReferralIndexStore.peek(key)
+        if index is not None and index.revision == revision:
+            return index
+
+        identity = (stat.st_dev, stat.st_ino)
+        # the index is updated in place, so only one thread may parse at a time
+        with ReferralIndexStore.lock(key), open(source, 'rb') as file:
+            index = ReferralIndexStore.peek(key)
+            if index is not None and index.revision == revision:
+                # another thread parsed it while this one waited
+                return index
+
+            if stat.st_size == 0:
+                # mmap refuses empty files
+                return self._store(key, FileReferralIndex(identity), revision)
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                size = min(stat.st_size, len(data))
+
+                if index is None or not index.is_append_of(identity, size, data):
+                    index = FileReferralIndex(identity)
+
+                index.parse(data, size)
+
+        return self._store(key, index, revision)
+
     def _get_raw_text(self, source: str) -> str:
         with open(source) as file:
             content: str = file.read()
 
         return content
 
-    def _save(self, referral: Referral, source: str) -> bool:
-        referral.check_format()
-        referral.validate()
+    def _get_revision(self, source: str) -> Tuple[int, int, int, int]:
+        return self._revision_of(os.stat(source))
 
-        if self._is_duplicate(referral, source):
-            raise DuplicateCodeException()
+    def _save(self, referral: Referral, source: str) -> bool:
+        # another process may have added the code since this one last read the list
+        with file_lock(source):
+            if self._is_duplicate(referral, source):
+                raise DuplicateCodeException()
 
-        with open(source, 'at') as file:
-            # add the entry with two leading newlines for readability
-            file.write("\n\n{new_user}:{code}".format(new_user=referral.get_user,
-                                                      code=referral.get_code))
+            with open(source, 'at') as file:
+                # add the entry with two leading newlines for readability
+                file.write("\n\n{new_user}:{code}".format(new_user=referral.get_user,
+                                                          code=referral.get_code))
 
         return True
 
     def _replace(self, raw_text: str, source: str):
-        # w = overwrite the file
-        with open(source, 'wt') as file:
+        with file_lock(source):
+            self._write_replacement(raw_text, source)
+
+    def _remove(self, codes: Set[str], source: str) -> List[Tuple[str, str]]:
+        # read under the lock, so an entry appended by another process meanwhile isn't lost
+        with file_lock(source):
+            raw_text, removed = self._without(self._get_raw_text(source), codes)
+            if removed:
+                self._write_replacement(raw_text, source)
+
+        return removed
+
+    def replace_with(self, other: AbstractHandler, merge: Optional[Callable[[str], str]] = None):
+        """Move the other list, through merge if given, into this one with no other process writing to either"""
+        if not isinstance(other, AbstractFileHandler):
+            super().replace_with(other, merge)
+            return
+
+        source = self._get_list_name()
+        other_source = other._get_list_name()
+        # both locks are always taken in the same order, so two processes can't each hold one
+        first, second = sorted((os.path.abspath(source), os.path.abspath(other_source)))
+
+        with self._stage('write'), self.lock(), other.lock(), file_lock(first), file_lock(second):
+            raw_text = self._get_raw_text(other_source)
+            self._write_replacement(merge(raw_text) if merge is not None else raw_text, source)
+            self._write_replacement('', other_source)
+
+    def get_raw_text(self) -> str:
+        # the file index doesn't keep a copy of the text
+        with self._stage('read'):
+            return self._get_raw_text(self._get_list_name())
+
+    def _write_replacement(self, raw_text: str, source: str):
+        """Replace the file's contents.  Called with file_lock held"""
+        # write then rename, truncating in place would let other processes read a partial list.  The new inode
+        # makes every process parse the file again
+        temporary = '{source}.{pid}.tmp'.format(source=source, pid=os.getpid())
+        with open(temporary, 'wt') as file:
             file.write(raw_text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, source)
+
+        ReferralIndexStore.invalidate(self._get_index_key(source))
+
+    @staticmethod
+    def _revision_of(stat: os.stat_result) -> Tuple[int, int, int, int]:
+        # any write changes the modification time or the size
+        return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _store(key: Hashable, index: FileReferralIndex, revision: Hashable) -> FileReferralIndex:
+        index.revision = revision
+        ReferralIndexStore.put(key, index)
+        return index
 
 
 class FileReferralHandler(AbstractFileHandler):
@@ -53,3 +228,17 @@ class FileRenewalHandler(AbstractFileHandler):
 
     def _get_list_name(self) -> str:
         return self._config.renewal_list_name
+
+
+class FileQuarantineHandler(AbstractFileHandler):
+    """
+    File handler for codes taken off the referral list because they stopped working
+    """
+
+    def _get_list_name(self) -> str:
+        return self._config.quarantine_list_name
+
+    def _save(self, referral: Referral, source: str) -> bool:
+        # created with the first quarantined code
+        open(source, 'a').close()
+        return super()._save(referral, source)
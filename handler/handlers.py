@@ -1,9 +1,11 @@
 from abc import ABC, abstractmethod
-import random
-from typing import List
-import re
+from threading import RLock
+from typing import Callable, Hashable, Iterable, List, Optional, Set, Tuple
 
-from exception.exceptions import NoReferralsFoundException
+import metrics
+from exception.exceptions import DuplicateCodeException
+from handler.index import ReferralIndex, ReferralIndexStore
+from handler.rotation import RotationScheduler
 from referralbotconfig import ReferralBotConfig
 from referral import Referral
 import praw
@@ -19,10 +21,18 @@ class AbstractHandler(ABC):
     def _get_list_name(self) -> str:
         pass
 
+    @abstractmethod
+    def _get_index_key(self, source: str) -> Hashable:
+        pass
+
     @abstractmethod
     def _get_raw_text(self, source: str) -> str:
         pass
 
+    @abstractmethod
+    def _get_revision(self, source: str) -> Hashable:
+        pass
+
     @abstractmethod
     def _replace(self, text: str, source: str) -> None:
         pass
@@ -32,85 +42,149 @@ class AbstractHandler(ABC):
         pass
 
     def get_all(self) -> List[Referral]:
-        return self._get_all(self._get_list_name())
+        with self._stage('read'):
+            return self._get_all(self._get_list_name())
 
     def get_random(self) -> Referral:
-        return self._get_random(self._get_list_name())
+        with self._stage('read'):
+            return self._get_random(self._get_list_name())
 
     def get_usernames(self) -> List[str]:
-        return self._get_usernames(self._get_list_name())
+        with self._stage('read'):
+            return self._get_usernames(self._get_list_name())
+
+    def get_revision(self) -> Hashable:
+        with self._stage('read'):
+            return self._get_revision(self._get_list_name())
+
+    def get_index_key(self) -> Hashable:
+        """Key of this list in the ReferralIndexStore, the same for every handler of the list"""
+        return self._get_index_key(self._get_list_name())
 
     def get_raw_text(self) -> str:
-        return self._get_raw_text(self._get_list_name())
+        with self._stage('read'):
+            return self._get_index(self._get_list_name()).raw_text
 
     def is_duplicate(self, referral: Referral) -> bool:
-        return self._is_duplicate(referral, self._get_list_name())
+        with self._stage('read'):
+            return self._is_duplicate(referral, self._get_list_name())
+
+    def lock(self) -> RLock:
+        """Lock serializing writes to this list across threads"""
+        return ReferralIndexStore.lock(self.get_index_key())
 
     def replace(self, raw_text: str):
-        self._replace(raw_text, self._get_list_name())
+        with self._stage('write'), self.lock():
+            self._replace(raw_text, self._get_list_name())
+
+    def replace_with(self, other: 'AbstractHandler', merge: Optional[Callable[[str], str]] = None):
+        """Replace this list with the contents of other, passed through merge if given, and empty other
+
+        merge is called with both lists locked, so nothing written to other after it was read is lost.
+        """
+        with self.lock(), other.lock():
+            raw_text = other.get_raw_text()
+            self.replace(merge(raw_text) if merge is not None else raw_text)
+            other.replace('')
 
     def save(self, referral: Referral) -> bool:
-        return self._save(referral, self._get_list_name())
+        # validation is the slow part, so it happens before taking the list lock
+        referral.check_format()
+        referral.validate()
 
-    def _get_all(self, source: str) -> List[Referral]:
-        referrals = self._get_referrals_str(source)
+        return self.add(referral)
+
+    def add(self, referral: Referral) -> bool:
+        """Add referral without checking it, eg. a code moved here from another list"""
+        with self._stage('write'), self.lock():
+            return self._save(referral, self._get_list_name())
+
+    def append_batch(self, referrals: List[Referral]) -> List[Referral]:
+        """Add referrals without checking them, returning the ones that weren't duplicates"""
+        accepted: List[Referral] = []
 
+        with self._stage('write'), self.lock():
+            for referral in referrals:
+                try:
+                    self._save(referral, self._get_list_name())
+                except DuplicateCodeException:
+                    continue
+                accepted.append(referral)
+
+        return accepted
+
+    def remove(self, codes: Iterable[str]) -> List[Tuple[str, str]]:
+        """Remove the entries for codes, returning the (user, code) entries removed"""
+        with self._stage('write'), self.lock():
+            return self._remove({code.upper() for code in codes}, self._get_list_name())
+
+    def _stage(self, operation: str) -> metrics.Stage:
+        """Time a read or write of the list, eg. as the wiki_read stage"""
+        return metrics.stage('{type}_{operation}'.format(type=self._config.referral_source_type, operation=operation))
+
+    def _get_all(self, source: str) -> List[Referral]:
         referrals_list: List[Referral] = []
 
-        for referral in referrals:
-            items = referral.split(':')
-            if len(items) == 2:
-                redditor = self._reddit.redditor(items[0])
-                referrals_list.append(Referral(self._config, redditor, items[1]))
+        for user, code in self._get_index(source).entries:
+            redditor = self._reddit.redditor(user)
+            referrals_list.append(Referral(self._config, redditor, code))
 
         return referrals_list
 
+    def _remove(self, codes: Set[str], source: str) -> List[Tuple[str, str]]:
+        raw_text, removed = self._without(self._get_raw_text(source), codes)
+        if removed:
+            self._replace(raw_text, source)
+
+        return removed
+
     def _get_codes(self, source: str) -> List[str]:
-        referrals = self._get_referrals_str(source)
+        return [code for _, code in self._get_index(source).entries]
 
-        codes_list: List[str] = []
+    def _get_index(self, source: str) -> ReferralIndex:
+        """Return the parsed list, only re-reading the source when its revision has changed"""
+        key = self._get_index_key(source)
+        revision = self._get_revision(source)
+        index = ReferralIndexStore.get(key, revision)
 
-        for referral in referrals:
-            items = referral.split(':')
-            if len(items) == 2:
-                codes_list.append(items[1].upper())
+        if index is None:
+            index = self._load_index(source, revision)
+            ReferralIndexStore.put(key, index)
 
-        return codes_list
+        return index
 
     def _get_random(self, source: str) -> Referral:
-        # avoids the extra blank lines
-        referrals = self._get_referrals_str(source)
+        index = self._get_index(source)
 
-        referral = random.sample(referrals, 1)[0]
-        referral = referral.strip()
-
-        items = referral.split(':')
-        if len(items) == 2:
-            redditor = self._reddit.redditor(items[0])
-            return Referral(self._config, redditor, items[1].upper())
+        if self._config.rotation_policy == 'random':
+            user, code = index.random_entry()
         else:
-            raise NoReferralsFoundException()
-
-    def _get_referrals_str(self, source: str) -> List[str]:
-        referrals_string: str = self._get_raw_text(source)
-
-        # get all the raw referrals text and split on newline
-        # remove all empty entries and return a list
-        referrals: List[str] = list(filter(None, re.split(r'[\n]+', referrals_string)))
+            code = RotationScheduler.for_list(self._config, self._get_index_key(source)).pick(index)
+            user = index.user_for(code)
 
-        return referrals
+        redditor = self._reddit.redditor(user)
+        return Referral(self._config, redditor, code)
 
     def _get_usernames(self, source: str) -> List[str]:
-        referrals: List[str] = self._get_referrals_str(source)
+        return self._get_index(source).usernames
 
-        users_list: List[str] = []
+    def _is_duplicate(self, referral: Referral, source: str) -> bool:
+        return self._get_index(source).contains(referral.get_code)
 
-        for referral in referrals:
-            items = referral.split(':')
-            if len(items) == 2:
-                users_list.append(items[0])
+    def _load_index(self, source: str, revision: Hashable) -> ReferralIndex:
+        return ReferralIndex(self._get_raw_text(source), revision)
 
-        return users_list
+    @staticmethod
+    def _without(raw_text: str, codes: Set[str]) -> Tuple[str, List[Tuple[str, str]]]:
+        """Return raw_text without the entry lines for the upper cased codes, and the entries left out"""
+        lines: List[str] = []
+        removed: List[Tuple[str, str]] = []
 
-    def _is_duplicate(self, referral: Referral, source: str) -> bool:
-        return referral.get_code.upper() in self._get_codes(source)
+        for line in raw_text.splitlines(keepends=True):
+            items = line.strip().split(':')
+            if len(items) == 2 and items[1].strip().upper() in codes:
+                removed.append((items[0].strip(), items[1].strip().upper()))
+            else:
+                lines.append(line)
+
+        return ''.join(lines), removed
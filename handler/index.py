@@ -0,0 +1,176 @@
+import random
+import re
+from threading import Lock, RLock
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from exception.exceptions import NoReferralsFoundException
+
+
+class ReferralIndex(object):
+    """
+    Parsed, in-memory view of a referral list
+
+    The index is tied to the revision of the list it was built from (a wiki revision id or a file's
+    mtime/size) and is only rebuilt when that revision changes.  A file's index is extended in place as lines
+    are appended, so every change and every read holds _lock, and the collections are handed out as copies.
+
+    Attributes:
+        _revision (Hashable): revision of the source the index was built from
+        _raw_text (str): raw text of the source
+        _codes (Dict[str, int]): upper cased codes and how often they appear, for duplicate checks
+        _usernames (List[str]): usernames in list order, for announcements
+        _users_by_code (Dict[str, str]): user owning each code
+        _entries (List[Tuple[str, str]]): (username, code) pairs, for random selection
+        _lock (RLock): held while the index is read or changed
+        _mark (int): entries before _mark haven't changed since the last take_appended
+    """
+
+    def __init__(self, raw_text: str, revision: Hashable = None):
+        self._revision: Hashable = revision
+        self._raw_text: str = ''
+        self._codes: Dict[str, int] = {}
+        self._usernames: List[str] = []
+        self._users_by_code: Dict[str, str] = {}
+        self._entries: List[Tuple[str, str]] = []
+        self._lock: RLock = RLock()
+        self._mark: int = 0
+
+        self.add_text(raw_text)
+
+    def add_text(self, raw_text: str):
+        """Parse user:code lines from raw_text and add them to the index"""
+        with self._lock:
+            self._raw_text += raw_text
+
+            # split on newline and skip the blank lines left for readability
+            for line in filter(None, re.split(r'[\n]+', raw_text)):
+                self.add_line(line)
+
+    def add_line(self, line: str) -> bool:
+        """Add a single user:code line, returning False if it isn't an entry"""
+        items = line.strip().split(':')
+        if len(items) != 2:
+            return False
+
+        self.add(items[0].strip(), items[1].strip())
+        return True
+
+    def add(self, user: str, code: str):
+        code = code.upper()
+        with self._lock:
+            self._codes[code] = self._codes.get(code, 0) + 1
+            self._users_by_code.setdefault(code, user)
+            self._usernames.append(user)
+            self._entries.append((user, code))
+
+    def pop(self) -> Tuple[str, str]:
+        """Remove and return the last entry"""
+        with self._lock:
+            user, code = self._entries.pop()
+            self._usernames.pop()
+            self._mark = min(self._mark, len(self._entries))
+
+            self._codes[code] -= 1
+            if not self._codes[code]:
+                del self._codes[code]
+                del self._users_by_code[code]
+
+        return user, code
+
+    def contains(self, code: str) -> bool:
+        with self._lock:
+            return code.upper() in self._codes
+
+    def random_entry(self) -> Tuple[str, str]:
+        with self._lock:
+            if not self._entries:
+                raise NoReferralsFoundException()
+
+            return self._entries[random.randrange(len(self._entries))]
+
+    def take_appended(self) -> List[Tuple[str, str]]:
+        """Return the entries added since the last call, including any re-added after a pop"""
+        with self._lock:
+            appended = self._entries[self._mark:]
+            self._mark = len(self._entries)
+            return appended
+
+    def user_for(self, code: str) -> str:
+        with self._lock:
+            return self._users_by_code[code.upper()]
+
+    @property
+    def codes(self) -> List[str]:
+        with self._lock:
+            return list(self._codes)
+
+    @property
+    def entries(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._entries)
+
+    @property
+    def raw_text(self) -> str:
+        return self._raw_text
+
+    @property
+    def revision(self) -> Hashable:
+        return self._revision
+
+    @revision.setter
+    def revision(self, revision: Hashable):
+        self._revision = revision
+
+    @property
+    def usernames(self) -> List[str]:
+        with self._lock:
+            return list(self._usernames)
+
+
+class ReferralIndexStore(object):
+    """
+    Process wide store of ReferralIndex objects
+
+    Handlers are created for every message, so the indexes live here instead of on the handler.
+    Keys identify the backing list, eg. ('wiki', subreddit, page) or ('file', path).
+    """
+
+    _indexes: Dict[Hashable, ReferralIndex] = {}
+    _locks: Dict[Hashable, RLock] = {}
+    _locks_guard: Lock = Lock()
+
+    @classmethod
+    def get(cls, key: Hashable, revision: Hashable) -> Optional[ReferralIndex]:
+        """Return the cached index for key if it was built from revision, otherwise None"""
+        index = cls._indexes.get(key)
+        if index is None or revision is None or index.revision != revision:
+            return None
+
+        return index
+
+    @classmethod
+    def peek(cls, key: Hashable) -> Optional[ReferralIndex]:
+        """Return the cached index for key whatever its revision"""
+        return cls._indexes.get(key)
+
+    @classmethod
+    def items(cls) -> List[Tuple[Hashable, ReferralIndex]]:
+        return list(cls._indexes.items())
+
+    @classmethod
+    def put(cls, key: Hashable, index: ReferralIndex):
+        cls._indexes[key] = index
+
+    @classmethod
+    def invalidate(cls, key: Hashable):
+        cls._indexes.pop(key, None)
+
+    @classmethod
+    def clear(cls):
+        cls._indexes.clear()
+
+    @classmethod
+    def lock(cls, key: Hashable) -> RLock:
+        """Return the write lock for key, creating it on first use"""
+        with cls._locks_guard:
+            return cls._locks.setdefault(key, RLock())
@@ -0,0 +1,201 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from exception.exceptions import NoReferralsFoundException
+from handler.index import ReferralIndex
+from referralbotconfig import ReferralBotConfig
+
+
+class RotationScheduler(object):
+    """
+    Picks which code to hand out next from a ReferralIndex
+
+    Keeps how often and when each code was served in a heap, so each pick is O(log n).  Policies:
+
+        lrs: least recently served first, never served codes first of all
+        fair: fewest hand-outs relative to the owner's weight first, so a user weighing 2 is handed out twice
+              as often as one weighing 1.  Codes joining part way through start level with the code served
+              least so far, so a late opt-in doesn't get every referral until it catches up
+
+    When the list changes only the difference is applied: lines appended to a file list are taken from the
+    index, and a rebuilt index is compared with the tracked codes as sets.  Codes that leave the list keep
+    stale heap entries, which are skipped when they reach the top, and the heap is rebuilt once they
+    outnumber the live ones.  The state is saved to state_file at most every save_interval seconds and when
+    the bot stops.
+
+    Attributes:
+        _policy (str): lrs or fair
+        _weights (Dict[str, float]): lower cased username -> weight, for the users not weighing 1
+        _state (Dict[str, List[float]]): code -> [serve count, last served timestamp]
+        _code_weights (Dict[str, float]): code -> its owner's weight, for the codes not weighing 1
+        _heap (List[Tuple]): (priority, code) entries, possibly stale
+        _revision (Hashable): revision of the index the heap was last synced with
+    """
+
+    _instances: Dict[Hashable, 'RotationScheduler'] = {}
+    _instances_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, policy: str, state_file: str, save_interval: float, name: str,
+                 weights: Optional[Dict[str, float]] = None):
+        self._policy: str = policy
+        self._weights: Dict[str, float] = weights or {}
+        self._state_file: str = state_file
+        self._save_interval: float = save_interval
+        self._name: str = name
+        self._state: Dict[str, List[float]] = {}
+        self._code_weights: Dict[str, float] = {}
+        self._heap: List[Tuple[Tuple[float, float], str]] = []
+        self._revision: Hashable = None
+        self._index: Optional[ReferralIndex] = None
+        self._saved_at: float = time.time()
+        self._lock: threading.Lock = threading.Lock()
+
+        self._load()
+
+    @classmethod
+    def for_list(cls, config: ReferralBotConfig, key: Hashable) -> 'RotationScheduler':
+        """Return the scheduler for the list identified by key"""
+        with cls._instances_lock:
+            scheduler = cls._instances.get(key)
+            if scheduler is None:
+                scheduler = cls(config.rotation_policy, config.rotation_state_file, config.rotation_save_interval,
+                                ':'.join(str(part) for part in key), config.rotation_weights)
+                cls._instances[key] = scheduler
+
+        return scheduler
+
+    @classmethod
+    def save_all(cls):
+        with cls._instances_lock:
+            schedulers = list(cls._instances.values())
+
+        for scheduler in schedulers:
+            scheduler.save()
+
+    def pick(self, index: ReferralIndex) -> str:
+        """Return the next code to hand out and record it as served
+
+        Raises:
+            NoReferralsFoundException: the list has no entries
+        """
+        with self._lock:
+            if self._index is not index or self._revision != index.revision:
+                self._sync(index)
+
+            code = self._top(index)
+            if code is None:
+                raise NoReferralsFoundException()
+
+            served = self._state[code]
+            served[0] += 1
+            served[1] = time.time()
+            heapq.heapreplace(self._heap, (self._priority(code), code))
+
+            self._save_if_due()
+
+        return code
+
+    def save(self):
+        if not self._state_file:
+            return
+
+        with self._lock:
+            # several lists and worker processes share the file, keep the others' entries
+            data = self._read_file()
+            data[self._name] = self._state
+            temporary = '{}.{}.tmp'.format(self._state_file, os.getpid())
+            with open(temporary, 'wt') as file:
+                json.dump(data, file)
+            os.replace(temporary, self._state_file)
+            self._saved_at = time.time()
+
+    def _priority(self, code: str) -> Tuple[float, float]:
+        count, last_served = self._state[code]
+        if self._policy == 'lrs':
+            return last_served, count
+        return count / self._code_weights.get(code, 1), last_served
+
+    def _top(self, index: ReferralIndex) -> Optional[str]:
+        """Return the code at the top of the heap after dropping stale entries, None if the heap is empty"""
+        while self._heap:
+            priority, code = self._heap[0]
+            if code in self._state and not index.contains(code):
+                # removed from the end of a file list without a new index, see _sync
+                del self._state[code]
+            if code in self._state and priority == self._priority(code):
+                return code
+            # stale entry: the code left the list or was served since this entry was pushed
+            heapq.heappop(self._heap)
+        return None
+
+    def _sync(self, index: ReferralIndex):
+        """Start tracking codes new to the list and forget the ones that left"""
+        if self._index is index:
+            # a file list the index was extended with in place.  Codes popped off its end are dropped by _top
+            appended = index.take_appended()
+            added = {code for _, code in appended if code not in self._state}
+        else:
+            index.take_appended()
+            appended = index.entries if self._weights else []
+            codes = set(index.codes)
+            for code in self._state.keys() - codes:
+                del self._state[code]
+            added = codes - self._state.keys()
+            self._code_weights = {}
+
+        if self._weights:
+            for user, code in appended:
+                weight = self._weights.get(user.lower())
+                if weight is not None:
+                    # the code's first owner, as in ReferralIndex.user_for
+                    self._code_weights.setdefault(code, weight)
+
+        if self._index is None or len(self._heap) > 2 * len(self._state):
+            # the counts were just loaded from the state file, or most entries are stale
+            self._heap = [(self._priority(code), code) for code in self._state]
+            heapq.heapify(self._heap)
+
+        self._index = index
+        self._revision = index.revision
+
+        floor = 0.0
+        if self._policy == 'fair':
+            top = self._top(index)
+            floor = self._priority(top)[0] if top is not None else 0.0
+
+        for code in added:
+            self._state[code] = [floor * self._code_weights.get(code, 1) if self._policy == 'fair' else 0, 0.0]
+
+        if len(added) > len(self._heap):
+            # eg. the first sync of a list without saved counts: one heapify beats a push per code
+            self._heap.extend((self._priority(code), code) for code in added)
+            heapq.heapify(self._heap)
+        else:
+            for code in added:
+                heapq.heappush(self._heap, (self._priority(code), code))
+
+    def _load(self):
+        self._state = {code: list(served) for code, served in self._read_file().get(self._name, {}).items()}
+
+    def _read_file(self) -> dict:
+        if not self._state_file or not os.path.exists(self._state_file):
+            return {}
+
+        try:
+            with open(self._state_file) as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning("[Warning] Ignoring unreadable rotation state {file}: {error}".format(
+                file=self._state_file, error=e))
+            return {}
+
+    def _save_if_due(self):
+        if time.time() - self._saved_at >= self._save_interval:
+            # save() takes the lock itself
+            threading.Thread(target=self.save, daemon=True).start()
+            self._saved_at = time.time()
@@ -0,0 +1,305 @@
+import logging
+import random
+import re
+import sqlite3
+import threading
+from abc import ABC
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Set, Tuple
+
+import praw
+from praw.models import WikiPage
+
+from exception.exceptions import DuplicateCodeException, NoReferralsFoundException
+from handler.handlers import AbstractHandler
+from handler.index import ReferralIndexStore
+from referral import Referral
+from referralbotconfig import ReferralBotConfig
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS referrals (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    list TEXT NOT NULL,
+    user TEXT NOT NULL,
+    code TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    UNIQUE (list, code),
+    UNIQUE (list, slot)
+);
+CREATE INDEX IF NOT EXISTS referrals_by_user ON referrals (list, user);
+CREATE TABLE IF NOT EXISTS notes (
+    list TEXT PRIMARY KEY,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS revisions (
+    list TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL
+);
+'''
+
+
+class AbstractSqliteHandler(AbstractHandler, ABC):
+    """
+    Abstract SQLite Handler
+
+    Abstract class for SQLite handlers to inherit common functionality.  Every list is a set of rows in one
+    table, indexed by code and by user.  Lines of a list that aren't user:code entries, like the
+    update approved text, are kept in the notes table.
+
+    Each list numbers its rows with a dense slot (0 to count - 1), so a random entry is two index lookups.
+
+    Every write bumps the list's revision in the same transaction, so cached indexes stay correct.
+
+    Raises:
+        DuplicateCodeException: code already exists in the list
+    """
+
+    _initialized: Set[str] = set()
+    _initialized_lock: threading.Lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection in a transaction, committed on success and rolled back on error"""
+        database = self._config.sqlite_database
+        connection = sqlite3.connect(database, timeout=30)
+        try:
+            with self._initialized_lock:
+                if database not in self._initialized:
+                    connection.executescript(SCHEMA)
+                    self._initialized.add(database)
+
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _get_index_key(self, source: str) -> Hashable:
+        return 'sqlite', self._config.sqlite_database, source
+
+    def _get_revision(self, source: str) -> int:
+        with self._connect() as connection:
+            row = connection.execute('SELECT revision FROM revisions WHERE list = ?', (source,)).fetchone()
+
+        return row[0] if row is not None else 0
+
+    def _get_raw_text(self, source: str) -> str:
+        with self._connect() as connection:
+            return self._read_text(connection, source)
+
+    def _get_codes(self, source: str) -> List[str]:
+        with self._connect() as connection:
+            rows = connection.execute('SELECT code FROM referrals WHERE list = ? ORDER BY position', (source,))
+            return [code for code, in rows]
+
+    def _get_random(self, source: str) -> Referral:
+        if self._config.rotation_policy != 'random':
+            # rotation needs the whole list in memory
+            return super()._get_random(source)
+
+        with self._connect() as connection:
+            last, = connection.execute('SELECT max(slot) FROM referrals WHERE list = ?', (source,)).fetchone()
+            if last is None:
+                raise NoReferralsFoundException()
+
+            user, code = connection.execute('SELECT user, code FROM referrals WHERE list = ? AND slot = ?',
+                                            (source, random.randint(0, last))).fetchone()
+
+        return Referral(self._config, self._reddit.redditor(user), code)
+
+    def _get_usernames(self, source: str) -> List[str]:
+        with self._connect() as connection:
+            rows = connection.execute('SELECT user FROM referrals WHERE list = ? ORDER BY position', (source,))
+            return [user for user, in rows]
+
+    def _is_duplicate(self, referral: Referral, source: str) -> bool:
+        with self._connect() as connection:
+            row = connection.execute('SELECT 1 FROM referrals WHERE list = ? AND code = ?',
+                                     (source, referral.get_code.upper())).fetchone()
+
+        return row is not None
+
+    def _save(self, referral: Referral, source: str) -> bool:
+        try:
+            with self._connect() as connection:
+                connection.execute('INSERT INTO referrals (list, user, code, slot) '
+                                   'SELECT ?, ?, ?, coalesce(max(slot) + 1, 0) FROM referrals WHERE list = ?',
+                                   (source, str(referral.get_user), referral.get_code.upper(), source))
+                self._bump_revision(connection, source)
+        except sqlite3.IntegrityError:
+            raise DuplicateCodeException()
+
+        return True
+
+    def _remove(self, codes: Set[str], source: str) -> List[Tuple[str, str]]:
+        if not codes:
+            return []
+
+        placeholders = ', '.join('?' * len(codes))
+        with self._connect() as connection:
+            # take the write lock before reading, so the rows deleted are the ones reported
+            connection.execute('BEGIN IMMEDIATE')
+            removed = connection.execute('SELECT user, code, slot FROM referrals WHERE list = ? AND code IN ({}) '
+                                         'ORDER BY position'.format(placeholders), (source, *codes)).fetchall()
+            if not removed:
+                return []
+
+            connection.execute('DELETE FROM referrals WHERE list = ? AND code IN ({})'.format(placeholders),
+                               (source, *codes))
+            self._fill_slots(connection, source, [slot for _, _, slot in removed])
+            self._bump_revision(connection, source)
+
+        ReferralIndexStore.invalidate(self._get_index_key(source))
+        return [(user, code) for user, code, _ in removed]
+
+    def _replace(self, raw_text: str, source: str):
+        with self._connect() as connection:
+            self._write_text(connection, raw_text, source)
+
+        ReferralIndexStore.invalidate(self._get_index_key(source))
+
+    def replace_with(self, other: AbstractHandler, merge: Optional[Callable[[str], str]] = None):
+        """Swap the other list, through merge if given, into this one and empty the other in a single transaction"""
+        if not isinstance(other, AbstractSqliteHandler) or \
+                other._config.sqlite_database != self._config.sqlite_database:
+            super().replace_with(other, merge)
+            return
+
+        source = self._get_list_name()
+        other_source = other._get_list_name()
+
+        with self._stage('write'), self._connect() as connection:
+            raw_text = merged = None
+            if merge is not None:
+                # take the write lock before reading, so no other process writes in between
+                connection.execute('BEGIN IMMEDIATE')
+                raw_text = self._read_text(connection, other_source)
+                merged = merge(raw_text)
+
+            if merged == raw_text:
+                # the rows are moved as they are, without rewriting them
+                connection.execute('DELETE FROM referrals WHERE list = ?', (source,))
+                connection.execute('UPDATE referrals SET list = ? WHERE list = ?', (source, other_source))
+                connection.execute('DELETE FROM notes WHERE list = ?', (source,))
+                connection.execute('UPDATE notes SET list = ? WHERE list = ?', (source, other_source))
+                self._bump_revision(connection, source)
+                self._bump_revision(connection, other_source)
+            else:
+                self._write_text(connection, merged, source)
+                self._write_text(connection, '', other_source)
+
+        ReferralIndexStore.invalidate(self._get_index_key(source))
+        ReferralIndexStore.invalidate(self._get_index_key(other_source))
+
+    def _read_text(self, connection: sqlite3.Connection, source: str) -> str:
+        note = connection.execute('SELECT text FROM notes WHERE list = ?', (source,)).fetchone()
+        rows = connection.execute('SELECT user, code FROM referrals WHERE list = ? ORDER BY position',
+                                  (source,)).fetchall()
+
+        return self._render(note[0] if note is not None else '', rows)
+
+    def _write_text(self, connection: sqlite3.Connection, raw_text: str, source: str):
+        """Replace the list's rows and notes with the ones parsed from raw_text"""
+        notes, entries = self._parse(raw_text)
+
+        connection.execute('DELETE FROM referrals WHERE list = ?', (source,))
+        connection.executemany('INSERT INTO referrals (list, user, code, slot) VALUES (?, ?, ?, ?)',
+                               [(source, user, code, slot) for slot, (user, code) in enumerate(entries)])
+        connection.execute('INSERT OR REPLACE INTO notes (list, text) VALUES (?, ?)', (source, notes))
+        self._bump_revision(connection, source)
+
+    @staticmethod
+    def _fill_slots(connection: sqlite3.Connection, source: str, freed: List[int]):
+        """Move the rows numbered past the end of the list into the freed slots, keeping them dense"""
+        count, = connection.execute('SELECT count(*) FROM referrals WHERE list = ?', (source,)).fetchone()
+        holes = sorted(slot for slot in freed if slot < count)
+        moved = connection.execute('SELECT slot FROM referrals WHERE list = ? AND slot >= ? ORDER BY slot',
+                                   (source, count)).fetchall()
+
+        connection.executemany('UPDATE referrals SET slot = ? WHERE list = ? AND slot = ?',
+                               [(hole, source, slot) for hole, (slot,) in zip(holes, moved)])
+
+    @staticmethod
+    def _bump_revision(connection: sqlite3.Connection, source: str):
+        connection.execute('INSERT OR IGNORE INTO revisions (list, revision) VALUES (?, 0)', (source,))
+        connection.execute('UPDATE revisions SET revision = revision + 1 WHERE list = ?', (source,))
+
+    @staticmethod
+    def _parse(raw_text: str) -> Tuple[str, List[Tuple[str, str]]]:
+        notes: List[str] = []
+        # code -> user, first entry for a code wins
+        entries: Dict[str, str] = {}
+
+        for line in filter(None, re.split(r'[\n]+', raw_text)):
+            items = line.strip().split(':')
+            if len(items) == 2:
+                entries.setdefault(items[1].strip().upper(), items[0].strip())
+            elif line.strip():
+                notes.append(line.strip())
+
+        return '\n\n'.join(notes), [(user, code) for code, user in entries.items()]
+
+    @staticmethod
+    def _render(notes: str, rows: List[Tuple[str, str]]) -> str:
+        # same layout as the wiki and file lists: entries separated by a blank line
+        return notes + ''.join("\n\n{user}:{code}".format(user=user, code=code) for user, code in rows)
+
+
+class SqliteReferralHandler(AbstractSqliteHandler):
+    """
+    SQLite handler for referrals
+    """
+
+    def _get_list_name(self) -> str:
+        return self._config.referral_list_name
+
+
+class SqliteRenewalHandler(AbstractSqliteHandler):
+    """
+    SQLite handler for renewals
+    """
+
+    def _get_list_name(self) -> str:
+        return self._config.renewal_list_name
+
+
+class SqliteQuarantineHandler(AbstractSqliteHandler):
+    """
+    SQLite handler for codes taken off the referral list because they stopped working
+    """
+
+    def _get_list_name(self) -> str:
+        return self._config.quarantine_list_name
+
+
+class SqliteWikiRenderer(object):
+    """
+    Copies the SQLite lists to their wiki pages for display
+
+    Only lists that changed since the last render are written.
+
+    Attributes:
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _reddit (praw.Reddit): Reddit instance
+        _rendered (dict): wiki page name -> list revision last written to it
+    """
+
+    def __init__(self, config: ReferralBotConfig, reddit: praw.Reddit):
+        self._config: ReferralBotConfig = config
+        self._reddit: praw.Reddit = reddit
+        self._rendered: dict = {}
+
+    def run(self):
+        for handler, page_name in ((SqliteReferralHandler(self._config, self._reddit),
+                                    self._config.wiki_referral_list_name),
+                                   (SqliteRenewalHandler(self._config, self._reddit),
+                                    self._config.wiki_renewal_list_name)):
+            revision = handler.get_revision()
+
+            if self._rendered.get(page_name) == revision:
+                continue
+
+            page: WikiPage = self._reddit.subreddit(self._config.home_subreddit).wiki[page_name]
+            page.edit(content=handler.get_raw_text())
+            self._rendered[page_name] = revision
+            logging.info("[Info] Rendered revision {revision} to wiki page {page}".format(revision=revision,
+                                                                                       page=page_name))
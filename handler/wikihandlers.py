@@ -1,13 +1,33 @@
+import logging
 import pprint
+import threading
 from abc import ABC
+from concurrent.futures import Future
+from typing import Dict, Hashable, List, Optional, Set, Tuple
 
 from praw.models import WikiPage
+from prawcore import Conflict, NotFound
 
 from exception.exceptions import DuplicateCodeException
 from handler.handlers import AbstractHandler
+from handler.index import ReferralIndex, ReferralIndexStore
 from referral import Referral
 
 
+class WikiReferralIndex(ReferralIndex):
+    """
+    ReferralIndex that also remembers whether the bot may revise the page it was built from
+    """
+
+    def __init__(self, raw_text: str, revision: Hashable = None, may_revise: bool = False):
+        super().__init__(raw_text, revision)
+        self._may_revise: bool = may_revise
+
+    @property
+    def may_revise(self) -> bool:
+        return self._may_revise
+
+
 class AbstractWikiHandler(AbstractHandler, ABC):
     """
     Abstract Wiki Handler
@@ -17,42 +37,145 @@ class AbstractWikiHandler(AbstractHandler, ABC):
     Raises:
         DuplicateCodeException: code already exists in the list
     """
+
+    MAX_EDIT_ATTEMPTS = 3
+
+    def _get_index_key(self, source: str) -> Hashable:
+        return 'wiki', self._config.home_subreddit.lower(), source
+
+    def _get_page(self, source: str) -> WikiPage:
+        return self._reddit.subreddit(self._config.home_subreddit).wiki[source]
+
     def _get_raw_text(self, source: str) -> str:
-        page: WikiPage = self._reddit.subreddit(self._config.home_subreddit).wiki[source]
+        page: WikiPage = self._get_page(source)
         return page.mod.wikipage.content_md
 
-    def _save(self, referral: Referral, source: str) -> bool:
+    def _get_revision(self, source: str) -> Optional[str]:
+        # the revisions listing is much smaller than the page itself
+        for revision in self._get_page(source).revisions(limit=1):
+            return revision['id']
+
+        return None
+
+    def _load_index(self, source: str, revision: Hashable) -> WikiReferralIndex:
+        page: WikiPage = self._get_page(source)
+        referrals_string = page.content_md
+
+        # the page fetch carries its own revision id, which is the one the content belongs to
+        return WikiReferralIndex(referrals_string, page.revision_id, page.may_revise)
+
+    def save(self, referral: Referral) -> bool:
+        if self._config.wiki_write_window <= 0:
+            return super().save(referral)
+
         referral.check_format()
         referral.validate()
 
-        if self._is_duplicate(referral, source):
+        # wait for the batch holding this referral to be written, so replies are only sent once it is
+        return WikiWriteBuffer.for_handler(self).submit(self, referral).result()
+
+    def append_batch(self, referrals: List[Referral]) -> List[Referral]:
+        """Append referrals in a single edit, returning the ones that weren't duplicates"""
+        with self._stage('write'), self.lock():
+            return self._append(referrals, self._get_list_name())
+
+    def _save(self, referral: Referral, source: str) -> bool:
+        if not self._append([referral], source):
             raise DuplicateCodeException()
 
-        page = self._reddit.subreddit(self._config.home_subreddit).wiki[source]
+        return True
 
-        if not page.may_revise:
-            raise PermissionError("Bot user {bot_user} does not have write access to wiki page {source}".format(
-                                        bot_user=self._config.botname,
-                                        source=source))
+    def _append(self, referrals: List[Referral], source: str) -> List[Referral]:
+        """Append the referrals that aren't on the page yet in one edit
 
-        referrals_string = page.mod.wikipage.content_md
-        # add the entry with two leading newlines for readability
-        updated_list = referrals_string + "\n\n{new_user}:{code}".format(
-                                                                new_user=referral.get_user,
-                                                                code=referral.get_code)
-        page.edit(updated_list)
+        The edit names the revision it was based on.  If the page changed in the meantime Reddit refuses the
+        edit, and the page is read again and the referrals merged into it once more.
+        """
+        conflict: Optional[Conflict] = None
 
-        return True
+        for attempt in range(self.MAX_EDIT_ATTEMPTS):
+            index: WikiReferralIndex = self._get_index(source)
+
+            if not index.may_revise:
+                raise PermissionError("Bot user {bot_user} does not have write access to wiki page {source}".format(
+                                            bot_user=self._config.botname,
+                                            source=source))
+
+            accepted: List[Referral] = []
+            codes = set()
+            for referral in referrals:
+                if not index.contains(referral.get_code) and referral.get_code not in codes:
+                    accepted.append(referral)
+                    codes.add(referral.get_code)
+
+            if not accepted:
+                return accepted
+
+            # add the entries with two leading newlines for readability
+            entries = ''.join("\n\n{new_user}:{code}".format(new_user=referral.get_user,
+                                                              code=referral.get_code) for referral in accepted)
+            edit_settings = {'previous': index.revision} if index.revision is not None else {}
+
+            try:
+                self._get_page(source).edit(content=index.raw_text + entries, **edit_settings)
+            except Conflict as e:
+                conflict = e
+                logging.info("[Info] Wiki page {source} changed during edit, merging again (attempt {attempt})".format(
+                    source=source, attempt=attempt + 1))
+                ReferralIndexStore.invalidate(self._get_index_key(source))
+                continue
+
+            # the edit response doesn't say which revision it made, and the latest one may already be another
+            # editor's.  Read the page again rather than tie this content to their revision
+            ReferralIndexStore.invalidate(self._get_index_key(source))
+
+            return accepted
+
+        # the page kept changing, leave the messages for the next sweep
+        raise conflict
+
+    def _remove(self, codes: Set[str], source: str) -> List[Tuple[str, str]]:
+        """Remove the entries for codes in one edit, based on the revision read like _append"""
+        conflict: Optional[Conflict] = None
+
+        for attempt in range(self.MAX_EDIT_ATTEMPTS):
+            index: WikiReferralIndex = self._get_index(source)
+
+            if not index.may_revise:
+                raise PermissionError("Bot user {bot_user} does not have write access to wiki page {source}".format(
+                                            bot_user=self._config.botname,
+                                            source=source))
+
+            raw_text, removed = self._without(index.raw_text, codes)
+            if not removed:
+                return removed
+
+            edit_settings = {'previous': index.revision} if index.revision is not None else {}
+            try:
+                self._get_page(source).edit(content=raw_text, **edit_settings)
+            except Conflict as e:
+                conflict = e
+                logging.info("[Info] Wiki page {source} changed during edit, removing again (attempt {attempt})".format(
+                    source=source, attempt=attempt + 1))
+                ReferralIndexStore.invalidate(self._get_index_key(source))
+                continue
+
+            ReferralIndexStore.invalidate(self._get_index_key(source))
+            return removed
+
+        raise conflict
 
     def _replace(self, raw_text: str, source: str):
-        page: WikiPage = self._reddit.subreddit(self._config.home_subreddit).wiki[source]
+        page: WikiPage = self._get_page(source)
 
         if not page.may_revise:
             raise PermissionError("Bot user {bot_user} does not have write access to wiki page {source}".format(
                                         bot_user=self._config.botname,
                                         source=source))
 
-        page.edit(raw_text)
+        page.edit(content=raw_text)
+
+        ReferralIndexStore.invalidate(self._get_index_key(source))
 
 
 class WikiReferralHandler(AbstractWikiHandler):
@@ -71,3 +194,132 @@ class WikiRenewalHandler(AbstractWikiHandler):
 
     def _get_list_name(self) -> str:
         return self._config.renewal_list_name
+
+
+class WikiQuarantineHandler(AbstractWikiHandler):
+    """
+    Wiki handler for codes taken off the referral list because they stopped working
+
+    The page is created along with the first codes moved to it.
+    """
+
+    def _get_list_name(self) -> str:
+        return self._config.quarantine_list_name
+
+    def _append(self, referrals: List[Referral], source: str) -> List[Referral]:
+        try:
+            return super()._append(referrals, source)
+        except NotFound:
+            # nothing was quarantined yet
+            pass
+
+        accepted: List[Referral] = []
+        codes = set()
+        for referral in referrals:
+            if referral.get_code not in codes:
+                accepted.append(referral)
+                codes.add(referral.get_code)
+
+        entries = ''.join("\n\n{new_user}:{code}".format(new_user=referral.get_user,
+                                                          code=referral.get_code) for referral in accepted)
+        self._reddit.subreddit(self._config.home_subreddit).wiki.create(name=source, content=entries,
+                                                                        reason='Codes that stopped working')
+        logging.info("[Info] Created wiki page {source}".format(source=source))
+
+        ReferralIndexStore.invalidate(self._get_index_key(source))
+        return accepted
+
+
+class WikiWriteBuffer(object):
+    """
+    Collects accepted referrals for a wiki page and writes them in one edit
+
+    A batch is written when the first referral in it has waited wiki_write_window seconds, or straight away
+    once it holds wiki_write_batch_size referrals.  Each submitter gets a Future that completes when its
+    batch is on the page, or fails with DuplicateCodeException or the error that stopped the edit.
+
+    Attributes:
+        _window (float): seconds to collect referrals before writing
+        _max_size (int): number of referrals that triggers an immediate write
+        _pending (List[Tuple[Referral, Future]]): referrals waiting to be written
+        _handler (AbstractWikiHandler): handler used to write the batch
+        _timer (threading.Timer): pending timed flush
+    """
+
+    _buffers: Dict[Hashable, 'WikiWriteBuffer'] = {}
+    _buffers_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, window: float, max_size: int):
+        self._window: float = window
+        self._max_size: int = max_size
+        self._pending: List[Tuple[Referral, Future]] = []
+        self._handler: Optional[AbstractWikiHandler] = None
+        self._timer: Optional[threading.Timer] = None
+        self._lock: threading.Lock = threading.Lock()
+
+    @classmethod
+    def for_handler(cls, handler: AbstractWikiHandler) -> 'WikiWriteBuffer':
+        key = handler.get_index_key()
+
+        with cls._buffers_lock:
+            buffer = cls._buffers.get(key)
+            if buffer is None:
+                buffer = cls(handler._config.wiki_write_window, handler._config.wiki_write_batch_size)
+                cls._buffers[key] = buffer
+
+        return buffer
+
+    def submit(self, handler: AbstractWikiHandler, referral: Referral) -> Future:
+        future = Future()
+        batch = None
+
+        with self._lock:
+            self._pending.append((referral, future))
+            self._handler = handler
+
+            if len(self._pending) >= self._max_size:
+                batch = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self._window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if batch:
+            self._commit(handler, batch)
+
+        return future
+
+    def flush(self):
+        with self._lock:
+            handler = self._handler
+            batch = self._take()
+
+        if batch:
+            self._commit(handler, batch)
+
+    def _take(self) -> List[Tuple[Referral, Future]]:
+        batch = self._pending
+        self._pending = []
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        return batch
+
+    @staticmethod
+    def _commit(handler: AbstractWikiHandler, batch: List[Tuple[Referral, Future]]):
+        try:
+            accepted = handler.append_batch([referral for referral, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        logging.info("[Info] Wrote {count} of {total} buffered referral(s) in one edit".format(count=len(accepted),
+                                                                                             total=len(batch)))
+        for referral, future in batch:
+            if referral in accepted:
+                future.set_result(True)
+            else:
+                future.set_exception(DuplicateCodeException())
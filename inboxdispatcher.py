@@ -0,0 +1,174 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterable, List
+import logging
+
+import praw
+from praw.exceptions import PRAWException
+from praw.models import Message
+from prawcore import PrawcoreException
+
+import metrics
+
+from bulkmessenger import BulkMessenger
+from exception.exceptions import ReferralBotFatalException
+from messagejournal import MessageJournal
+from profilecache import ProfilePrefetcher
+from redditpool import RedditPool
+from referralbotconfig import ReferralBotConfig
+from responder import Responder
+
+
+class AbstractDispatcher(ABC):
+    """
+    Answers the unread Messages of a sweep and marks them read
+
+    Each handled message is recorded in the MessageJournal, and the whole sweep is marked read in bulk at the
+    end.  Messages already in the journal, eg. handled just before a crash, are only marked read.  Subclasses
+    decide where the rest are answered.
+
+    Attributes:
+        _reddit (praw.Reddit): Reddit instance
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _bulk_messenger (bulkmessenger.BulkMessenger): shared sender for announcements and notifications
+        _journal (messagejournal.MessageJournal): ids of the messages already handled
+    """
+
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig, bulk_messenger: BulkMessenger = None):
+        self._reddit: praw.Reddit = reddit
+        self._config: ReferralBotConfig = config
+        self._bulk_messenger: BulkMessenger = bulk_messenger
+        self._journal: MessageJournal = MessageJournal.for_config(config)
+
+    def dispatch(self, messages: Iterable[Message]):
+        """Respond to messages and mark them read, returning once all of them are handled
+
+        Raises:
+            Exception: the first error raised by a Responder, preferring ReferralBotFatalException.
+                Messages of the failing author after the error are left unread.  The messages handled before
+                it are still marked read.
+        """
+        handled: List[Message] = []
+        pending: List[Message] = []
+        for message in messages:
+            if self._journal.contains(message.id):
+                handled.append(message)
+            else:
+                pending.append(message)
+
+        if handled:
+            logging.info("[Info] Skipping {count} message(s) handled before".format(count=len(handled)))
+
+        try:
+            self._dispatch(pending, handled)
+        finally:
+            self._mark_read(handled)
+
+    @abstractmethod
+    def _dispatch(self, messages: List[Message], handled: List[Message]) -> None:
+        """Answer messages, adding the ones answered to handled"""
+
+    def reconfigure(self, config: ReferralBotConfig):
+        """Use config from the next sweep on.  Only call between sweeps"""
+        self._config = config
+
+    def shutdown(self):
+        pass
+
+    def _mark_read(self, messages: List[Message]):
+        if not messages:
+            return
+
+        try:
+            with metrics.stage('mark_read'):
+                # praw sends these 25 to a request
+                self._reddit.inbox.mark_read(messages)
+        except (PRAWException, PrawcoreException) as e:
+            # they're in the journal, so the next sweep only tries marking them read again
+            logging.warning("[Warning] Could not mark {count} message(s) read: {error}".format(
+                count=len(messages), error=e))
+
+
+class InboxDispatcher(AbstractDispatcher):
+    """
+    Runs a Responder for each unread Message, optionally on a pool of worker threads.
+
+    Messages are grouped by author and each author's messages are handled in the order they were sent,
+    so only different users are ever processed at the same time.  Writes to the referral and renewal
+    lists are serialized by the handlers.  Each worker thread answers through its own Reddit instance from the
+    RedditPool.
+
+    Attributes:
+        _executor (ThreadPoolExecutor): worker pool, None when running sequentially
+        _prefetcher (profilecache.ProfilePrefetcher): bulk loads the authors' profiles, None when disabled
+    """
+
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig, bulk_messenger: BulkMessenger = None):
+        super().__init__(reddit, config, bulk_messenger)
+        self._executor: ThreadPoolExecutor = None
+        self._prefetcher: ProfilePrefetcher = None
+
+        if config.profile_prefetch:
+            self._prefetcher = ProfilePrefetcher(reddit, config)
+        if config.workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=config.workers)
+
+    def _dispatch(self, messages: List[Message], handled: List[Message]):
+        if self._prefetcher is not None:
+            self._prefetcher.prefetch(messages)
+
+        conversations = self._group_by_author(messages)
+
+        if self._executor is None:
+            for conversation in conversations:
+                self._respond(conversation, handled)
+            return
+
+        futures = [self._executor.submit(self._respond_borrowed, conversation, handled)
+                   for conversation in conversations]
+        wait(futures)
+
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        for error in errors:
+            if isinstance(error, ReferralBotFatalException):
+                raise error
+        if errors:
+            raise errors[0]
+
+    def reconfigure(self, config: ReferralBotConfig):
+        super().reconfigure(config)
+        if self._prefetcher is not None:
+            self._prefetcher = ProfilePrefetcher(self._reddit, config)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _respond_borrowed(self, conversation: List[Message], handled: List[Message]):
+        with RedditPool.for_reddit(self._reddit).borrow() as reddit:
+            self._respond(conversation, handled, reddit)
+
+    def _respond(self, conversation: List[Message], handled: List[Message], reddit: praw.Reddit = None):
+        reddit = reddit or self._reddit
+        for message in conversation:
+            responder = Responder(reddit, self._config, RedditPool.rebind(message, reddit), self._bulk_messenger)
+            responder.run()
+            self._journal.record(message.id)
+            handled.append(message)
+
+    @staticmethod
+    def _group_by_author(messages: Iterable[Message]) -> List[List[Message]]:
+        conversations = OrderedDict()
+
+        for message in messages:
+            if isinstance(message, Message):
+                conversations.setdefault(str(message.author), []).append(message)
+
+        # the inbox lists newest first, answer each user oldest first
+        for conversation in conversations.values():
+            conversation.sort(key=lambda message: message.created_utc)
+
+        logging.info("[Info] Dispatching {count} conversation(s)".format(count=len(conversations)))
+
+        return list(conversations.values())
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, IO, Optional
+
+from referralbotconfig import ReferralBotConfig
+
+
+class MessageJournal(object):
+    """
+    Append-only record of the inbox messages the bot has finished handling
+
+    A message id is appended as soon as its reply is sent, before the message is marked read, so a message
+    handled just before a crash is skipped after the restart instead of being answered twice.  Ids are read
+    back on startup.  Only the newest max_size ids are needed, since older messages have long been marked
+    read, so the file is rewritten with just those once it holds twice as many.
+
+    Attributes:
+        _filename (str): journal file, empty to keep the journal in memory only
+        _max_size (int): ids kept after a compaction
+        _ids (OrderedDict): handled message ids, oldest first
+        _lines (int): ids written to the file since it was last rewritten
+        _file (IO): the journal opened for appending, None until the first id is recorded
+    """
+
+    _instances: Dict[str, 'MessageJournal'] = {}
+    _instances_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, filename: str, max_size: int):
+        self._filename: str = filename
+        self._max_size: int = max_size
+        self._ids: 'OrderedDict[str, None]' = OrderedDict()
+        self._lines: int = 0
+        self._file: Optional[IO] = None
+        self._lock: threading.Lock = threading.Lock()
+
+        self._load()
+
+    @classmethod
+    def for_config(cls, config: ReferralBotConfig) -> 'MessageJournal':
+        """Return the shared journal for config's journal file"""
+        with cls._instances_lock:
+            journal = cls._instances.get(config.journal_file)
+            if journal is None:
+                journal = cls(config.journal_file, config.journal_size)
+                cls._instances[config.journal_file] = journal
+
+        return journal
+
+    def contains(self, message_id: str) -> bool:
+        with self._lock:
+            return message_id in self._ids
+
+    def record(self, message_id: str):
+        """Remember message_id as handled.  Written through to the file before returning"""
+        with self._lock:
+            if message_id in self._ids:
+                return
+
+            self._ids[message_id] = None
+            self._trim()
+            if not self._filename:
+                return
+
+            if self._file is None:
+                self._file = open(self._filename, 'at')
+            self._file.write(message_id + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._lines += 1
+
+            if self._lines >= 2 * self._max_size:
+                self._compact()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _load(self):
+        if not self._filename or not os.path.exists(self._filename):
+            return
+
+        try:
+            with open(self._filename) as file:
+                ids = [line.strip() for line in file]
+        except OSError as e:
+            logging.warning("[Warning] Ignoring unreadable message journal {file}: {error}".format(
+                file=self._filename, error=e))
+            return
+
+        # a crash mid write can leave a partial last line, so that message is handled again
+        for message_id in ids:
+            if message_id:
+                self._ids[message_id] = None
+        self._trim()
+        self._lines = len(ids)
+        logging.info("[Info] Loaded {count} handled message id(s) from {file}".format(
+            count=len(self._ids), file=self._filename))
+
+    def _trim(self):
+        while len(self._ids) > self._max_size:
+            self._ids.popitem(last=False)
+
+    def _compact(self):
+        """Rewrite the file with only the newest max_size ids.  Called with the lock held"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        # write then rename so a crash never loses the ids still needed
+        with open(self._filename + '.tmp', 'wt') as file:
+            file.writelines(message_id + '\n' for message_id in self._ids)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self._filename + '.tmp', self._filename)
+        self._lines = len(self._ids)
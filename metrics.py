@@ -0,0 +1,219 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from praw.exceptions import APIException
+from prawcore import Conflict, Forbidden, NotFound, TooManyRequests
+
+from exception.exceptions import DuplicateCodeException, InvalidCodeException, InvalidCodeFormatException, \
+    NoReferralsFoundException, ReferralBotFatalException, ValidationUnavailableException
+from referralbotconfig import ReferralBotConfig
+
+# upper bounds in seconds, from a cached lookup to a slow Reddit request
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# outcome label for errors raised out of a stage, most specific first
+OUTCOMES = ((ReferralBotFatalException, 'fatal'),
+            (DuplicateCodeException, 'duplicate'),
+            (InvalidCodeFormatException, 'invalid_code'),
+            (InvalidCodeException, 'invalid_code'),
+            (ValidationUnavailableException, 'unavailable'),
+            (NoReferralsFoundException, 'no_referrals'),
+            (TooManyRequests, 'rate_limited'),
+            (Conflict, 'conflict'),
+            (NotFound, 'not_found'),
+            (Forbidden, 'forbidden'))
+
+LabelValues = Tuple[str, str, str]
+
+
+class StageMetrics(object):
+    """
+    Process wide counters and latency histograms for each stage of handling a message
+
+    Every observation is labeled with the stage (eg. inbox_fetch, validate, wiki_write), the command being
+    handled (eg. referral, optin, or none outside a command) and the outcome (eg. ok, duplicate, rate_limited).
+    """
+
+    LABELS = ('stage', 'command', 'outcome')
+
+    _counts: Dict[LabelValues, List[int]] = {}
+    _sums: Dict[LabelValues, float] = {}
+    _lock: threading.Lock = threading.Lock()
+    _local: threading.local = threading.local()
+
+    @classmethod
+    def observe(cls, stage: str, command: str, outcome: str, seconds: float):
+        labels = (stage, command, outcome)
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+
+        with cls._lock:
+            counts = cls._counts.get(labels)
+            if counts is None:
+                # one count per bucket plus +Inf
+                counts = cls._counts[labels] = [0] * (len(BUCKETS) + 1)
+                cls._sums[labels] = 0.0
+            counts[bucket] += 1
+            cls._sums[labels] += seconds
+
+    @classmethod
+    def current_command(cls) -> str:
+        return getattr(cls._local, 'command', 'none')
+
+    @classmethod
+    @contextmanager
+    def command(cls, name: str) -> Iterator[None]:
+        """Label the stages run by this thread inside the block with command name"""
+        previous = cls.current_command()
+        cls._local.command = name
+        try:
+            yield
+        finally:
+            cls._local.command = previous
+
+    @classmethod
+    def start_trace(cls):
+        """Also keep the stages this thread runs, until stop_trace"""
+        cls._local.trace = []
+
+    @classmethod
+    def stop_trace(cls) -> List[Tuple[str, float]]:
+        """Return the (stage, seconds) run since start_trace, in the order they finished"""
+        trace = getattr(cls._local, 'trace', None) or []
+        cls._local.trace = None
+        return trace
+
+    @classmethod
+    def render(cls) -> str:
+        """Return every metric in the Prometheus text exposition format"""
+        with cls._lock:
+            snapshot = [(labels, list(counts), cls._sums[labels]) for labels, counts in sorted(cls._counts.items())]
+
+        lines = ['# HELP referralbot_stage_total Times each stage ran',
+                 '# TYPE referralbot_stage_total counter']
+        lines.extend('referralbot_stage_total{{{labels}}} {count}'.format(labels=cls._format(labels), count=sum(counts))
+                     for labels, counts, _ in snapshot)
+
+        lines.extend(['# HELP referralbot_stage_seconds Time spent in each stage',
+                      '# TYPE referralbot_stage_seconds histogram'])
+        for labels, counts, total in snapshot:
+            formatted = cls._format(labels)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float('inf'),), counts):
+                cumulative += count
+                lines.append('referralbot_stage_seconds_bucket{{{labels},le="{bound}"}} {count}'.format(
+                    labels=formatted, bound='+Inf' if bound == float('inf') else repr(bound), count=cumulative))
+            lines.append('referralbot_stage_seconds_sum{{{labels}}} {total!r}'.format(labels=formatted, total=total))
+            lines.append('referralbot_stage_seconds_count{{{labels}}} {count}'.format(labels=formatted,
+                                                                                       count=cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._counts.clear()
+            cls._sums.clear()
+
+    @classmethod
+    def _format(cls, values: LabelValues) -> str:
+        return ','.join('{name}="{value}"'.format(
+            name=name, value=value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in zip(cls.LABELS, values))
+
+
+class Stage(object):
+    """
+    Context manager timing one run of a stage
+
+    The outcome is ok unless the block sets another one or raises, in which case it is taken from the error.
+    """
+
+    def __init__(self, name: str, command: Optional[str] = None):
+        self._name: str = name
+        self._command: Optional[str] = command
+        self._started: float = 0.0
+        self.outcome: str = 'ok'
+
+    def __enter__(self) -> 'Stage':
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is not None:
+            self.outcome = outcome_for(exc_value)
+
+        seconds = time.perf_counter() - self._started
+        StageMetrics.observe(self._name, self._command or StageMetrics.current_command(), self.outcome, seconds)
+
+        # only set while the profiler is tracing this thread's message
+        trace = getattr(StageMetrics._local, 'trace', None)
+        if trace is not None:
+            trace.append((self._name, seconds))
+        return False
+
+
+def stage(name: str, command: Optional[str] = None) -> Stage:
+    return Stage(name, command)
+
+
+def outcome_for(error: BaseException) -> str:
+    if isinstance(error, APIException):
+        # praw 7 wraps several errors in RedditAPIException.items
+        item = error.items[0] if getattr(error, 'items', None) else error
+        return 'rate_limited' if item.error_type == 'RATELIMIT' else 'api_error'
+
+    for error_type, outcome in OUTCOMES:
+        if isinstance(error, error_type):
+            return outcome
+
+    return 'error'
+
+
+class MetricsServer(object):
+    """
+    Serves StageMetrics on http://<metrics address>:<metrics port>/metrics from a background thread
+
+    Attributes:
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _server (ThreadingHTTPServer): the HTTP server, None until started
+    """
+
+    def __init__(self, config: ReferralBotConfig):
+        self._config: ReferralBotConfig = config
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self._config.metrics_address, self._config.metrics_port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='MetricsServer', daemon=True).start()
+        logging.info("[Info] Serving metrics on http://{address}:{port}/metrics".format(
+            address=self._config.metrics_address, port=self._server.server_address[1]))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = StageMetrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood log.txt
+        pass
@@ -0,0 +1,110 @@
+import random
+import time
+from typing import Iterator, List, Optional, Set
+
+import praw
+from praw.models import Message
+from praw.models.util import stream_generator
+
+import metrics
+from referralbotconfig import ReferralBotConfig
+
+
+class PollScheduler(object):
+    """
+    Decides when to check the inbox next
+
+    Right after a sweep that found messages the inbox is checked again after min_interval seconds.  Every
+    quiet sweep multiplies the interval by backoff_factor, up to max_interval.  Errors back off exponentially
+    from error_delay with jitter, and never retry before Reddit's rate limit window resets.
+
+    In 'stream' mode the inbox is read with PRAW's stream generator, which only asks Reddit for messages
+    newer than the last one seen.  Its first request only returns the newest 100, so the whole unread backlog
+    is read once, as in poll mode, before switching to it.  Messages that fail are not seen again until the
+    bot restarts.
+
+    Attributes:
+        _reddit (praw.Reddit): Reddit instance
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _interval (float): delay before the next sweep
+        _errors (int): consecutive failed sweeps
+        _stream (Iterator): inbox stream, only used in 'stream' mode
+        _drained (Set[str]): fullnames of the backlog read before the stream, skipped in its first batch
+    """
+
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig):
+        self._reddit: praw.Reddit = reddit
+        self._config: ReferralBotConfig = config
+        self._interval: float = config.poll_min_interval
+        self._errors: int = 0
+        self._stream: Optional[Iterator[Optional[Message]]] = None
+        self._drained: Set[str] = set()
+
+    def fetch(self) -> List[Message]:
+        """Return the unread messages for this sweep"""
+        with metrics.stage('inbox_fetch') as stage:
+            messages = self._fetch()
+            if not messages:
+                stage.outcome = 'empty'
+
+        return messages
+
+    def _fetch(self) -> List[Message]:
+        if self._config.poll_mode != 'stream':
+            return list(self._reddit.inbox.unread(limit=None))
+
+        if self._stream is None:
+            backlog = list(self._reddit.inbox.unread(limit=None))
+            self._drained = {message.fullname for message in backlog}
+            # pause_after=-1 hands back None after every request so the pacing stays here
+            self._stream = stream_generator(self._reddit.inbox.unread, pause_after=-1)
+            return backlog
+
+        messages: List[Message] = []
+        try:
+            for message in self._stream:
+                if message is None:
+                    break
+                if message.fullname not in self._drained:
+                    messages.append(message)
+        except Exception:
+            # the generator is finished once it raises: start over from the backlog on the next sweep
+            self._stream = None
+            raise
+
+        # from here on the stream itself remembers what it has seen
+        self._drained = set()
+        return messages
+
+    def reconfigure(self, config: ReferralBotConfig):
+        """Use config's intervals from the next wait on"""
+        self._config = config
+        self._interval = min(max(self._interval, config.poll_min_interval), config.poll_max_interval)
+
+    def next_delay(self, activity: bool) -> float:
+        """Return how long to wait before the next sweep, sooner when the last sweep found messages"""
+        self._errors = 0
+
+        if activity:
+            self._interval = self._config.poll_min_interval
+        else:
+            self._interval = min(self._interval * self._config.poll_backoff_factor, self._config.poll_max_interval)
+
+        return self._interval
+
+    def next_error_delay(self, rate_limited: bool = False) -> float:
+        """Return how long to wait after a failed sweep, backing off with jitter"""
+        self._errors += 1
+        # the inbox may have been left half read, so look again soon once recovered
+        self._interval = self._config.poll_min_interval
+
+        delay = min(self._config.poll_error_delay * 2 ** (self._errors - 1), self._config.poll_max_error_delay)
+        if rate_limited:
+            delay = max(delay, self._seconds_until_reset())
+        return delay + random.uniform(0, delay / 4)
+
+    def _seconds_until_reset(self) -> float:
+        limits = getattr(getattr(self._reddit, 'auth', None), 'limits', None) or {}
+        reset = limits.get('reset_timestamp')
+
+        return max(0.0, reset - time.time()) if reset is not None else 0.0
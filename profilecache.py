@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import praw
+from praw.exceptions import PRAWException
+from praw.models import Message
+from prawcore import PrawcoreException
+
+import metrics
+from commandrouter import CommandRouter
+from referralbotconfig import ReferralBotConfig
+
+# most account ids Reddit accepts in one user_data_by_account_ids request
+PREFETCH_BATCH = 100
+
+
+class ProfileCache(object):
+    """
+    LRU cache of the Redditor profile data used by the account age and karma checks
+
+    An account's creation time never changes, so it is kept until the entry is evicted.  Karma changes, so it
+    is only trusted for karma_ttl seconds.  The cache is saved to a JSON snapshot at most every save_interval
+    seconds and when the bot stops, so it survives restarts.  One cache exists per file, shared by every
+    Responder.
+
+    Attributes:
+        _filename (str): snapshot file, empty to keep the cache in memory only
+        _karma_ttl (float): seconds karma is trusted
+        _max_size (int): maximum number of users kept
+        _entries (OrderedDict): lower cased username -> [created_utc, link karma, comment karma, karma expiry],
+            least recently used first
+    """
+
+    _instances: Dict[str, 'ProfileCache'] = {}
+    _instances_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, filename: str, karma_ttl: float, max_size: int, save_interval: float):
+        self._filename: str = filename
+        self._karma_ttl: float = karma_ttl
+        self._max_size: int = max_size
+        self._save_interval: float = save_interval
+        self._entries: 'OrderedDict[str, List[float]]' = OrderedDict()
+        self._saved_at: float = time.time()
+        self._dirty: bool = False
+        self._lock: threading.Lock = threading.Lock()
+
+        self._load()
+
+    @classmethod
+    def for_config(cls, config: ReferralBotConfig) -> 'ProfileCache':
+        """Return the shared cache for config's snapshot file"""
+        with cls._instances_lock:
+            cache = cls._instances.get(config.profile_cache_file)
+            if cache is None:
+                cache = cls(config.profile_cache_file,
+                            config.profile_karma_ttl,
+                            config.profile_cache_size,
+                            config.profile_save_interval)
+                cls._instances[config.profile_cache_file] = cache
+
+        return cache
+
+    @classmethod
+    def save_all(cls):
+        with cls._instances_lock:
+            caches = list(cls._instances.values())
+
+        for cache in caches:
+            cache.save()
+
+    def get_created(self, user: str) -> Optional[float]:
+        """Return when user's account was created, or None if it isn't cached"""
+        with self._lock:
+            entry = self._entries.get(user.lower())
+            if entry is None:
+                return None
+
+            self._entries.move_to_end(user.lower())
+            return entry[0]
+
+    def get_karma(self, user: str) -> Optional[Tuple[int, int]]:
+        """Return user's (link karma, comment karma), or None if it isn't cached or has expired"""
+        with self._lock:
+            entry = self._entries.get(user.lower())
+            if entry is None or entry[3] <= time.time():
+                return None
+
+            self._entries.move_to_end(user.lower())
+            return int(entry[1]), int(entry[2])
+
+    def put(self, user: str, created_utc: float, link_karma: int, comment_karma: int):
+        with self._lock:
+            self._entries[user.lower()] = [created_utc, link_karma, comment_karma, time.time() + self._karma_ttl]
+            self._entries.move_to_end(user.lower())
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+            self._dirty = True
+            self._save_if_due()
+
+    def save(self):
+        if not self._filename:
+            return
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            # write then rename so a crash never leaves a truncated snapshot.  Least recently used first.  Worker
+            # processes save the same file, so each writes its own temporary file
+            temporary = '{}.{}.tmp'.format(self._filename, os.getpid())
+            with open(temporary, 'wt') as file:
+                json.dump([[user] + entry for user, entry in self._entries.items()], file)
+            os.replace(temporary, self._filename)
+            self._dirty = False
+            self._saved_at = time.time()
+
+    def _load(self):
+        if not self._filename or not os.path.exists(self._filename):
+            return
+
+        try:
+            with open(self._filename) as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning("[Warning] Ignoring unreadable profile cache {file}: {error}".format(
+                file=self._filename, error=e))
+            return
+
+        for user, created_utc, link_karma, comment_karma, karma_expires in data:
+            self._entries[user] = [created_utc, link_karma, comment_karma, karma_expires]
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def _save_if_due(self):
+        if self._filename and time.time() - self._saved_at >= self._save_interval:
+            # save() takes the lock itself
+            threading.Thread(target=self.save, daemon=True).start()
+            self._saved_at = time.time()
+
+
+class ProfilePrefetcher(object):
+    """
+    Loads the profiles of a sweep's authors into the ProfileCache in bulk
+
+    Every author whose command checks account age or karma and who isn't cached already is looked up by
+    account id, up to PREFETCH_BATCH per request, so a backlog of N messages costs N / 100 requests instead
+    of N.  Authors Reddit leaves out of the response (eg. suspended accounts) and sweeps where the lookup
+    fails are loaded one by one by the Responder as before.
+
+    Attributes:
+        _reddit (praw.Reddit): Reddit instance
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _profiles (ProfileCache): cache the profiles are put in
+        _router (commandrouter.CommandRouter): picks the command for each message subject
+    """
+
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig):
+        self._reddit: praw.Reddit = reddit
+        self._config: ReferralBotConfig = config
+        self._profiles: ProfileCache = ProfileCache.for_config(config)
+        self._router: CommandRouter = CommandRouter.for_config(config)
+
+    def prefetch(self, messages: Iterable[Message]):
+        ids = self._missing_ids(messages)
+        if not ids:
+            return
+
+        for start in range(0, len(ids), PREFETCH_BATCH):
+            batch = ids[start:start + PREFETCH_BATCH]
+            try:
+                with metrics.stage('profile_prefetch') as stage:
+                    users = self._reddit.request(method='GET', path='api/user_data_by_account_ids',
+                                                 params={'ids': ','.join(batch)}) or {}
+                    if len(users) < len(batch):
+                        stage.outcome = 'partial'
+            except (PRAWException, PrawcoreException) as e:
+                logging.warning("[Warning] Could not prefetch {count} profiles, loading them one by one: "
+                                "{error}".format(count=len(batch), error=e))
+                return
+
+            for data in users.values():
+                self._profiles.put(data['name'], data['created_utc'], data.get('link_karma', 0),
+                                   data.get('comment_karma', 0))
+
+        logging.debug("[Debug] Prefetched {count} profiles".format(count=len(ids)))
+
+    def _missing_ids(self, messages: Iterable[Message]) -> List[str]:
+        """Return the account ids of the authors whose profiles will be needed but aren't cached"""
+        ids: Dict[str, None] = OrderedDict()
+
+        for message in messages:
+            # deleted accounts and messages from Reddit itself have no author id
+            fullname = getattr(message, 'author_fullname', None)
+            if not fullname or fullname in ids:
+                continue
+
+            command = self._router.route(message.subject)
+            user = str(message.author)
+            if command.requires_karma and self._profiles.get_karma(user) is None:
+                ids[fullname] = None
+            elif command.requires_age and self._profiles.get_created(user) is None:
+                ids[fullname] = None
+
+        return list(ids)
@@ -0,0 +1,215 @@
+import contextlib
+import cProfile
+import logging
+import os
+import random
+import signal
+import threading
+import time
+import tracemalloc
+from typing import ContextManager, Dict, List, Optional, Tuple
+
+from metrics import StageMetrics
+from referralbotconfig import ReferralBotConfig
+
+# handed out for every message while profiling is off
+DISABLED: ContextManager = contextlib.nullcontext()
+
+
+class Profiler(object):
+    """
+    Opt-in profiling of the running bot
+
+    Enabled by the profiling config flag or at runtime by sending the process SIGUSR1, which toggles it.
+    While enabled:
+
+        a sample of messages is run under cProfile and dumped to <directory>/<command>-<time>.prof, keeping
+        the newest few dumps of each command
+        a tracemalloc snapshot is taken every tracemalloc_interval seconds and the biggest changes since the
+        previous snapshot are written to <directory>/tracemalloc-<time>.txt, also keeping the newest few
+        messages slower than slow_threshold seconds are logged with the time spent in each stage
+
+    When disabled, message() hands back a shared no-op context manager, so it costs one attribute check.
+
+    Attributes:
+        _enabled (bool): profiling is on
+        _profile_lock (threading.Lock): held while a message is profiled, cProfile profiles one at a time
+        _snapshot (tracemalloc.Snapshot): the last tracemalloc snapshot, to diff the next one against
+        _stop (threading.Event): set to stop the tracemalloc thread
+    """
+
+    _instances: Dict[str, 'Profiler'] = {}
+    _instances_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, config: ReferralBotConfig):
+        self._config: ReferralBotConfig = config
+        self._enabled: bool = False
+        self._profile_lock: threading.Lock = threading.Lock()
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._stop: threading.Event = threading.Event()
+
+        if config.profiling_enabled:
+            self.enable()
+
+    @classmethod
+    def for_config(cls, config: ReferralBotConfig) -> 'Profiler':
+        """Return the shared profiler for config's profiling directory"""
+        with cls._instances_lock:
+            profiler = cls._instances.get(config.profiling_directory)
+            if profiler is None:
+                profiler = cls(config)
+                cls._instances[config.profiling_directory] = profiler
+
+        return profiler
+
+    def install_signal_handler(self):
+        """Toggle profiling on SIGUSR1.  Only works from the main thread, and not on Windows"""
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle())
+
+    def toggle(self):
+        if self._enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def enable(self):
+        if self._enabled:
+            return
+
+        os.makedirs(self._config.profiling_directory, exist_ok=True)
+        self._enabled = True
+
+        if self._config.profiling_tracemalloc_interval > 0:
+            tracemalloc.start(self._config.profiling_tracemalloc_frames)
+            self._snapshot = tracemalloc.take_snapshot()
+            # a fresh event, so a watcher left from before a quick disable and enable still stops
+            self._stop = threading.Event()
+            threading.Thread(target=self._watch_memory, args=(self._stop,), name='Profiler', daemon=True).start()
+
+        logging.info("[Info] Profiling enabled, writing to {directory}".format(
+            directory=self._config.profiling_directory))
+
+    def disable(self):
+        if not self._enabled:
+            return
+
+        self._enabled = False
+        self._stop.set()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._snapshot = None
+
+        logging.info("[Info] Profiling disabled")
+
+    def message(self, command: str, user: str) -> ContextManager:
+        """Context manager around handling one message"""
+        if not self._enabled:
+            return DISABLED
+
+        return MessageProfile(self, command, user)
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def _should_sample(self) -> bool:
+        return random.random() < self._config.profiling_sample_rate
+
+    def _dump(self, profile: cProfile.Profile, command: str):
+        directory = self._config.profiling_directory
+        profile.dump_stats(os.path.join(directory, '{command}-{time}.prof'.format(
+            command=command, time=time.strftime('%Y%m%d-%H%M%S-') + '{:06d}'.format(int(time.time() % 1 * 1e6)))))
+
+        self._rotate(command + '-', '.prof')
+
+    def _rotate(self, prefix: str, suffix: str):
+        """Remove all but the newest keep files named prefix<time>suffix"""
+        directory = self._config.profiling_directory
+        # the timestamp sorts in creation order
+        names = sorted(name for name in os.listdir(directory) if name.startswith(prefix) and name.endswith(suffix))
+        for name in names[:-self._config.profiling_keep]:
+            os.remove(os.path.join(directory, name))
+
+    def _log_slow(self, command: str, user: str, duration: float, stages: List[Tuple[str, float]]):
+        breakdown = ', '.join("{stage} {seconds:.3f}s".format(stage=stage, seconds=seconds)
+                              for stage, seconds in stages)
+        logging.warning("[Warning] Slow {command} message from {user} took {duration:.3f}s: {breakdown}".format(
+            command=command, user=user, duration=duration, breakdown=breakdown or 'no stages recorded'))
+
+    def _watch_memory(self, stop: threading.Event):
+        while not stop.wait(self._config.profiling_tracemalloc_interval):
+            if not tracemalloc.is_tracing():
+                return
+
+            snapshot = tracemalloc.take_snapshot()
+            previous, self._snapshot = self._snapshot, snapshot
+            if previous is None:
+                continue
+
+            differences = snapshot.compare_to(previous, 'lineno')
+            growth = sum(difference.size_diff for difference in differences)
+            path = os.path.join(self._config.profiling_directory,
+                                'tracemalloc-{time}.txt'.format(time=time.strftime('%Y%m%d-%H%M%S')))
+
+            with open(path, 'wt') as file:
+                file.write("Traced memory {current} bytes, peak {peak} bytes, {growth:+d} bytes since the last "
+                           "snapshot\n\n".format(current=tracemalloc.get_traced_memory()[0],
+                                                 peak=tracemalloc.get_traced_memory()[1],
+                                                 growth=growth))
+                for difference in differences[:self._config.profiling_tracemalloc_top]:
+                    file.write(str(difference) + '\n')
+
+            self._rotate('tracemalloc-', '.txt')
+            logging.info("[Info] Memory {growth:+d} bytes since the last snapshot, see {path}".format(
+                growth=growth, path=path))
+
+
+class MessageProfile(object):
+    """
+    Profiles one message for an enabled Profiler
+
+    Stage timings are collected from metrics.Stage through the thread's StageMetrics trace.
+    """
+
+    def __init__(self, profiler: Profiler, command: str, user: str):
+        self._profiler: Profiler = profiler
+        self._command: str = command
+        self._user: str = user
+        self._profile: Optional[cProfile.Profile] = None
+        self._started: float = 0.0
+
+    def __enter__(self) -> 'MessageProfile':
+        StageMetrics.start_trace()
+
+        # only one profiler can run at a time, messages handled alongside a profiled one aren't sampled
+        if self._profiler._should_sample() and self._profiler._profile_lock.acquire(blocking=False):
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+            except ValueError:
+                # another profiling tool is active
+                self._profile = None
+                self._profiler._profile_lock.release()
+
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self._started
+        stages = StageMetrics.stop_trace()
+
+        if self._profile is not None:
+            self._profile.disable()
+            try:
+                self._profiler._dump(self._profile, self._command)
+            except OSError as e:
+                logging.warning("[Warning] Could not write profile: {error}".format(error=e))
+            finally:
+                self._profiler._profile_lock.release()
+
+        threshold = self._profiler._config.profiling_slow_threshold
+        if 0 < threshold <= duration:
+            self._profiler._log_slow(self._command, self._user, duration, stages)
+
+        return False
@@ -0,0 +1,198 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import signal
+import traceback
+from multiprocessing.process import BaseProcess
+from typing import Callable, List
+
+import praw
+import requests
+from praw.models import Message
+
+import botlogging
+from bulkmessenger import BulkMessageJob, BulkMessenger
+from configmanager import ConfigManager
+from exception.exceptions import ReferralBotFatalException
+from inboxdispatcher import AbstractDispatcher
+from profilecache import ProfileCache
+from referralbotconfig import ReferralBotConfig
+from responder import Responder
+from validationcache import ValidationCache
+from workqueue import WorkQueue
+
+# exit code of a worker stopped by a ReferralBotFatalException, which stops the leader as well
+FATAL_EXIT_CODE = 3
+# seconds an idle worker waits before looking at the queue again
+IDLE_WAIT = 0.5
+# seconds a worker gets to finish its message on shutdown
+STOP_TIMEOUT = 30
+
+
+class QueueDispatcher(AbstractDispatcher):
+    """
+    Hands the unread messages to worker processes through a WorkQueue
+
+    This process stays the leader: it reads the inbox, queues the messages not in the MessageJournal and
+    returns without waiting for them.  The worker processes, as many as the processes setting asks for, claim
+    queued messages and run a Responder for each, one at a time.  Every sweep the leader records the messages
+    the workers answered in the journal and marks them read in bulk, and puts the failed ones back in the
+    queue to be tried again, as a failed message would be on the next sweep without workers.
+
+    Workers log through the leader's log file, load the config themselves and reload it when it changes.  A
+    worker that dies has its message queued again and is replaced, one stopped by a ReferralBotFatalException
+    stops the tenant.  Announcements and notifications are checkpointed by the workers and sent by the
+    leader's BulkMessenger, so they never hold up the next message in a worker.
+
+    Attributes:
+        _config_file (str): config file the workers load
+        _login (Callable): logs a worker into Reddit, must be importable by the worker, eg. app.login
+        _queue (workqueue.WorkQueue): messages waiting for, or answered by, the workers
+        _context (multiprocessing.context.BaseContext): starts the workers
+        _records (multiprocessing.Queue): log records of the workers
+        _stop (multiprocessing.Event): set to stop the workers once they finish their message
+        _workers (List[BaseProcess]): running workers
+    """
+
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig, bulk_messenger: BulkMessenger,
+                 config_file: str, login: Callable[[ReferralBotConfig, requests.Session], praw.Reddit]):
+        super().__init__(reddit, config, bulk_messenger)
+        self._config_file: str = config_file
+        self._login: Callable[[ReferralBotConfig, requests.Session], praw.Reddit] = login
+        self._queue: WorkQueue = WorkQueue(config.work_queue_file)
+
+        # a forked worker would inherit the leader's threads and locks mid use
+        self._context = multiprocessing.get_context('spawn')
+        self._records = self._context.Queue(-1)
+        self._stop = self._context.Event()
+        self._workers: List[BaseProcess] = []
+        botlogging.listen(self._records)
+
+        # claimed by workers of a previous run
+        requeued = self._queue.requeue()
+        if requeued:
+            logging.info("[Info] Queued {count} unfinished message(s) again".format(count=requeued))
+
+        for _ in range(config.processes):
+            self._start_worker()
+        # stop the workers between messages, before multiprocessing terminates them at exit
+        atexit.register(self.shutdown)
+
+    def _dispatch(self, messages: List[Message], handled: List[Message]):
+        self._check_workers()
+        # checkpointed by the workers since the last sweep
+        self._bulk_messenger.collect()
+
+        answered = self._queue.done(self._reddit)
+        for message in answered:
+            self._journal.record(message.id)
+        handled.extend(answered)
+        self._queue.remove([message.id for message in answered])
+
+        for message_id, author, error in self._queue.retry_failed():
+            logging.warning("[Warning] Message {id} from {user} failed, trying again: {error}".format(
+                id=message_id, user=author, error=error))
+
+        # answered while this sweep read the inbox
+        pending = [message for message in messages
+                   if isinstance(message, Message) and not self._journal.contains(message.id)]
+        queued = self._queue.put(pending)
+        if queued:
+            logging.info("[Info] Queued {count} message(s) for {workers} worker(s)".format(
+                count=queued, workers=len(self._workers)))
+
+    def shutdown(self):
+        self._stop.set()
+        for process in self._workers:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                logging.warning("[Warning] Worker {pid} did not stop, terminating it".format(pid=process.pid))
+                process.terminate()
+                process.join()
+            self._queue.requeue(process.pid)
+        self._workers = []
+
+        super().shutdown()
+
+    def _check_workers(self):
+        fatal = False
+
+        for process in list(self._workers):
+            if process.is_alive():
+                continue
+
+            self._workers.remove(process)
+            self._queue.requeue(process.pid)
+            if process.exitcode == FATAL_EXIT_CODE:
+                fatal = True
+            else:
+                logging.warning("[Warning] Worker {pid} exited with code {code}, starting another".format(
+                    pid=process.pid, code=process.exitcode))
+                self._start_worker()
+
+        if fatal:
+            raise ReferralBotFatalException("A worker process stopped on a fatal error")
+
+    def _start_worker(self):
+        process = self._context.Process(target=run_worker, name='Worker',
+                                        args=(self._config_file, self._login, self._records, self._stop),
+                                        daemon=True)
+        process.start()
+        self._workers.append(process)
+
+
+def run_worker(config_file: str, login: Callable[[ReferralBotConfig, requests.Session], praw.Reddit],
+               records: multiprocessing.Queue, stop: multiprocessing.Event):
+    """Answer queued messages until stop is set.  Entry point of the worker processes"""
+    # Ctrl-C reaches the whole process group, the leader stops the workers between messages instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    manager = ConfigManager(config_file)
+    botlogging.configure_worker(records, manager.config.log_level)
+    reddit = login(manager.config, requests.Session())
+    queue = WorkQueue(manager.config.work_queue_file)
+    messenger = HandOffMessenger(reddit, manager.config)
+    worker = os.getpid()
+    leader = os.getppid()
+    logging.info("[Info] Worker {pid} started".format(pid=worker))
+
+    # a leader that was killed can't set stop
+    while not stop.is_set() and os.getppid() == leader:
+        manager.reload_if_changed()
+
+        message = queue.claim(worker, reddit)
+        if message is None:
+            stop.wait(IDLE_WAIT)
+            continue
+
+        try:
+            Responder(reddit, manager.config, message, messenger).run()
+        except ReferralBotFatalException:
+            logging.fatal("[FATAL] {msg}".format(msg=traceback.format_exc()))
+            queue.fail(message.id, 'fatal error')
+            save_caches()
+            exit(FATAL_EXIT_CODE)
+        except Exception as e:
+            logging.warning("[Warning] Error answering message {id}.  Stacktrace follows: \n {trace}".format(
+                id=message.id, trace=traceback.format_exc()))
+            queue.fail(message.id, str(e))
+        else:
+            queue.complete(message.id)
+
+    save_caches()
+
+
+class HandOffMessenger(BulkMessenger):
+    """A worker's BulkMessenger: checkpoints jobs for the leader's BulkMessenger to send instead of sending them"""
+
+    def submit(self, job: BulkMessageJob):
+        job.save(self._config.bulk_queue_directory)
+        logging.info("[Info] Handed bulk message job {id} for {count} user(s) to the leader".format(
+            id=job.id, count=len(job.recipients)))
+
+
+def save_caches():
+    """Write what the worker's caches learned since their last save, the leader's saves don't include it"""
+    ProfileCache.save_all()
+    ValidationCache.save_all()
@@ -0,0 +1,100 @@
+import copy
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import praw
+from praw.models import Message
+from prawcore.rate_limit import RateLimiter
+
+# settings copied to every clone when set on the original
+CLONED_SETTINGS = ('client_id', 'client_secret', 'username', 'password', 'refresh_token', 'redirect_uri',
+                   'user_agent', 'oauth_url', 'reddit_url')
+
+
+class RedditPool(object):
+    """
+    Hands each thread working on Reddit its own praw.Reddit, logged into the same account as the original
+
+    praw isn't thread safe: its session keeps the access token and rate limiter without any locking.  A thread
+    borrows an instance for a piece of work, eg. a conversation or a bulk message, and returns it afterwards
+    for the next thread to reuse, so there are never more instances than threads working at once.  The
+    clones send their requests through the original's HTTP session and share its rate limiter, so together
+    they stay within the one budget Reddit gives the OAuth client.
+
+    Anything other than a praw.Reddit, eg. the benchmarks' in-memory stand-in, is shared as is.
+
+    Attributes:
+        _reddit (praw.Reddit): the original, only used by the thread that created it
+        _idle (List[praw.Reddit]): clones not borrowed right now
+    """
+
+    _instances: Dict[int, 'RedditPool'] = {}
+    _instances_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, reddit: praw.Reddit):
+        self._reddit: praw.Reddit = reddit
+        self._idle: List[praw.Reddit] = []
+        self._lock: threading.Lock = threading.Lock()
+
+    @classmethod
+    def for_reddit(cls, reddit: praw.Reddit) -> 'RedditPool':
+        """The pool shared by everything using reddit"""
+        with cls._instances_lock:
+            # the pool keeps reddit alive, so its id isn't reused
+            if id(reddit) not in cls._instances:
+                cls._instances[id(reddit)] = cls(reddit)
+            return cls._instances[id(reddit)]
+
+    @contextmanager
+    def borrow(self) -> Iterator[praw.Reddit]:
+        """An instance for the calling thread alone, until the block ends"""
+        if not isinstance(self._reddit, praw.Reddit):
+            yield self._reddit
+            return
+
+        with self._lock:
+            reddit = self._idle.pop() if self._idle else None
+        if reddit is None:
+            reddit = self._clone()
+
+        try:
+            yield reddit
+        finally:
+            with self._lock:
+                self._idle.append(reddit)
+
+    @staticmethod
+    def rebind(message: Message, reddit: praw.Reddit) -> Message:
+        """A copy of message whose replies, and author, go through reddit"""
+        if not isinstance(message, Message) or message._reddit is reddit:
+            return message
+
+        message = copy.copy(message)
+        message._reddit = reddit
+        if message.author is not None:
+            message.author = reddit.redditor(str(message.author))
+        return message
+
+    def _clone(self) -> praw.Reddit:
+        config = self._reddit.config
+        settings = {setting: getattr(config, setting) for setting in CLONED_SETTINGS
+                    if getattr(config, setting) not in (None, config.CONFIG_NOT_SET)}
+
+        reddit = praw.Reddit(check_for_updates=False,
+                             requestor_kwargs={'session': self._reddit._core._requestor._http},
+                             **settings)
+        # the original's limiter, which the TenantRunner may share with other accounts of the same client
+        share_rate_limiter(reddit, self._reddit._core._rate_limiter)
+        return reddit
+
+
+def share_rate_limiter(reddit: praw.Reddit, limiter: RateLimiter):
+    """Pace every request of reddit with limiter
+
+    prawcore paces each session with its own RateLimiter, fed from Reddit's x-ratelimit headers.  Reddit counts
+    requests per OAuth client, so every instance using the client needs to wait on the same budget.
+    """
+    for core in (getattr(reddit, '_authorized_core', None), getattr(reddit, '_read_only_core', None)):
+        if core is not None:
+            core._rate_limiter = limiter
@@ -1,10 +1,9 @@
-import ssl
-import urllib.request
-import re
-
+import metrics
 from exception.exceptions import InvalidCodeFormatException, InvalidCodeException
 from referralbotconfig import ReferralBotConfig
 from praw.models import Redditor
+from validationcache import ValidationCache
+from validationclient import ValidationClient
 
 
 class Referral(object):
@@ -25,23 +24,45 @@ class Referral(object):
     def validate(self) -> bool:
         """Check the URL if the format is good
 
+        Results are cached, so resubmitted codes don't hit the activation site again.
+
         Returns:
             bool: True = format is good
                    False = format is incorrect
         """
-        ssl._create_default_https_context = ssl._create_unverified_context
-        with urllib.request.urlopen(self._createlink()) as response:
-            html = response.read().decode('utf-8')
-            # look for the checkbox icon on the page
-            if re.search(self._config.html_match_success, html) is None:
+        with metrics.stage('validate'):
+            cache = ValidationCache.for_config(self._config)
+            valid = cache.get(self._code)
+
+            if valid is None:
+                valid = self.refresh()
+
+            if not valid:
                 raise InvalidCodeException()
 
         return True
 
+    def refresh(self) -> bool:
+        """Check the code against the activation site, even if a result is cached, and cache the new result
+
+        Raises:
+            ValidationUnavailableException: the activation site could not be checked
+        """
+        with metrics.stage('validation_fetch') as stage:
+            valid = self._fetch_validation()
+            stage.outcome = 'valid' if valid else 'invalid_code'
+
+        ValidationCache.for_config(self._config).put(self._code, valid)
+        return valid
+
+    def _fetch_validation(self) -> bool:
+        # look for the checkbox icon on the page
+        return ValidationClient.for_config(self._config).is_valid(self._createlink())
+
     def check_format(self) -> bool:
-        matcher = re.compile(self._config.code_regex, re.IGNORECASE)
-        if not matcher.match(self._code):
-            raise InvalidCodeFormatException()
+        with metrics.stage('check_format'):
+            if not self._config.code_pattern.match(self._code):
+                raise InvalidCodeFormatException()
 
         return True
 
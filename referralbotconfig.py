@@ -1,12 +1,72 @@
 from configparser import ConfigParser, ExtendedInterpolation
+import re
+import string
+from typing import Dict, FrozenSet, List, Optional, Pattern, Tuple
 import urllib.parse
 
+from exception.exceptions import InvalidConfigException
+
+# the fields each reply template is formatted with
+TEMPLATE_FIELDS: Dict[str, FrozenSet[str]] = {
+    'bulk_report_message': frozenset(('subject', 'total', 'sent', 'failed', 'skipped', 'duration', 'failures')),
+    'optin_duplicate_message': frozenset(('code',)),
+    'optin_invalid_code_message': frozenset(('code',)),
+    'optin_message': frozenset(('code',)),
+    'referral_message': frozenset(('code', 'referrer')),
+    'referrer_message': frozenset(('code', 'notify_user')),
+    'renewal_duplicate_message': frozenset(('code',)),
+    'renewal_invalid_code_message': frozenset(('code',)),
+    'renewal_message': frozenset(('code',)),
+    'renewal_process_success': frozenset(('report',)),
+}
+
+
+class MessageTemplate(str):
+    """
+    Reply text with {field} placeholders, split into its literal text and field names when the config loads
+
+    format() joins the pieces rather than parsing the whole template again for every reply.  Templates using
+    anything beyond plain named fields, eg. {0} or {code!r:>10}, are left to str.format.
+    """
+
+    def __new__(cls, text: str) -> 'MessageTemplate':
+        template = super().__new__(cls, text)
+        template._pieces = template._split()
+        return template
+
+    def format(self, *args, **kwargs) -> str:
+        if args or self._pieces is None:
+            return str.format(self, *args, **kwargs)
+
+        return ''.join([literal if field is None else literal + format(kwargs[field], '')
+                        for literal, field in self._pieces])
+
+    def _split(self) -> Optional[List[Tuple[str, Optional[str]]]]:
+        pieces: List[Tuple[str, Optional[str]]] = []
+        try:
+            for literal, field, spec, conversion in string.Formatter().parse(self):
+                if field is not None and (not field.isidentifier() or spec or conversion):
+                    return None
+                pieces.append((literal, field))
+        except ValueError:
+            # unbalanced braces, str.format raises the same error when the template is used
+            return None
+
+        return pieces
+
 
 class ReferralBotConfig(object):
     """
     Global configuration handler
 
     There's probably a better Python pattern
+
+    Raises:
+        configparser.Error: a required option is missing
+        ValueError: an option has the wrong type
+        re.error: codeRegex or htmlMatchSuccess isn't a valid regular expression
+        InvalidConfigException: a reply template uses a field it isn't formatted with, or a rotation weight isn't
+            greater than 0
     """
 
     def __init__(self, filename):
@@ -33,43 +93,137 @@ class ReferralBotConfig(object):
         self._announcement_subject: str = config.get('Announcements', 'subject')
         self._announcement_success_message: str = config.get('Announcements', 'success')
         self._botname: str = config.get('referralbot', 'botName')
+        self._bulk_min_remaining: int = int(config.get('Bulk Messages', 'minRemainingRequests', fallback='10'))
+        self._bulk_queue_directory: str = config.get('Bulk Messages', 'queueDirectory', fallback='bulkmessages')
+        self._bulk_report_message: str = MessageTemplate(config.get('Bulk Messages', 'report',
+                                                                    fallback='{sent} of {total} sent'))
+        self._bulk_report_subject: str = config.get('Bulk Messages', 'reportSubject', fallback='Bulk message report')
+        self._bulk_workers: int = int(config.get('Bulk Messages', 'workers', fallback='4'))
         self._bot_about_message: str = config.get('Bot Message', 'aboutMessage')
         self._bot_error_message: str = config.get('Bot Message', 'errorMessage')
         self._code_regex: str = config.get('validation', 'codeRegex')
+        self._code_pattern: Pattern = re.compile(self._code_regex, re.IGNORECASE)
         self._contact_name: str = config.get('referralbot', 'contactName')
         self._home_subreddit: str = config.get('referralbot', 'subreddit')
         self._html_match_success: str = config.get('validation', 'htmlMatchSuccess')
+        self._html_success_pattern: Pattern = re.compile(self._html_match_success)
+        self._journal_file: str = config.get('polling', 'journalFile', fallback='')
+        self._journal_size: int = int(config.get('polling', 'journalSize', fallback='10000'))
         self._karma_failed_message: str = config.get('Messages', 'karmaFailed')
         self._karma_requirement: int = int(config.get('validation', 'karmaRequirement'))
+        self._log_backup_count: int = int(config.get('logging', 'backupCount', fallback='14'))
+        self._log_compress: bool = config.getboolean('logging', 'compress', fallback=True)
+        self._log_console: bool = config.getboolean('logging', 'console', fallback=True)
+        self._log_file: str = config.get('logging', 'file', fallback='log.txt')
+        self._log_format: str = config.get('logging', 'format', fallback='json')
+        self._log_level: str = config.get('logging', 'level', fallback='INFO').upper()
+        self._log_max_bytes: int = int(config.get('logging', 'maxBytes', fallback='10485760'))
+        self._log_rotate_when: str = config.get('logging', 'rotateWhen', fallback='midnight')
+        self._metrics_address: str = config.get('metrics', 'address', fallback='127.0.0.1')
+        self._metrics_port: int = int(config.get('metrics', 'port', fallback='0'))
         self._no_referrals_found_message: str = config.get('Referral Request Messages', 'noReferralsFound')
         self._noreply_message: str = config.get('Messages', 'noreply')
-        self._optin_message: str = config.get('Opt-In Messages', 'success')
-        self._optin_duplicate_message: str = config.get('Opt-In Messages', 'duplicate')
-        self._optin_invalid_code_message: str = config.get('Opt-In Messages', 'invalidCode')
+        self._optin_message: str = MessageTemplate(config.get('Opt-In Messages', 'success'))
+        self._optin_duplicate_message: str = MessageTemplate(config.get('Opt-In Messages', 'duplicate'))
+        self._optin_invalid_code_message: str = MessageTemplate(config.get('Opt-In Messages', 'invalidCode'))
+        self._poll_backoff_factor: float = float(config.get('polling', 'backoffFactor', fallback='2'))
+        self._poll_error_delay: float = float(config.get('polling', 'errorDelay', fallback='30'))
+        self._poll_max_error_delay: float = float(config.get('polling', 'maxErrorDelay', fallback='600'))
+        self._poll_max_interval: float = float(config.get('polling', 'maxInterval', fallback='30'))
+        self._poll_min_interval: float = float(config.get('polling', 'minInterval', fallback='5'))
+        self._poll_mode: str = config.get('polling', 'mode', fallback='poll')
+        self._praw_site: str = config.get('referralbot', 'prawSite', fallback='')
+        self._processes: int = int(config.get('referralbot', 'processes', fallback='1'))
+        self._profile_cache_file: str = config.get('validation', 'profileCacheFile', fallback='')
+        self._profile_cache_size: int = int(config.get('validation', 'profileCacheSize', fallback='10000'))
+        self._profile_karma_ttl: float = float(config.get('validation', 'profileKarmaTtl', fallback='3600'))
+        self._profile_prefetch: bool = config.getboolean('validation', 'profilePrefetch', fallback=True)
+        self._profile_save_interval: float = float(config.get('validation', 'profileSaveInterval', fallback='300'))
+        self._profiling_directory: str = config.get('profiling', 'directory', fallback='profiles')
+        self._profiling_enabled: bool = config.getboolean('profiling', 'enabled', fallback=False)
+        self._profiling_keep: int = int(config.get('profiling', 'keep', fallback='10'))
+        self._profiling_sample_rate: float = float(config.get('profiling', 'sampleRate', fallback='0.05'))
+        self._profiling_slow_threshold: float = float(config.get('profiling', 'slowThreshold', fallback='5'))
+        self._profiling_tracemalloc_frames: int = int(config.get('profiling', 'tracemallocFrames', fallback='1'))
+        self._profiling_tracemalloc_interval: float = float(config.get('profiling', 'tracemallocInterval',
+                                                                       fallback='300'))
+        self._profiling_tracemalloc_top: int = int(config.get('profiling', 'tracemallocTop', fallback='25'))
         self._referral_base_url: str = config.get('Links', 'referralBaseUrl')
         self._referral_source_type: str = config.get('referralbot', 'referralOutputMethod')
 
+        self._sqlite_database: str = config.get('sqlite', 'database', fallback='referralbot.db')
+        self._sqlite_render_wiki: bool = config.getboolean('sqlite', 'renderWiki', fallback=False)
+        self._wiki_referral_list_name: str = config.get('wiki', 'referralList')
+        self._wiki_renewal_list_name: str = config.get('wiki', 'renewalList')
+        self._wiki_write_batch_size: int = int(config.get('wiki', 'writeBatchSize', fallback='20'))
+        self._wiki_write_window: float = float(config.get('wiki', 'writeWindow', fallback='0'))
+
         if self._referral_source_type == 'wiki':
-            self._referral_list_name: str = config.get('wiki', 'referralList')
-            self._renewal_list_name: str = config.get('wiki', 'renewalList')
+            self._referral_list_name: str = self._wiki_referral_list_name
+            self._renewal_list_name: str = self._wiki_renewal_list_name
+            self._quarantine_list_name: str = config.get('wiki', 'quarantineList', fallback='referrals-quarantine')
+        elif self._referral_source_type == 'sqlite':
+            self._referral_list_name: str = config.get('sqlite', 'referralList')
+            self._renewal_list_name: str = config.get('sqlite', 'renewalList')
+            self._quarantine_list_name: str = config.get('sqlite', 'quarantineList', fallback='referrals-quarantine')
         else:
             self._referral_list_name: str = config.get('file', 'referralList')
             self._renewal_list_name: str = config.get('file', 'renewalList')
+            self._quarantine_list_name: str = config.get('file', 'quarantineList', fallback='quarantineList.txt')
 
-        self._referral_message: str = config.get('Referral Request Messages', 'referralMessage')
-        self._referrer_message: str = config.get('Referral Request Messages', 'referrerMessage')
+        self._referral_message: str = MessageTemplate(config.get('Referral Request Messages', 'referralMessage'))
+        self._referrer_message: str = MessageTemplate(config.get('Referral Request Messages', 'referrerMessage'))
         self._referrer_subject: str = config.get('Referral Request Messages', 'referrerSubject')
         self._renewal_complete: str = config.get('Process Renewal Messages', 'complete')
         self._renewal_complete_subject: str = config.get('Process Renewal Messages', 'completeSubject')
-        self._renewal_duplicate_message: str = config.get('Renewal Request Messages', 'duplicate')
+        # new members get the renewal message unless they have their own, dropped members only get one if set
+        self._renewal_added: str = config.get('Process Renewal Messages', 'added', fallback=self._renewal_complete)
+        self._renewal_added_subject: str = config.get('Process Renewal Messages', 'addedSubject',
+                                                      fallback=self._renewal_complete_subject)
+        self._renewal_dropped: str = config.get('Process Renewal Messages', 'dropped', fallback='')
+        self._renewal_dropped_subject: str = config.get('Process Renewal Messages', 'droppedSubject', fallback='')
+        self._renewal_duplicate_message: str = MessageTemplate(config.get('Renewal Request Messages', 'duplicate'))
         self._renewal_failed_message: str = config.get('Process Renewal Messages', 'failed')
-        self._renewal_invalid_code_message: str = config.get('Renewal Request Messages', 'invalidCode')
-        self._renewal_process_success: str = config.get('Process Renewal Messages', 'success')
-        self._renewal_message: str = config.get('Renewal Request Messages', 'success')
+        self._renewal_invalid_code_message: str = MessageTemplate(config.get('Renewal Request Messages', 'invalidCode'))
+        self._renewal_process_success: str = MessageTemplate(config.get('Process Renewal Messages', 'success'))
+        self._renewal_message: str = MessageTemplate(config.get('Renewal Request Messages', 'success'))
         self._request_subject: str = config.get('Referral Request Messages', 'requestSubject')
+        self._revalidation_budget: float = float(config.get('revalidation', 'budget', fallback='300'))
+        self._revalidation_concurrency: int = int(config.get('revalidation', 'concurrency', fallback='2'))
+        self._revalidation_enabled: bool = config.getboolean('revalidation', 'enabled', fallback=False)
+        self._revalidation_failures: int = int(config.get('revalidation', 'failures', fallback='3'))
+        self._revalidation_interval: float = float(config.get('revalidation', 'interval', fallback='3600'))
+        self._rotation_policy: str = config.get('rotation', 'policy', fallback='fair')
+        self._rotation_save_interval: float = float(config.get('rotation', 'saveInterval', fallback='60'))
+        self._rotation_state_file: str = config.get('rotation', 'stateFile', fallback='')
+        # user:weight pairs, separated by commas
+        self._rotation_weights: Dict[str, float] = {
+            user.strip().lower(): float(weight) for user, _, weight in
+            (item.partition(':') for item in config.get('rotation', 'weights', fallback='').split(',') if item.strip())}
         self._service_link: str = config.get('Links', 'serviceLink')
+        self._snapshot_file: str = config.get('snapshot', 'file', fallback='')
+        self._snapshot_interval: float = float(config.get('snapshot', 'interval', fallback='300'))
         self._service_name: str = config.get('referralbot', 'serviceName')
         self._update_approved_text: str = config.get('referralbot', 'updateApprovedText')
+        self._validation_cache_file: str = config.get('validation', 'cacheFile', fallback='')
+        self._validation_cache_invalid_ttl: int = int(config.get('validation', 'cacheInvalidTtl', fallback='900'))
+        self._validation_cache_save_interval: float = float(config.get('validation', 'cacheSaveInterval',
+                                                                       fallback='300'))
+        self._validation_cache_size: int = int(config.get('validation', 'cacheSize', fallback='5000'))
+        self._validation_cache_valid_ttl: int = int(config.get('validation', 'cacheValidTtl', fallback='86400'))
+        self._validation_connect_timeout: float = float(config.get('validation', 'connectTimeout', fallback='5'))
+        self._validation_failure_threshold: int = int(config.get('validation', 'failureThreshold', fallback='3'))
+        self._validation_pool_size: int = int(config.get('validation', 'poolSize', fallback='4'))
+        self._validation_read_timeout: float = float(config.get('validation', 'readTimeout', fallback='10'))
+        self._validation_reset_timeout: float = float(config.get('validation', 'resetTimeout', fallback='60'))
+        self._validation_verify_certificate: bool = config.getboolean('validation', 'verifyCertificate',
+                                                                      fallback=True)
+        self._work_queue_file: str = config.get('referralbot', 'queueFile', fallback='workqueue.db')
+        self._workers: int = int(config.get('referralbot', 'workers', fallback='1'))
+
+        self._check_templates()
+        if any(weight <= 0 for weight in self._rotation_weights.values()):
+            raise InvalidConfigException("rotation weights must be greater than 0")
 
     @property
     def activation(self) -> str:
@@ -95,6 +249,26 @@ class ReferralBotConfig(object):
     def botname(self) -> str:
         return self._botname
 
+    @property
+    def bulk_min_remaining(self) -> int:
+        return self._bulk_min_remaining
+
+    @property
+    def bulk_queue_directory(self) -> str:
+        return self._bulk_queue_directory
+
+    @property
+    def bulk_report_message(self) -> str:
+        return self._bulk_report_message
+
+    @property
+    def bulk_report_subject(self) -> str:
+        return self._bulk_report_subject
+
+    @property
+    def bulk_workers(self) -> int:
+        return self._bulk_workers
+
     @property
     def bot_about_message(self) -> str:
         return self._bot_about_message
@@ -107,6 +281,10 @@ class ReferralBotConfig(object):
     def bot_message_link(self) -> str:
         return self._bot_message_link
 
+    @property
+    def code_pattern(self) -> Pattern:
+        return self._code_pattern
+
     @property
     def code_regex(self) -> str:
         return self._code_regex
@@ -123,6 +301,18 @@ class ReferralBotConfig(object):
     def html_match_success(self) -> str:
         return self._html_match_success
 
+    @property
+    def html_success_pattern(self) -> Pattern:
+        return self._html_success_pattern
+
+    @property
+    def journal_file(self) -> str:
+        return self._journal_file
+
+    @property
+    def journal_size(self) -> int:
+        return self._journal_size
+
     @property
     def karma_failed_message(self) -> str:
         return self._karma_failed_message
@@ -131,6 +321,46 @@ class ReferralBotConfig(object):
     def karma_requirement(self) -> int:
         return self._karma_requirement
 
+    @property
+    def log_backup_count(self) -> int:
+        return self._log_backup_count
+
+    @property
+    def log_compress(self) -> bool:
+        return self._log_compress
+
+    @property
+    def log_console(self) -> bool:
+        return self._log_console
+
+    @property
+    def log_file(self) -> str:
+        return self._log_file
+
+    @property
+    def log_format(self) -> str:
+        return self._log_format
+
+    @property
+    def log_level(self) -> str:
+        return self._log_level
+
+    @property
+    def log_max_bytes(self) -> int:
+        return self._log_max_bytes
+
+    @property
+    def log_rotate_when(self) -> str:
+        return self._log_rotate_when
+
+    @property
+    def metrics_address(self) -> str:
+        return self._metrics_address
+
+    @property
+    def metrics_port(self) -> int:
+        return self._metrics_port
+
     @property
     def no_referrals_found_message(self) -> str:
         return self._no_referrals_found_message
@@ -151,6 +381,94 @@ class ReferralBotConfig(object):
     def optin_invalid_code_message(self) -> str:
         return self._optin_invalid_code_message
 
+    @property
+    def poll_backoff_factor(self) -> float:
+        return self._poll_backoff_factor
+
+    @property
+    def poll_error_delay(self) -> float:
+        return self._poll_error_delay
+
+    @property
+    def poll_max_error_delay(self) -> float:
+        return self._poll_max_error_delay
+
+    @property
+    def poll_max_interval(self) -> float:
+        return self._poll_max_interval
+
+    @property
+    def poll_min_interval(self) -> float:
+        return self._poll_min_interval
+
+    @property
+    def poll_mode(self) -> str:
+        return self._poll_mode
+
+    @property
+    def praw_site(self) -> str:
+        return self._praw_site
+
+    @property
+    def processes(self) -> int:
+        return self._processes
+
+    @property
+    def profile_cache_file(self) -> str:
+        return self._profile_cache_file
+
+    @property
+    def profile_cache_size(self) -> int:
+        return self._profile_cache_size
+
+    @property
+    def profile_karma_ttl(self) -> float:
+        return self._profile_karma_ttl
+
+    @property
+    def profile_prefetch(self) -> bool:
+        return self._profile_prefetch
+
+    @property
+    def profile_save_interval(self) -> float:
+        return self._profile_save_interval
+
+    @property
+    def profiling_directory(self) -> str:
+        return self._profiling_directory
+
+    @property
+    def profiling_enabled(self) -> bool:
+        return self._profiling_enabled
+
+    @property
+    def profiling_keep(self) -> int:
+        return self._profiling_keep
+
+    @property
+    def profiling_sample_rate(self) -> float:
+        return self._profiling_sample_rate
+
+    @property
+    def profiling_slow_threshold(self) -> float:
+        return self._profiling_slow_threshold
+
+    @property
+    def profiling_tracemalloc_frames(self) -> int:
+        return self._profiling_tracemalloc_frames
+
+    @property
+    def profiling_tracemalloc_interval(self) -> float:
+        return self._profiling_tracemalloc_interval
+
+    @property
+    def profiling_tracemalloc_top(self) -> int:
+        return self._profiling_tracemalloc_top
+
+    @property
+    def quarantine_list_name(self) -> str:
+        return self._quarantine_list_name
+
     @property
     def referral_base_url(self) -> str:
         return self._referral_base_url
@@ -175,6 +493,14 @@ class ReferralBotConfig(object):
     def referrer_subject(self) -> str:
         return self._referrer_subject
 
+    @property
+    def renewal_added(self) -> str:
+        return self._renewal_added
+
+    @property
+    def renewal_added_subject(self) -> str:
+        return self._renewal_added_subject
+
     @property
     def renewal_complete(self) -> str:
         return self._renewal_complete
@@ -183,6 +509,14 @@ class ReferralBotConfig(object):
     def renewal_complete_subject(self) -> str:
         return self._renewal_complete_subject
 
+    @property
+    def renewal_dropped(self) -> str:
+        return self._renewal_dropped
+
+    @property
+    def renewal_dropped_subject(self) -> str:
+        return self._renewal_dropped_subject
+
     @property
     def renewal_duplicate_message(self) -> str:
         return self._renewal_duplicate_message
@@ -211,6 +545,42 @@ class ReferralBotConfig(object):
     def request_subject(self) -> str:
         return self._request_subject
 
+    @property
+    def revalidation_budget(self) -> float:
+        return self._revalidation_budget
+
+    @property
+    def revalidation_concurrency(self) -> int:
+        return self._revalidation_concurrency
+
+    @property
+    def revalidation_enabled(self) -> bool:
+        return self._revalidation_enabled
+
+    @property
+    def revalidation_failures(self) -> int:
+        return self._revalidation_failures
+
+    @property
+    def revalidation_interval(self) -> float:
+        return self._revalidation_interval
+
+    @property
+    def rotation_policy(self) -> str:
+        return self._rotation_policy
+
+    @property
+    def rotation_save_interval(self) -> float:
+        return self._rotation_save_interval
+
+    @property
+    def rotation_state_file(self) -> str:
+        return self._rotation_state_file
+
+    @property
+    def rotation_weights(self) -> Dict[str, float]:
+        return self._rotation_weights
+
     @property
     def service_link(self) -> str:
         return self._service_link
@@ -219,6 +589,22 @@ class ReferralBotConfig(object):
     def service_name(self) -> str:
         return self._service_name
 
+    @property
+    def snapshot_file(self) -> str:
+        return self._snapshot_file
+
+    @property
+    def snapshot_interval(self) -> float:
+        return self._snapshot_interval
+
+    @property
+    def sqlite_database(self) -> str:
+        return self._sqlite_database
+
+    @property
+    def sqlite_render_wiki(self) -> bool:
+        return self._sqlite_render_wiki
+
     @property
     def update_approved_text(self) -> str:
         return self._update_approved_text
@@ -226,3 +612,86 @@ class ReferralBotConfig(object):
     @property
     def user_message_link(self) -> str:
         return self._user_message_link
+
+    @property
+    def validation_cache_file(self) -> str:
+        return self._validation_cache_file
+
+    @property
+    def validation_cache_invalid_ttl(self) -> int:
+        return self._validation_cache_invalid_ttl
+
+    @property
+    def validation_cache_save_interval(self) -> float:
+        return self._validation_cache_save_interval
+
+    @property
+    def validation_cache_size(self) -> int:
+        return self._validation_cache_size
+
+    @property
+    def validation_cache_valid_ttl(self) -> int:
+        return self._validation_cache_valid_ttl
+
+    @property
+    def validation_connect_timeout(self) -> float:
+        return self._validation_connect_timeout
+
+    @property
+    def validation_failure_threshold(self) -> int:
+        return self._validation_failure_threshold
+
+    @property
+    def validation_pool_size(self) -> int:
+        return self._validation_pool_size
+
+    @property
+    def validation_read_timeout(self) -> float:
+        return self._validation_read_timeout
+
+    @property
+    def validation_reset_timeout(self) -> float:
+        return self._validation_reset_timeout
+
+    @property
+    def validation_verify_certificate(self) -> bool:
+        return self._validation_verify_certificate
+
+    @property
+    def wiki_referral_list_name(self) -> str:
+        return self._wiki_referral_list_name
+
+    @property
+    def wiki_renewal_list_name(self) -> str:
+        return self._wiki_renewal_list_name
+
+    @property
+    def wiki_write_batch_size(self) -> int:
+        return self._wiki_write_batch_size
+
+    @property
+    def wiki_write_window(self) -> float:
+        return self._wiki_write_window
+
+    @property
+    def work_queue_file(self) -> str:
+        return self._work_queue_file
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def _check_templates(self):
+        """Fail on a template that would raise when a reply is formatted, rather than part way through a reply"""
+        for name, allowed in TEMPLATE_FIELDS.items():
+            try:
+                fields = {field for _, field, _, _ in string.Formatter().parse(getattr(self, name))
+                          if field is not None}
+            except ValueError as e:
+                raise InvalidConfigException("{name}: {error}".format(name=name, error=e))
+
+            # {referrer.name} is formatted from referrer
+            unknown = {re.split(r'[.\[]', field)[0] for field in fields} - allowed
+            if unknown:
+                raise InvalidConfigException("{name} uses unknown field(s) {fields}, expected {allowed}".format(
+                    name=name, fields=', '.join(sorted(unknown)), allowed=', '.join(sorted(allowed))))
@@ -1,10 +1,73 @@
+from typing import Dict, List, Tuple
+
 from praw import Reddit
 
 from handler.filehandlers import FileReferralHandler, FileRenewalHandler
 from handler.handlers import AbstractHandler
+from handler.sqlitehandlers import SqliteReferralHandler, SqliteRenewalHandler
 from handler.wikihandlers import WikiReferralHandler, WikiRenewalHandler
 from referralbotconfig import ReferralBotConfig
 
+# names listed per group in the report, the rest are counted
+REPORT_NAMES = 50
+
+
+class RenewalReport(object):
+    """
+    What a renewal changed: who stayed on the referral list, who joined, who was dropped
+
+    Users are compared case insensitively and each is in at most one group, in list order.
+
+    Attributes:
+        _retained (List[str]): on the list before and renewed
+        _added (List[str]): renewed without being on the list before
+        _dropped (List[str]): on the list before and did not renew
+        _duplicates (int): renewal entries left out because their code was already on the new list
+    """
+
+    def __init__(self, retained: List[str], added: List[str], dropped: List[str], duplicates: int):
+        self._retained: List[str] = retained
+        self._added: List[str] = added
+        self._dropped: List[str] = dropped
+        self._duplicates: int = duplicates
+
+    @property
+    def added(self) -> List[str]:
+        return self._added
+
+    @property
+    def dropped(self) -> List[str]:
+        return self._dropped
+
+    @property
+    def duplicates(self) -> int:
+        return self._duplicates
+
+    @property
+    def retained(self) -> List[str]:
+        return self._retained
+
+    def summary(self) -> str:
+        """Markdown for the moderator's reply"""
+        lines = ["Retained: {count}".format(count=len(self._retained)),
+                 "Added: {count}{names}".format(count=len(self._added), names=self._names(self._added)),
+                 "Dropped: {count}{names}".format(count=len(self._dropped), names=self._names(self._dropped))]
+        if self._duplicates:
+            lines.append("Duplicate entries removed: {count}".format(count=self._duplicates))
+
+        return '\n\n'.join(lines)
+
+    @staticmethod
+    def _names(users: List[str]) -> str:
+        if not users:
+            return ''
+
+        names = ', '.join('/u/' + user for user in users[:REPORT_NAMES])
+        if len(users) > REPORT_NAMES:
+            names += " and {count} more".format(count=len(users) - REPORT_NAMES)
+
+        return ' (' + names + ')'
+
 
 class ReferralProcessor(object):
     """
@@ -21,13 +84,67 @@ class ReferralProcessor(object):
         if config.referral_source_type == 'wiki':
             self._referralHandler: AbstractHandler = WikiReferralHandler(config, reddit)
             self._renewalHandler: AbstractHandler = WikiRenewalHandler(config, reddit)
+        elif config.referral_source_type == 'sqlite':
+            self._referralHandler: AbstractHandler = SqliteReferralHandler(config, reddit)
+            self._renewalHandler: AbstractHandler = SqliteRenewalHandler(config, reddit)
         else:
             self._referralHandler: AbstractHandler = FileReferralHandler(config, reddit)
             self._renewalHandler: AbstractHandler = FileRenewalHandler(config, reddit)
 
-    def process(self):
-        self._referralHandler.replace(self._renewalHandler.get_raw_text())
-        self._renewalHandler.replace('')
+    def process(self) -> RenewalReport:
+        """Make the renewals the new referral list, empty the renewal list and report who changed"""
+        previous: List[str] = []
+        renewed: List[str] = []
+        duplicates = 0
+
+        def merge(raw_text: str) -> str:
+            # called with both lists locked, so no renewal can be added between the read and the reset
+            nonlocal previous, renewed, duplicates
+            previous = self._referralHandler.get_usernames()
+            merged, renewed, duplicates = self._merge(raw_text)
+            return merged
+
+        self._referralHandler.replace_with(self._renewalHandler, merge)
+
+        return self._compare(previous, renewed, duplicates)
 
     def is_renewal_approved(self):
         return self._config.update_approved_text in self._referralHandler.get_raw_text()
+
+    @staticmethod
+    def _merge(raw_text: str) -> Tuple[str, List[str], int]:
+        """Drop the entries repeating an earlier code, returning the text, the users in order and how many"""
+        codes = set()
+        users: List[str] = []
+        lines: List[str] = []
+        duplicates = 0
+
+        # same rule as the handlers: a line with exactly one colon is a user:code entry
+        for line in raw_text.splitlines(keepends=True):
+            items = line.strip().split(':')
+            if len(items) == 2:
+                code = items[1].strip().upper()
+                if code in codes:
+                    duplicates += 1
+                    continue
+                codes.add(code)
+                users.append(items[0].strip())
+            lines.append(line)
+
+        return ''.join(lines), users, duplicates
+
+    @staticmethod
+    def _compare(previous: List[str], renewed: List[str], duplicates: int) -> RenewalReport:
+        before = {user.lower() for user in previous}
+        after: Dict[str, str] = {}
+        for user in renewed:
+            after.setdefault(user.lower(), user)
+
+        retained = [user for key, user in after.items() if key in before]
+        added = [user for key, user in after.items() if key not in before]
+        dropped: Dict[str, str] = {}
+        for user in previous:
+            if user.lower() not in after:
+                dropped.setdefault(user.lower(), user)
+
+        return RenewalReport(retained, added, list(dropped.values()), duplicates)
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
+from typing import Tuple
 
 import praw
 from praw.models import Message
@@ -10,10 +11,17 @@ import logging
 
 from prawcore import NotFound, Forbidden, BadRequest
 
+import metrics
+from botlogging import LogContext
+from bulkmessenger import BulkMessageJob, BulkMessenger
+from commandrouter import Command, CommandRouter, Stopwatch
 from exception.exceptions import InvalidCodeFormatException, InvalidCodeException, DuplicateCodeException, \
-    NoReferralsFoundException, ReferralBotFatalException
+    NoReferralsFoundException, ReferralBotFatalException, ValidationUnavailableException
 from handler.filehandlers import FileReferralHandler, FileRenewalHandler
 from handler.handlers import AbstractHandler
+from handler.sqlitehandlers import SqliteReferralHandler, SqliteRenewalHandler
+from profilecache import ProfileCache
+from profiling import Profiler
 from referralbotconfig import ReferralBotConfig
 from handler.wikihandlers import WikiReferralHandler, WikiRenewalHandler
 from referral import Referral
@@ -29,14 +37,24 @@ class Responder(object):
         _user (str): Author of message
         _replyMessage (str): Message body to send back
         _referrer (str); Username of person who will refer the user
+        _bulk_messenger (bulkmessenger.BulkMessenger): sends announcements and renewal notifications
+        _router (commandrouter.CommandRouter): picks the command for the message subject
+        _profiles (profilecache.ProfileCache): cached account ages and karma, shared by every Responder
+        _outcome (str): how the command went, eg. duplicate or invalid_code, for metrics
     """
 
-    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig, message: Message):
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig, message: Message,
+                 bulk_messenger: BulkMessenger = None):
         self._message: Message = message
         self._user = message.author
         self._config: ReferralBotConfig = config
         self._reddit: praw.Reddit = reddit
+        self._router: CommandRouter = CommandRouter.for_config(config)
+        self._profiles: ProfileCache = ProfileCache.for_config(config)
+        # without a running messenger, bulk messages are sent before replying
+        self._bulk_messenger: BulkMessenger = bulk_messenger or BulkMessenger(reddit, config)
         self._replyMessage: str = "Hello {user}! \n\n ".format(user=self._user)
+        self._outcome: str = 'ok'
 
         self._referral_list_name: str = ''
         self._renewal_list_name: str = ''
@@ -44,42 +62,46 @@ class Responder(object):
         if config.referral_source_type == 'wiki':
             self._referralHandler: AbstractHandler = WikiReferralHandler(config, reddit)
             self._renewalHandler: AbstractHandler = WikiRenewalHandler(config, reddit)
+        elif config.referral_source_type == 'sqlite':
+            self._referralHandler: AbstractHandler = SqliteReferralHandler(config, reddit)
+            self._renewalHandler: AbstractHandler = SqliteRenewalHandler(config, reddit)
         else:
             self._referralHandler: AbstractHandler = FileReferralHandler(config, reddit)
             self._renewalHandler: AbstractHandler = FileRenewalHandler(config, reddit)
 
     def run(self):
         """Handles the actions for Responder"""
-        print("Responding to {}".format(self._user))
-        logging.info("[Info] Responding to {}".format(self._user))
-        if self._user == "[deleted]":
-            logging.warning("[Warning] {} is a invalid user.  Not responding..".format(self._user))
-        elif self._user == "reddit":
-            logging.warning("[Warning] {} is an automatic Reddit message.  Not responding..".format(self._user))
-        elif self._verify_account_age():
-            print("User age verified")
-            logging.info("[Info] {} age verified".format(self._user))
-            if self._message.subject.lower() in ['Renewal'.lower(), 'Opt-in'.lower()]:
-                if self._verifykarma():
-                    print("User karma verified")
-                    logging.info("[Info] {} karma verified".format(self._user))
-                    self._build_message()
-                    self._reply()
-                else:
-                    print("User karma verification failed")
-                    logging.info("[Info] Failed karma verification, replying with karma requirement information.")
-                    self._replyMessage += self._config.karma_failed_message
-                    self._reply()
+        with LogContext.bind(message_id=self._message.id, user=str(self._user)):
+            logging.info("[Info] Responding to {}".format(self._user))
+            if self._user == "[deleted]":
+                logging.warning("[Warning] {} is a invalid user.  Not responding..".format(self._user))
+            elif self._user == "reddit":
+                logging.warning("[Warning] {} is an automatic Reddit message.  Not responding..".format(self._user))
             else:
-                print("Skipping user karma verification, not required")
-                logging.info("[Info] Skipped karma verification, not required.")
-                self._build_message()
-                self._reply()
-        else:
-            print("User age verification failed")
+                command: Command = self._router.route(self._message.subject)
+                with LogContext.bind(command=command.name), metrics.StageMetrics.command(command.name), \
+                        Profiler.for_config(self._config).message(command.name, str(self._user)), \
+                        metrics.stage('command') as stage, Stopwatch(self._router, command):
+                    self._run_command(command)
+                    stage.outcome = self._outcome
+
+    def _run_command(self, command: Command):
+        if command.requires_age and not self._verify_account_age():
             logging.info("[Info] Failed age verification, replying with age requirement information.")
             self._replyMessage += self._config.age_failed_message
-            self._reply()
+            self._outcome = 'age_failed'
+        elif command.requires_karma and not self._verifykarma():
+            logging.info("[Info] Failed karma verification, replying with karma requirement information.")
+            self._replyMessage += self._config.karma_failed_message
+            self._outcome = 'karma_failed'
+        else:
+            if command.requires_age:
+                logging.info("[Info] {} age verified".format(self._user))
+            if command.requires_karma:
+                logging.info("[Info] {} karma verified".format(self._user))
+            getattr(self, command.handler)()
+
+        self._reply()
 
     def _verify_account_age(self) -> bool:
         """
@@ -90,7 +112,9 @@ class Responder(object):
         """
         current_time = datetime.utcnow()
 
-        user_created = self._user.created_utc
+        user_created = self._profiles.get_created(str(self._user))
+        if user_created is None:
+            user_created = self._load_profile()[0]
 
         age_requirement = timedelta(days=self._config.age_requirement)
 
@@ -99,10 +123,24 @@ class Responder(object):
     def _verifykarma(self) -> bool:
         # Verifies user for at least X combined karma.  Returns true or false dependent on result.
 
-        combined_karma = self._user.link_karma + self._user.comment_karma
+        karma = self._profiles.get_karma(str(self._user))
+        if karma is None:
+            _, link_karma, comment_karma = self._load_profile()
+            karma = link_karma, comment_karma
+
+        combined_karma = sum(karma)
         min_karma = self._config.karma_requirement
         return combined_karma > min_karma
 
+    def _load_profile(self) -> Tuple[float, int, int]:
+        """Load the author's account creation time and karma from Reddit and cache them"""
+        # the first profile attribute read loads the Redditor, the rest come with it
+        with metrics.stage('redditor_load'):
+            profile = self._user.created_utc, self._user.link_karma, self._user.comment_karma
+
+        self._profiles.put(str(self._user), *profile)
+        return profile
+
     def _get_referral(self) -> Referral:
         """
         Gets _user as a randomly selected element from a list of user's who opted in to referring other customers.
@@ -120,30 +158,17 @@ class Responder(object):
 
         return referral
 
-    def _build_message(self):
-        """Build the response to the user."""
-
-        if self._message.subject.startswith("re: "):
-            # They are responding to our message. What to do?
-            logging.info("[Info] Responding to a reply")
-            print("User {} replied to our message. This is the message: \n"
-                  "Subject: {} \n Message Body: {}".format(self._user, self._message.subject, self._message.body))
-            # Respond to the message directing them to the reddit
-            self._replyMessage += self._config.noreply_message
-        elif self._config.request_subject.lower() in self._message.subject.lower():
-            self._build_message_get_referral()
-        elif "Opt-in".lower() in self._message.subject.lower():
-            self._build_message_optin()
-        elif "Renewal".lower() in self._message.subject.lower():
-            self._build_message_renewal()
-        elif "Replace Month".lower() in self._message.subject.lower():
-            self._build_message_process_renewals()
-        elif "Announcement".lower() in self._message.subject.lower():
-            self._build_message_announcement()
-        else:
-            # Tell them more about PM Mobile
-            logging.info("[Info] Responding with general response")
-            self._replyMessage += self._config.bot_about_message
+    def _build_message_reply(self):
+        # They are responding to our message. What to do?
+        logging.info("[Info] Responding to a reply.  Subject: {} \n Message Body: {}".format(self._message.subject,
+                                                                                            self._message.body))
+        # Respond to the message directing them to the reddit
+        self._replyMessage += self._config.noreply_message
+
+    def _build_message_about(self):
+        # Tell them more about PM Mobile
+        logging.info("[Info] Responding with general response")
+        self._replyMessage += self._config.bot_about_message
 
     def _build_message_get_referral(self):
         # Give them a referral
@@ -153,6 +178,7 @@ class Responder(object):
             referral: Referral = self._get_referral()
         except NoReferralsFoundException:
             self._replyMessage += self._config.no_referrals_found_message
+            self._outcome = 'no_referrals'
             logging.info("[Info] Sent No Referral Found Notification Message to " + self._config.contact_name)
         else:
             self._reddit.redditor(referral.get_user.name).message(
@@ -170,10 +196,17 @@ class Responder(object):
             self._referralHandler.save(r)
         except(InvalidCodeFormatException, InvalidCodeException):
             self._replyMessage += self._config.optin_invalid_code_message.format(code=r.get_code)
+            self._outcome = 'invalid_code'
             logging.info("[Info] Responding with Opt-In invalid code refusal")
         except DuplicateCodeException:
             self._replyMessage += self._config.optin_duplicate_message.format(code=r.get_code)
+            self._outcome = 'duplicate'
             logging.info("[Info] Responding with Opt-In duplicate refusal")
+        except ValidationUnavailableException as e:
+            self._replyMessage += self._config.bot_error_message
+            self._outcome = 'unavailable'
+            logging.warning("[Warning] Could not validate Opt-In code {code}: {error}".format(code=r.get_code,
+                                                                                           error=e))
         except (PermissionError, FileNotFoundError, NotFound, Forbidden, BadRequest) as e:
             error = "{exception_type} writing Opt-In to {type}:{target}".format(
                 exception_type=e.__class__.__name__,
@@ -192,10 +225,17 @@ class Responder(object):
             self._renewalHandler.save(r)
         except(InvalidCodeFormatException, InvalidCodeException):
             self._replyMessage += self._config.renewal_invalid_code_message.format(code=r.get_code)
+            self._outcome = 'invalid_code'
             logging.info("[Info] Responding with renewal invalid code refusal")
         except DuplicateCodeException:
             self._replyMessage += self._config.renewal_duplicate_message.format(code=r.get_code)
+            self._outcome = 'duplicate'
             logging.info("[Info] Responding with renewal duplicate refusal")
+        except ValidationUnavailableException as e:
+            self._replyMessage += self._config.bot_error_message
+            self._outcome = 'unavailable'
+            logging.warning("[Warning] Could not validate renewal code {code}: {error}".format(code=r.get_code,
+                                                                                            error=e))
         except (PermissionError, FileNotFoundError, NotFound, Forbidden, BadRequest) as e:
             error = "{exception_type} writing renewal to {type}:{target}".format(
                 exception_type=e.__class__.__name__,
@@ -222,7 +262,7 @@ class Responder(object):
         if is_renewal_approved:
             logging.info("[Info] Processing list updates...")
             try:
-                rp.process()
+                report = rp.process()
             except (PermissionError, FileNotFoundError, NotFound, Forbidden) as e:
                 error = "{exception_type} error processing renewals from:" \
                             " {type}:{source} to: {type}:{target}".format(
@@ -232,27 +272,37 @@ class Responder(object):
                                                         target=self._config.referral_list_name)
                 logging.fatal("[FATAL] " + error)
                 raise ReferralBotFatalException(error)
-            message_body = self._config.renewal_complete
-            users = self._referralHandler.get_usernames()
-            for user in users:
-                self._reddit.redditor(user).message(self._config.renewal_complete_subject, message_body)
-            self._replyMessage += self._config.renewal_process_success
+            logging.info("[Info] Renewal kept {retained}, added {added} and dropped {dropped} user(s), removed "
+                         "{duplicates} duplicate(s)".format(retained=len(report.retained), added=len(report.added),
+                                                            dropped=len(report.dropped),
+                                                            duplicates=report.duplicates))
+            # each user gets one message, the one for their group
+            groups = [(self._config.renewal_complete_subject, self._config.renewal_complete, report.retained),
+                      (self._config.renewal_added_subject, self._config.renewal_added, report.added),
+                      (self._config.renewal_dropped_subject, self._config.renewal_dropped, report.dropped)]
+            for subject, body, users in groups:
+                if users and body:
+                    self._bulk_messenger.submit(BulkMessageJob(subject, body, users, notify=str(self._user)))
+            self._replyMessage += self._config.renewal_process_success.format(report=report.summary())
         else:
             logging.info("[Info] Responding with general response.  Refusing list update request.")
             self._replyMessage += self._config.renewal_failed_message
+            self._outcome = 'refused'
 
     def _build_message_announcement(self):
         # Note: If this is used to message users without consent, consequences may arise
         if str(self._user).lower() == self._config.contact_name.lower():
             logging.info("[Info] Sending mass message...")
             users = self._referralHandler.get_usernames()
-            message_body = self._message.body
-            for user in users:
-                self._reddit.redditor(user).message(self._config.announcement_subject, message_body)
+            self._bulk_messenger.submit(BulkMessageJob(self._config.announcement_subject,
+                                                       self._message.body,
+                                                       users,
+                                                       notify=str(self._user)))
             self._replyMessage += self._config.announcement_success_message
         else:
             logging.info("[Info] Responding with general response.  Refusing announcement request.")
             self._replyMessage += self._config.bot_error_message
+            self._outcome = 'refused'
 
     def _reply(self):
         """Send a reply to the user"""
@@ -260,19 +310,18 @@ class Responder(object):
         def send_message():
             self._message.reply(self._replyMessage)
 
-        try:
-            send_message()
-            print("Message send successful to {}".format(self._user))
-            logging.info("[Info] Successfully responded to {}".format(self._user))
-        except (APIException, PRAWException, ClientException) as e:
-            print(e)
-            logging.warning("[Warning] Error sending message.  Stacktrace followed: \n" + e)
-
-            # In case of RateLimitExceeded
-            time.sleep(10)
-            send_message()
-            print("Message send successful")
-            logging.info("[Info] Successfully responded to {} after ratelimit cooldown".format(self._user))
-        except Exception as e:
-            print("Didn't send message. This is why: \n {}".format(e))
-            logging.warning("[Warning] Error sending message.  Stacktrace followed: \n" + e)
+        with metrics.stage('reply_send') as stage:
+            try:
+                send_message()
+                logging.info("[Info] Successfully responded to {}".format(self._user))
+            except (APIException, PRAWException, ClientException) as e:
+                logging.warning("[Warning] Error sending message: {error}".format(error=e), exc_info=True)
+
+                # In case of RateLimitExceeded
+                time.sleep(10)
+                send_message()
+                logging.info("[Info] Successfully responded to {} after ratelimit cooldown".format(self._user))
+                stage.outcome = 'rate_limited'
+            except Exception as e:
+                stage.outcome = metrics.outcome_for(e)
+                logging.warning("[Warning] Didn't send message: {error}".format(error=e), exc_info=True)
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import praw
+
+import metrics
+from exception.exceptions import ValidationUnavailableException
+from handler.filehandlers import FileQuarantineHandler, FileReferralHandler
+from handler.handlers import AbstractHandler
+from handler.sqlitehandlers import SqliteQuarantineHandler, SqliteReferralHandler
+from handler.wikihandlers import WikiQuarantineHandler, WikiReferralHandler
+from redditpool import RedditPool
+from referral import Referral
+from referralbotconfig import ReferralBotConfig
+from validationcache import ValidationCache
+
+
+class RevalidationSweeper(object):
+    """
+    Checks the codes on the referral list against the activation site again, in the background
+
+    Codes are only checked when opting in, so a code that stops working later would keep being handed out.
+    Every interval seconds the sweeper checks the codes whose result in the ValidationCache has expired, a
+    few at a time and for at most budget seconds, and puts the new results in the cache.  Codes it runs out
+    of time for are checked first on the next run.  A code found invalid failures times in a row is moved to
+    the quarantine list, so referral requests are only handed codes known to work.  Runs where the site
+    can't be reached change nothing.  The lists are read and written through a Reddit instance borrowed from
+    the RedditPool, since the sweep runs beside the inbox loop.
+
+    Attributes:
+        _reddit (praw.Reddit): Reddit instance
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _cache (validationcache.ValidationCache): where results are read from and reported to, and where the
+            failed checks in a row per code are counted
+        _thread (threading.Thread): the background sweep, None until started
+    """
+
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig):
+        self._reddit: praw.Reddit = reddit
+        self._config: ReferralBotConfig = config
+        self._cache: ValidationCache = ValidationCache.for_config(config)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work, name='RevalidationSweeper', daemon=True)
+        self._thread.start()
+
+    def run(self) -> Dict[str, int]:
+        """Check the codes that are due once, returning how many codes ended up in each outcome"""
+        with RedditPool.for_reddit(self._reddit).borrow() as reddit:
+            return self._run(*self._handlers(reddit))
+
+    def _run(self, referrals: AbstractHandler, quarantine: AbstractHandler) -> Dict[str, int]:
+        deadline = time.monotonic() + self._config.revalidation_budget
+        listed = referrals.get_all()
+        self._cache.retain_failures(referral.get_code for referral in listed)
+        due = [referral for referral in listed if self._cache.get(referral.get_code) is None]
+
+        with ThreadPoolExecutor(max_workers=self._config.revalidation_concurrency) as executor:
+            results = list(executor.map(lambda referral: self._check(referral, deadline), due))
+
+        counts = {'valid': 0, 'invalid': 0, 'quarantined': 0, 'unchecked': 0}
+        broken: List[Referral] = []
+        working: List[str] = []
+        for referral, valid in zip(due, results):
+            if valid is None:
+                counts['unchecked'] += 1
+            elif valid:
+                counts['valid'] += 1
+                working.append(referral.get_code)
+            else:
+                counts['invalid'] += 1
+                if self._cache.record_failure(referral.get_code) >= self._config.revalidation_failures:
+                    broken.append(referral)
+        self._cache.clear_failures(working)
+
+        if broken:
+            counts['quarantined'] = self._quarantine(broken, referrals, quarantine)
+
+        if due:
+            logging.info("[Info] Revalidated {checked} of {due} code(s): {valid} valid, {invalid} invalid, "
+                         "{quarantined} quarantined".format(checked=len(due) - counts['unchecked'], due=len(due),
+                                                            **counts))
+        return counts
+
+    def _work(self):
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                # the next run starts over from the list
+                logging.warning("[Warning] Revalidation sweep stopped: {error}".format(error=e))
+
+            time.sleep(self._config.revalidation_interval)
+
+    def _check(self, referral: Referral, deadline: float) -> Optional[bool]:
+        """Return whether the code works, or None when it wasn't checked"""
+        if time.monotonic() >= deadline:
+            return None
+
+        try:
+            with metrics.stage('revalidate') as stage:
+                valid = referral.refresh()
+                stage.outcome = 'valid' if valid else 'invalid_code'
+        except ValidationUnavailableException as e:
+            # says nothing about the code, and the circuit breaker turns the rest away quickly
+            logging.debug("[Debug] Could not revalidate {code}: {error}".format(code=referral.get_code, error=e))
+            return None
+
+        return valid
+
+    def _quarantine(self, broken: List[Referral], referrals: AbstractHandler, quarantine: AbstractHandler) -> int:
+        """Move the broken codes to the quarantine list, returning how many were moved"""
+        # added first, so a failure part way leaves a code on both lists rather than on neither.  One wiki edit
+        quarantine.append_batch(broken)
+
+        removed = referrals.remove(referral.get_code for referral in broken)
+        self._cache.clear_failures(code for _, code in removed)
+        for user, code in removed:
+            logging.info("[Info] Quarantined code {code} of {user} after {failures} failed checks".format(
+                code=code, user=user, failures=self._config.revalidation_failures))
+
+        return len(removed)
+
+    def _handlers(self, reddit: praw.Reddit) -> List[AbstractHandler]:
+        if self._config.referral_source_type == 'wiki':
+            handlers = WikiReferralHandler, WikiQuarantineHandler
+        elif self._config.referral_source_type == 'sqlite':
+            handlers = SqliteReferralHandler, SqliteQuarantineHandler
+        else:
+            handlers = FileReferralHandler, FileQuarantineHandler
+
+        return [handler(self._config, reddit) for handler in handlers]
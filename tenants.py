@@ -0,0 +1,197 @@
+import atexit
+import logging
+import time
+import traceback
+from typing import Callable, List, Optional
+
+import praw
+import requests
+from praw.exceptions import RedditAPIException
+from requests.adapters import HTTPAdapter
+
+import botlogging
+from bulkmessenger import BulkMessenger
+from configmanager import ConfigManager
+from exception.exceptions import InvalidConfigException, ReferralBotFatalException
+from handler.sqlitehandlers import SqliteWikiRenderer
+from inboxdispatcher import AbstractDispatcher, InboxDispatcher
+from metrics import MetricsServer
+from pollscheduler import PollScheduler
+from profiling import Profiler
+from queuedispatcher import QueueDispatcher
+from redditpool import share_rate_limiter
+from referralbotconfig import ReferralBotConfig
+from revalidation import RevalidationSweeper
+from warmstart import WarmStart
+
+# (config, shared HTTP session) -> logged in Reddit instance for the config's bot account
+Login = Callable[[ReferralBotConfig, requests.Session], praw.Reddit]
+
+
+class Tenant(object):
+    """
+    One community served by a TenantRunner, with its own config, bot account, lists and dispatcher
+
+    Attributes:
+        _name (str): name used in the log, the tenant's subreddit
+        _reddit (praw.Reddit): the tenant's bot account
+        _config_manager (configmanager.ConfigManager): the tenant's config, reloaded when its file changes
+        _scheduler (pollscheduler.PollScheduler): reads the tenant's inbox
+        _dispatcher (inboxdispatcher.AbstractDispatcher): answers the tenant's messages, through worker processes
+            when the config asks for more than one
+        _renderer (handler.sqlitehandlers.SqliteWikiRenderer): copies SQLite lists to the wiki, None if unused
+        _warm_start (warmstart.WarmStart): the tenant's snapshot
+    """
+
+    def __init__(self, config_manager: ConfigManager, reddit: praw.Reddit, login: Login):
+        config = config_manager.config
+        self._name: str = config.home_subreddit
+        self._reddit: praw.Reddit = reddit
+        self._config_manager: ConfigManager = config_manager
+
+        self._warm_start: WarmStart = WarmStart(reddit, config)
+        self._warm_start.load()
+        self._warm_start.warm()
+        # also on Ctrl-C and on the fatal exit
+        atexit.register(self._warm_start.save)
+
+        self._bulk_messenger: BulkMessenger = BulkMessenger(reddit, config)
+        self._bulk_messenger.start()
+        if config.processes > 1:
+            self._dispatcher: AbstractDispatcher = QueueDispatcher(reddit, config, self._bulk_messenger,
+                                                                   config_manager.filename, login)
+        else:
+            self._dispatcher: AbstractDispatcher = InboxDispatcher(reddit, config, self._bulk_messenger)
+        self._scheduler: PollScheduler = PollScheduler(reddit, config)
+        self._renderer: Optional[SqliteWikiRenderer] = None
+        if config.referral_source_type == 'sqlite' and config.sqlite_render_wiki:
+            self._renderer = SqliteWikiRenderer(config, reddit)
+        if config.revalidation_enabled:
+            RevalidationSweeper(reddit, config).start()
+
+    def sweep(self) -> int:
+        """Answer the tenant's unread messages, returning how many there were"""
+        if self._config_manager.reload_if_changed():
+            self._dispatcher.reconfigure(self._config_manager.config)
+            self._scheduler.reconfigure(self._config_manager.config)
+
+        messages = self._scheduler.fetch()
+        self._dispatcher.dispatch(messages)
+        if self._renderer is not None:
+            self._renderer.run()
+        self._warm_start.save_if_due()
+
+        return len(messages)
+
+    def shutdown(self):
+        self._dispatcher.shutdown()
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def scheduler(self) -> PollScheduler:
+        return self._scheduler
+
+
+class TenantRunner(object):
+    """
+    Serves any number of communities, each with its own referralbot.ini, from one process
+
+    Every tenant keeps its own bot account, lists, caches and workers, as configured in its file.  What they
+    share:
+
+        one HTTP connection pool, used by every bot account
+        one Reddit rate limit budget.  Reddit counts requests per OAuth client, so tenants using the same
+            client id are paced together instead of each assuming it has the whole budget
+        one polling loop.  Each sweep reads every tenant's inbox in turn.  Every remaining tenant's poll
+            settings work out their next wait, and the loop sleeps for the shortest
+
+    Logging, metrics and profiling are set up from the first tenant's config.  A tenant that hits a fatal
+    error is stopped while the others carry on.  The process exits once none are left.
+
+    Attributes:
+        _tenants (List[Tenant]): tenants still running
+        _session (requests.Session): HTTP session shared by every bot account
+    """
+
+    def __init__(self, config_files: List[str], login: Login):
+        managers = [ConfigManager(config_file) for config_file in config_files]
+        configs = [manager.config for manager in managers]
+
+        accounts = [config.praw_site for config in configs]
+        if len(set(accounts)) < len(accounts):
+            # two tenants reading one inbox would each answer the other's messages
+            raise InvalidConfigException("Every tenant needs its own bot account, set a different prawSite for each")
+        queues = [config.work_queue_file for config in configs if config.processes > 1]
+        if len(set(queues)) < len(queues):
+            # workers answer whatever is queued with their own tenant's account
+            raise InvalidConfigException("Every tenant with worker processes needs its own queueFile")
+
+        botlogging.configure(configs[0])
+        logging.info("[Info] Starting bot for {tenants}".format(
+            tenants=', '.join("/r/{subreddit} in {type} mode".format(subreddit=config.home_subreddit,
+                                                                     type=config.referral_source_type)
+                              for config in configs)))
+
+        adapter = HTTPAdapter(pool_connections=len(configs),
+                              pool_maxsize=sum(config.workers + config.bulk_workers for config in configs))
+        self._session: requests.Session = requests.Session()
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        accounts = [login(config, self._session) for config in configs]
+        self._share_rate_limit(accounts)
+
+        if configs[0].metrics_port:
+            MetricsServer(configs[0]).start()
+        Profiler.for_config(configs[0]).install_signal_handler()
+
+        self._tenants: List[Tenant] = [Tenant(manager, reddit, login) for manager, reddit in zip(managers, accounts)]
+
+    def run(self):
+        while self._tenants:
+            logging.debug("[Debug] Checking inbox...")
+
+            activity, failures, rate_limited = False, 0, False
+            for tenant in list(self._tenants):
+                try:
+                    activity = tenant.sweep() > 0 or activity
+                except ReferralBotFatalException:
+                    logging.fatal("[FATAL] {msg}".format(msg=traceback.format_exc()))
+                    logging.fatal("[FATAL] Stopping /r/{tenant}".format(tenant=tenant.name))
+                    tenant.shutdown()
+                    self._tenants.remove(tenant)
+                except RedditAPIException:
+                    # probably rate limited. Sleep until the rate limit window resets
+                    logging.warning("[Warning] Error occurred for /r/{tenant}.  Stacktrace follows: \n {trace}".format(
+                        tenant=tenant.name, trace=traceback.format_exc()))
+                    failures += 1
+                    rate_limited = True
+                except Exception:
+                    logging.warning("[Warning] Error checking inbox of /r/{tenant}.  Stacktrace follows: \n "
+                                    "{trace}".format(tenant=tenant.name, trace=traceback.format_exc()))
+                    failures += 1
+
+            if not self._tenants:
+                break
+            # the tenants still running, so a stopped one doesn't keep pacing the others
+            if rate_limited or failures == len(self._tenants):
+                delay = min(tenant.scheduler.next_error_delay(rate_limited=rate_limited) for tenant in self._tenants)
+                logging.info("[Info] Sweep failed for {failures} of {tenants} tenant(s), sleeping {delay:.0f}s".format(
+                    failures=failures, tenants=len(self._tenants), delay=delay))
+            else:
+                delay = min(tenant.scheduler.next_delay(activity=activity) for tenant in self._tenants)
+            time.sleep(delay)
+
+        logging.fatal("[FATAL] Bot is terminating")
+        botlogging.shutdown()
+        exit(1)
+
+    @staticmethod
+    def _share_rate_limit(accounts: List[praw.Reddit]):
+        # the accounts' threads borrow clones from the RedditPool, which take over the limiter set here
+        limiter = accounts[0]._core._rate_limiter
+        for reddit in accounts:
+            share_rate_limiter(reddit, limiter)
@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from referralbotconfig import ReferralBotConfig
+
+
+class ValidationCache(object):
+    """
+    LRU cache of referral code validation results with separate lifetimes for valid and invalid codes
+
+    The cache is saved to a JSON file at most every save_interval seconds and when the bot stops, so it
+    survives restarts.  One cache exists per file, shared by every Referral.  It also keeps the
+    RevalidationSweeper's count of failed checks in a row per code, so a streak isn't started over by a
+    restart or a reload.
+
+    Attributes:
+        _filename (str): where the cache is persisted, empty to keep it in memory only
+        _valid_ttl (int): seconds a valid result is trusted
+        _invalid_ttl (int): seconds an invalid result is trusted
+        _max_size (int): maximum number of codes kept
+        _save_interval (float): seconds between saves of a changed cache
+        _entries (OrderedDict): code -> (valid, expiry timestamp), least recently used first
+        _failures (Dict[str, int]): code -> failed revalidations in a row
+    """
+
+    _instances: Dict[str, 'ValidationCache'] = {}
+    _instances_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, filename: str, valid_ttl: int, invalid_ttl: int, max_size: int, save_interval: float):
+        self._filename: str = filename
+        self._valid_ttl: int = valid_ttl
+        self._invalid_ttl: int = invalid_ttl
+        self._max_size: int = max_size
+        self._save_interval: float = save_interval
+        self._entries: 'OrderedDict[str, Tuple[bool, float]]' = OrderedDict()
+        self._failures: Dict[str, int] = {}
+        self._saved_at: float = time.time()
+        self._dirty: bool = False
+        self._lock: threading.Lock = threading.Lock()
+
+        self._load()
+
+    @classmethod
+    def for_config(cls, config: ReferralBotConfig) -> 'ValidationCache':
+        """Return the shared cache for config's cache file"""
+        with cls._instances_lock:
+            cache = cls._instances.get(config.validation_cache_file)
+            if cache is None:
+                cache = cls(config.validation_cache_file,
+                            config.validation_cache_valid_ttl,
+                            config.validation_cache_invalid_ttl,
+                            config.validation_cache_size,
+                            config.validation_cache_save_interval)
+                cls._instances[config.validation_cache_file] = cache
+
+        return cache
+
+    @classmethod
+    def save_all(cls):
+        with cls._instances_lock:
+            caches = list(cls._instances.values())
+
+        for cache in caches:
+            cache.save()
+
+    @staticmethod
+    def normalize(code: str) -> str:
+        return code.strip().upper()
+
+    def get(self, code: str) -> Optional[bool]:
+        """Return the cached result for code, or None if it is unknown or expired"""
+        code = self.normalize(code)
+
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None:
+                return None
+
+            valid, expires = entry
+            if expires <= time.time():
+                del self._entries[code]
+                return None
+
+            self._entries.move_to_end(code)
+            return valid
+
+    def put(self, code: str, valid: bool):
+        ttl = self._valid_ttl if valid else self._invalid_ttl
+
+        with self._lock:
+            code = self.normalize(code)
+            self._entries[code] = (valid, time.time() + ttl)
+            self._entries.move_to_end(code)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+            self._dirty = True
+            self._save_if_due()
+
+    def invalidate(self, code: str):
+        with self._lock:
+            if self._entries.pop(self.normalize(code), None) is not None:
+                self._dirty = True
+                self._save_if_due()
+
+    def record_failure(self, code: str) -> int:
+        """Count a failed revalidation of code, returning how many failed in a row"""
+        code = self.normalize(code)
+
+        with self._lock:
+            self._failures[code] = self._failures.get(code, 0) + 1
+            self._dirty = True
+            self._save_if_due()
+            return self._failures[code]
+
+    def clear_failures(self, codes: Iterable[str]):
+        """Start the failure count of codes over, after a successful check or once they are quarantined"""
+        with self._lock:
+            for code in codes:
+                if self._failures.pop(self.normalize(code), None) is not None:
+                    self._dirty = True
+            self._save_if_due()
+
+    def retain_failures(self, codes: Iterable[str]):
+        """Forget the failure counts of codes no longer on the list"""
+        codes = {self.normalize(code) for code in codes}
+
+        with self._lock:
+            for code in self._failures.keys() - codes:
+                del self._failures[code]
+                self._dirty = True
+
+    def save(self):
+        if not self._filename:
+            return
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            # write then rename so a crash never leaves a truncated cache, through a temporary file of this process
+            temporary = '{}.{}.tmp'.format(self._filename, os.getpid())
+            with open(temporary, 'wt') as file:
+                json.dump({'entries': [[code, valid, expires] for code, (valid, expires) in self._entries.items()],
+                           'failures': self._failures}, file)
+            os.replace(temporary, self._filename)
+            self._dirty = False
+            self._saved_at = time.time()
+
+    def _load(self):
+        if not self._filename or not os.path.exists(self._filename):
+            return
+
+        try:
+            with open(self._filename) as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning("[Warning] Ignoring unreadable validation cache {file}: {error}".format(
+                file=self._filename, error=e))
+            return
+
+        if isinstance(data, list):
+            # written before the failure counts were kept
+            data = {'entries': data}
+
+        now = time.time()
+        # the file is written least recently used first
+        for code, valid, expires in data.get('entries', []):
+            if expires > now:
+                self._entries[code] = (valid, expires)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+        self._failures = data.get('failures', {})
+
+    def _save_if_due(self):
+        if self._filename and time.time() - self._saved_at >= self._save_interval:
+            # save() takes the lock itself
+            threading.Thread(target=self.save, daemon=True).start()
+            self._saved_at = time.time()
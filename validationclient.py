@@ -0,0 +1,195 @@
+import codecs
+import contextlib
+import logging
+import threading
+import time
+import warnings
+from typing import Dict, Iterator, Pattern
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from exception.exceptions import ValidationUnavailableException
+from referralbotconfig import ReferralBotConfig
+
+# client errors that say nothing about the code: the request timed out, or the site asks to slow down
+UNAVAILABLE_STATUSES = (408, 429)
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast while a remote site is down
+
+    After failure_threshold consecutive failures the breaker opens and calls are refused for reset_timeout
+    seconds.  The first call after that is let through as a trial; success closes the breaker again.
+
+    Attributes:
+        _failure_threshold (int): consecutive failures before opening
+        _reset_timeout (float): seconds to stay open
+        _failures (int): consecutive failures so far
+        _opened_at (float): when the breaker opened, None while closed
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self._failure_threshold: int = failure_threshold
+        self._reset_timeout: float = reset_timeout
+        self._failures: int = 0
+        self._opened_at: float = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if time.time() - self._opened_at >= self._reset_timeout:
+                # half open: let one trial call through and keep refusing the rest until it reports back
+                self._opened_at = time.time()
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self._failure_threshold:
+                if self._opened_at is None:
+                    logging.warning("[Warning] Activation site failed {count} times in a row, "
+                                    "pausing validation for {timeout}s".format(count=self._failures,
+                                                                               timeout=self._reset_timeout))
+                self._opened_at = time.time()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+
+class ValidationClient(object):
+    """
+    HTTP client for checking referral codes against the activation site
+
+    Connections are pooled and kept alive between validations, every request has connect and read timeouts
+    and a CircuitBreaker refuses requests while the site is down.  The page is read in chunks and reading
+    stops as soon as the success marker is found.
+
+    Attributes:
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _session (requests.Session): pooled session, certificate checks only affect this session
+        _breaker (CircuitBreaker): breaker for the activation site
+        _success (Pattern): html_match_success, compiled by the config
+    """
+
+    CHUNK_SIZE = 8192
+    # bytes left after the marker that are worth reading to keep the connection alive
+    DRAIN_LIMIT = 65536
+    # characters kept from the previous chunk so a marker split between chunks is still found
+    OVERLAP = 1024
+
+    _instances: Dict[str, 'ValidationClient'] = {}
+    _instances_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, config: ReferralBotConfig):
+        self._config: ReferralBotConfig = config
+        self._success: Pattern = config.html_success_pattern
+        self._breaker: CircuitBreaker = CircuitBreaker(config.validation_failure_threshold,
+                                                       config.validation_reset_timeout)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.validation_pool_size)
+        self._session: requests.Session = requests.Session()
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.verify = config.validation_verify_certificate
+
+    @classmethod
+    def for_config(cls, config: ReferralBotConfig) -> 'ValidationClient':
+        """Return the shared client for config's activation site"""
+        with cls._instances_lock:
+            client = cls._instances.get(config.referral_base_url)
+            if client is None:
+                client = cls(config)
+                cls._instances[config.referral_base_url] = client
+
+        return client
+
+    def is_valid(self, url: str) -> bool:
+        """Fetch url and look for the success marker
+
+        A client error, eg. 404 for a code the site doesn't know, means the code is not valid.
+
+        Raises:
+            ValidationUnavailableException: the site could not be reached, timed out, returned a server error,
+                asked to slow down or the circuit breaker is open
+        """
+        if not self._breaker.allow():
+            raise ValidationUnavailableException("Activation site is unavailable, not checking " + url)
+
+        try:
+            with self._insecure_warnings_ignored(), \
+                    self._session.get(url,
+                                      stream=True,
+                                      timeout=(self._config.validation_connect_timeout,
+                                               self._config.validation_read_timeout)) as response:
+                response.raise_for_status()
+                found = self._scan(response)
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status is not None and status < 500 and status not in UNAVAILABLE_STATUSES:
+                # the site answered, it just has no activation page for this code
+                self._breaker.record_success()
+                return False
+
+            self._breaker.record_failure()
+            raise ValidationUnavailableException(str(e)) from e
+        except requests.RequestException as e:
+            self._breaker.record_failure()
+            raise ValidationUnavailableException(str(e)) from e
+
+        self._breaker.record_success()
+        return found
+
+    @contextlib.contextmanager
+    def _insecure_warnings_ignored(self) -> Iterator[None]:
+        """Silence urllib3's warning for each request while verifyCertificate is off, around this session's
+        requests only"""
+        if self._session.verify:
+            yield
+            return
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', urllib3.exceptions.InsecureRequestWarning)
+            yield
+
+    def _scan(self, response: requests.Response) -> bool:
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+        tail = ''
+        read = 0
+
+        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+            read += len(chunk)
+            window = tail + decoder.decode(chunk)
+
+            if self._success.search(window) is not None:
+                self._release(response, read)
+                return True
+
+            tail = window[-self.OVERLAP:]
+
+        return False
+
+    def _release(self, response: requests.Response, read: int):
+        """Finish reading a short remainder so the connection goes back to the pool, otherwise drop it"""
+        length = response.headers.get('Content-Length')
+
+        if length is not None and length.isdigit() and int(length) - read <= self.DRAIN_LIMIT:
+            for _ in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                pass
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return self._breaker
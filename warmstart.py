@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Hashable, List, Optional, Tuple
+
+import praw
+
+from handler.filehandlers import FileReferralHandler, FileRenewalHandler
+from handler.handlers import AbstractHandler
+from handler.index import ReferralIndexStore
+from handler.rotation import RotationScheduler
+from handler.sqlitehandlers import SqliteReferralHandler, SqliteRenewalHandler
+from handler.wikihandlers import WikiReferralHandler, WikiReferralIndex, WikiRenewalHandler
+from profilecache import ProfileCache
+from redditpool import RedditPool
+from referralbotconfig import ReferralBotConfig
+from validationcache import ValidationCache
+from validationclient import ValidationClient
+
+SNAPSHOT_VERSION = 1
+
+
+class WarmStart(object):
+    """
+    Saves the bot's warm state on the way down and restores it on the way up
+
+    The snapshot file holds the parsed wiki referral and renewal lists with the revision each was read at.
+    Restoring them means the first request after a restart checks the page's small revisions listing instead
+    of fetching and parsing the whole page, as long as nobody edited it in the meantime.  The validation
+    cache, profile cache and rotation state keep their own files, save() writes them as well.
+
+    On startup load() restores the lists, then warm() checks them against Reddit and opens the caches on a
+    background thread while the bot already answers messages.  Anything stale is reloaded by the usual
+    revision check, whether warm() or a message gets to it first.
+
+    Attributes:
+        _reddit (praw.Reddit): Reddit instance
+        _config (referralbotconfig.ReferralBotConfig): Global configuration
+        _saved_at (float): when the snapshot was last written
+        _saved_revisions (List): (key, revision) of the lists in the last snapshot, to skip unchanged saves
+    """
+
+    def __init__(self, reddit: praw.Reddit, config: ReferralBotConfig):
+        self._reddit: praw.Reddit = reddit
+        self._config: ReferralBotConfig = config
+        self._saved_at: float = time.time()
+        self._saved_revisions: List[Tuple[Hashable, Hashable]] = []
+
+    def load(self):
+        """Put the lists from the snapshot into the ReferralIndexStore"""
+        filename = self._config.snapshot_file
+        if not filename or not os.path.exists(filename):
+            return
+
+        try:
+            with open(filename) as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning("[Warning] Ignoring unreadable snapshot {file}: {error}".format(file=filename, error=e))
+            return
+
+        if data.get('version') != SNAPSHOT_VERSION:
+            logging.info("[Info] Ignoring snapshot {file} from another version".format(file=filename))
+            return
+
+        for entry in data['indexes']:
+            key = tuple(entry['key'])
+            # a list read since startup is newer than the snapshot
+            if ReferralIndexStore.peek(key) is None:
+                ReferralIndexStore.put(key, WikiReferralIndex(entry['raw_text'], entry['revision'],
+                                                              entry['may_revise']))
+
+        self._saved_revisions = self._revisions()
+        logging.info("[Info] Restored {count} list(s) saved {age:.0f}s ago from {file}".format(
+            count=len(data['indexes']), age=time.time() - data['saved'], file=filename))
+
+    def warm(self):
+        """Revalidate the restored lists and open the caches on a background thread"""
+        threading.Thread(target=self._warm, name='WarmStart', daemon=True).start()
+
+    def save(self):
+        """Write the snapshot, the rotation state and the profile and validation caches"""
+        RotationScheduler.save_all()
+        ProfileCache.save_all()
+        ValidationCache.save_all()
+
+        filename = self._config.snapshot_file
+        self._saved_at = time.time()
+        revisions = self._revisions()
+        if not filename or revisions == self._saved_revisions:
+            return
+
+        indexes = [{'key': list(key),
+                    'revision': index.revision,
+                    'may_revise': index.may_revise,
+                    'raw_text': index.raw_text} for key, index in self._wiki_indexes()]
+
+        # write then rename so a crash never leaves a truncated snapshot
+        with open(filename + '.tmp', 'wt') as file:
+            json.dump({'version': SNAPSHOT_VERSION, 'saved': self._saved_at, 'indexes': indexes}, file)
+        os.replace(filename + '.tmp', filename)
+        self._saved_revisions = revisions
+
+    def save_if_due(self):
+        if time.time() - self._saved_at >= self._config.snapshot_interval:
+            try:
+                self.save()
+            except OSError as e:
+                logging.warning("[Warning] Could not write snapshot: {error}".format(error=e))
+
+    def _warm(self):
+        started = time.perf_counter()
+
+        try:
+            ValidationCache.for_config(self._config)
+            ValidationClient.for_config(self._config)
+            ProfileCache.for_config(self._config)
+
+            with RedditPool.for_reddit(self._reddit).borrow() as reddit:
+                for handler in self._handlers(reddit):
+                    # checks the revision and only fetches the list when it changed
+                    handler.get_usernames()
+                    if self._config.rotation_policy != 'random':
+                        RotationScheduler.for_list(self._config, handler.get_index_key())
+        except Exception as e:
+            # every message checks the lists anyway, so nothing is lost
+            logging.warning("[Warning] Warm start failed, continuing cold: {error}".format(error=e))
+            return
+
+        logging.info("[Info] Warm start finished in {seconds:.2f}s".format(seconds=time.perf_counter() - started))
+
+    def _handlers(self, reddit: praw.Reddit) -> List[AbstractHandler]:
+        if self._config.referral_source_type == 'wiki':
+            handlers = WikiReferralHandler, WikiRenewalHandler
+        elif self._config.referral_source_type == 'sqlite':
+            handlers = SqliteReferralHandler, SqliteRenewalHandler
+        else:
+            handlers = FileReferralHandler, FileRenewalHandler
+
+        return [handler(self._config, reddit) for handler in handlers]
+
+    def _wiki_indexes(self) -> List[Tuple[Hashable, WikiReferralIndex]]:
+        # local files and databases are quick to read again, only the wiki lists are worth keeping
+        return [(key, index) for key, index in ReferralIndexStore.items()
+                if isinstance(index, WikiReferralIndex) and index.revision is not None]
+
+    def _revisions(self) -> List[Tuple[Hashable, Optional[Hashable]]]:
+        return sorted(((key, index.revision) for key, index in self._wiki_indexes()), key=repr)
@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+import praw
+from praw.models import Message, Subreddit
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    message_id TEXT PRIMARY KEY,
+    author TEXT NOT NULL,
+    created_utc REAL NOT NULL,
+    data TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    worker INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, created_utc);
+'''
+
+# the Message attributes a worker needs to answer it, besides author, dest and subreddit
+MESSAGE_FIELDS = ('id', 'name', 'author_fullname', 'subject', 'body', 'body_html', 'context', 'created',
+                  'created_utc', 'distinguished', 'first_message', 'first_message_name', 'new', 'parent_id',
+                  'was_comment')
+
+
+class WorkQueue(object):
+    """
+    Inbox messages waiting for a worker process, kept in a SQLite database shared by the leader and workers
+
+    The leader puts each unread message in the queue once.  A worker claims the oldest queued message whose
+    author has no other message claimed or failed, so each user is still answered in order and by one
+    process at a time, then marks it done or failed.  The leader removes the answered messages and queues the
+    failed ones again.
+
+    Every state change is a single statement or transaction, and the database runs in WAL mode so the
+    workers' writes don't block the leader's reads.
+
+    Attributes:
+        _filename (str): the database file
+    """
+
+    _initialized: Set[str] = set()
+    _initialized_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, filename: str):
+        self._filename: str = filename
+
+    def put(self, messages: Iterable[Message]) -> int:
+        """Queue the messages not queued yet, returning how many were added"""
+        rows = [(message.id, str(message.author), message.created_utc, json.dumps(self._encode(message)))
+                for message in messages]
+
+        with self._connect() as connection:
+            before = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO jobs (message_id, author, created_utc, data) '
+                                   'VALUES (?, ?, ?, ?)', rows)
+            return connection.total_changes - before
+
+    def claim(self, worker: int, reddit: praw.Reddit) -> Optional[Message]:
+        """Claim the next message for worker, None when there is nothing to do.  Workers claim one at a time"""
+        with self._connect() as connection:
+            # one statement, so two workers can't pick the same row
+            connection.execute('''
+                UPDATE jobs SET state = 'claimed', worker = ? WHERE message_id = (
+                    SELECT message_id FROM jobs WHERE state = 'queued' AND author NOT IN (
+                        SELECT author FROM jobs WHERE state IN ('claimed', 'failed'))
+                    ORDER BY created_utc LIMIT 1)''', (worker,))
+            row = connection.execute("SELECT data FROM jobs WHERE state = 'claimed' AND worker = ?",
+                                     (worker,)).fetchone()
+
+        return self._decode(json.loads(row[0]), reddit) if row is not None else None
+
+    def complete(self, message_id: str):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET state = 'done' WHERE message_id = ?", (message_id,))
+
+    def fail(self, message_id: str, error: str):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET state = 'failed', error = ? WHERE message_id = ?",
+                               (error, message_id))
+
+    def requeue(self, worker: Optional[int] = None) -> int:
+        """Put the messages claimed by worker, or by any worker, back in the queue, returning how many"""
+        with self._connect() as connection:
+            if worker is None:
+                cursor = connection.execute("UPDATE jobs SET state = 'queued', worker = NULL "
+                                            "WHERE state = 'claimed'")
+            else:
+                cursor = connection.execute("UPDATE jobs SET state = 'queued', worker = NULL "
+                                            "WHERE state = 'claimed' AND worker = ?", (worker,))
+            return cursor.rowcount
+
+    def done(self, reddit: praw.Reddit) -> List[Message]:
+        """Return the messages answered.  They stay in the queue until removed"""
+        with self._connect() as connection:
+            rows = connection.execute("SELECT data FROM jobs WHERE state = 'done'").fetchall()
+
+        return [self._decode(json.loads(row[0]), reddit) for row in rows]
+
+    def remove(self, message_ids: List[str]):
+        with self._connect() as connection:
+            connection.executemany('DELETE FROM jobs WHERE message_id = ?',
+                                   [(message_id,) for message_id in message_ids])
+
+    def retry_failed(self) -> List[Tuple[str, str, str]]:
+        """Queue the failed messages again, returning (id, author, error) of each"""
+        with self._connect() as connection:
+            failed = connection.execute("SELECT message_id, author, error FROM jobs "
+                                        "WHERE state = 'failed'").fetchall()
+            connection.execute("UPDATE jobs SET state = 'queued', worker = NULL, error = NULL "
+                               "WHERE state = 'failed'")
+
+        return failed
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection in a transaction, committed on success and rolled back on error"""
+        connection = sqlite3.connect(self._filename, timeout=30)
+        try:
+            with self._initialized_lock:
+                if self._filename not in self._initialized:
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.executescript(SCHEMA)
+                    self._initialized.add(self._filename)
+
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _encode(message: Message) -> dict:
+        data = {field: getattr(message, field, None) for field in MESSAGE_FIELDS}
+        data['author'] = str(message.author) if message.author is not None else None
+        # messages to a subreddit have a #subreddit destination
+        data['dest'] = ('#' if isinstance(message.dest, Subreddit) else '') + str(message.dest)
+        subreddit = getattr(message, 'subreddit', None)
+        data['subreddit'] = str(subreddit) if subreddit is not None else None
+        return data
+
+    @staticmethod
+    def _decode(data: dict, reddit: praw.Reddit) -> Message:
+        return Message.parse(dict(data, replies=''), reddit)